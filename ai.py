@@ -0,0 +1,362 @@
+"""
+ИИ-ответы на вопросы, которых нет в базе знаний.
+
+- клиент LLM подключаемый: OpenAI (config.OPENAI_API_KEY) или FakeLLMClient для тестов;
+- одинаковые вопросы, заданные одновременно, превращаются в один запрос к модели,
+  все спросившие получают одни и те же частичные ответы;
+- готовые ответы кешируются (TTL + LRU) по нормализованному вопросу и справке
+  из FAQ: на первый вопрос клиента промпт общий, без истории; клиент уже в
+  диалоге (в истории есть ответы ИИ или админа) — промпт с историей, такой
+  ответ персональный и идёт мимо кеша и объединения;
+- не больше AI_MAX_CONCURRENCY запросов к модели одновременно, общий таймаут
+  (ожидание в очереди тоже считается);
+- ответ показывается по мере генерации: сообщение-заглушка редактируется;
+- генерация идёт отдельной задачей (spawn): хендлер не держит воркер
+  планировщика (chat_scheduler.py) и очередь чата, пока модель отвечает.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import time
+from collections import OrderedDict
+from typing import AsyncIterator, Awaitable, Dict, List, NamedTuple, Optional, Set
+
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import Message
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+import config
+import faq
+import metrics
+from database import Message as DBMessage
+
+logger = logging.getLogger(__name__)
+
+AI_REQUESTS = metrics.Counter("bot_ai_requests_total", "Ответы ИИ по источнику", ["source"])
+AI_LATENCY = metrics.Histogram("bot_ai_completion_seconds", "Время генерации ответа моделью")
+
+SYSTEM_PROMPT = (
+    "Ты — помощник детейлинг-студии «Инсайд Детейлинг». Отвечай коротко (до 5 предложений), "
+    "по-русски, дружелюбно. Не называй точных цен и сроков, которых нет в справке, — "
+    "предлагай записаться на бесплатный осмотр через главное меню бота. "
+    "Если вопрос не про студию и автомобили — вежливо верни разговор к услугам.\n\n"
+    f"Адрес: {config.STUDIO_ADDRESS}\n"
+    f"Часы работы: пн–пт {config.WEEKDAY_HOURS}, сб {config.SATURDAY_HOURS}, вс {config.SUNDAY_HOURS}"
+)
+
+
+# ==================== КЛИЕНТЫ LLM ====================
+
+class LLMClient:
+    """Интерфейс: потоковая генерация ответа по списку сообщений"""
+
+    async def stream(self, messages: List[Dict[str, str]]) -> AsyncIterator[str]:
+        raise NotImplementedError
+        yield  # pragma: no cover
+
+
+class OpenAIClient(LLMClient):
+    def __init__(self, api_key: str, model: str):
+        # openai тяжёлый — импортируем, только если ИИ-слой включён
+        from openai import AsyncOpenAI
+
+        self.client = AsyncOpenAI(api_key=api_key)
+        self.model = model
+
+    async def stream(self, messages: List[Dict[str, str]]) -> AsyncIterator[str]:
+        response = await self.client.chat.completions.create(
+            model=self.model,
+            messages=messages,
+            stream=True,
+            max_tokens=400,
+            temperature=0.3,
+        )
+        async for chunk in response:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+
+class FakeLLMClient(LLMClient):
+    """Локальный клиент для тестов: отдаёт заготовленный ответ кусками"""
+
+    def __init__(self, answer: str = "Хороший вопрос! Подскажем на осмотре — запишитесь через главное меню.", chunk_delay: float = 0.05, chunk_size: int = 12):
+        self.answer = answer
+        self.chunk_delay = chunk_delay
+        self.chunk_size = chunk_size
+        self.calls = 0
+
+    async def stream(self, messages: List[Dict[str, str]]) -> AsyncIterator[str]:
+        self.calls += 1
+        for i in range(0, len(self.answer), self.chunk_size):
+            await asyncio.sleep(self.chunk_delay)
+            yield self.answer[i:i + self.chunk_size]
+
+
+# ==================== КЕШ И ОБЪЕДИНЕНИЕ ЗАПРОСОВ ====================
+
+class TTLCache:
+    """LRU-кеш с временем жизни записей"""
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data: "OrderedDict[str, tuple]" = OrderedDict()
+
+    def get(self, key: str) -> Optional[str]:
+        item = self._data.get(key)
+        if item is None:
+            return None
+        value, expires_at = item
+        if expires_at < time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: str, value: str):
+        self._data[key] = (value, time.monotonic() + self.ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+
+class _Flight:
+    """Один запрос к модели, на частичные ответы которого подписаны все спросившие"""
+
+    def __init__(self):
+        self.chunks: List[str] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self._changed = asyncio.Event()
+
+    def push(self, chunk: str):
+        self.chunks.append(chunk)
+        self._notify()
+
+    def finish(self, error: BaseException = None):
+        self.done = True
+        self.error = error
+        self._notify()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def subscribe(self) -> AsyncIterator[str]:
+        """Весь текст, накопленный к текущему моменту, по мере роста"""
+        seen = 0
+        while True:
+            changed = self._changed
+            if len(self.chunks) > seen:
+                seen = len(self.chunks)
+                yield "".join(self.chunks)
+            if self.done:
+                if self.error:
+                    raise self.error
+                return
+            await changed.wait()
+
+
+class Prompt(NamedTuple):
+    messages: List[Dict[str, str]]
+    key: Optional[str]   # ключ кеша и объединения; None — ответ персональный (промпт с историей)
+
+
+def question_key(question: str, snippets: List[str]) -> str:
+    """Ключ общего ответа: нормализованный вопрос + справка, попавшая в промпт"""
+    raw = json.dumps([faq.normalize(question), snippets], ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+# ==================== СЕРВИС ОТВЕТОВ ====================
+
+class ReplyService:
+    def __init__(
+        self,
+        client: LLMClient,
+        max_concurrency: int = 4,
+        timeout: float = 30.0,
+        cache_size: int = 1000,
+        cache_ttl: float = 3600.0,
+        history_messages: int = 10,
+        edit_interval: float = 1.0,
+    ):
+        self.client = client
+        self.timeout = timeout
+        self.history_messages = history_messages
+        self.edit_interval = edit_interval
+        self.cache = TTLCache(cache_size, cache_ttl)
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._flights: Dict[str, _Flight] = {}
+        self._tasks: Set[asyncio.Task] = set()
+
+    def build_context(self, db: Session, user_id: int, question: str) -> Prompt:
+        """
+        Системный промпт + справка из FAQ + вопрос; клиент уже в диалоге —
+        ещё и его последние сообщения (тогда ответ не кешируется).
+        """
+        snippets = [
+            f"— {q}\n{a}" for score, q, a in faq.index.search(question, k=3) if score > 0.15
+        ]
+        system = SYSTEM_PROMPT
+        if snippets:
+            system += "\n\nСправка студии:\n" + "\n\n".join(snippets)
+
+        history = db.execute(
+            select(DBMessage.text, DBMessage.is_from_admin, DBMessage.message_type)
+            .where(DBMessage.user_id == user_id, DBMessage.text.isnot(None))
+            .order_by(DBMessage.created_at.desc())
+            .limit(self.history_messages)
+        ).all()
+
+        messages = [{"role": "system", "content": system}]
+        roles = ["assistant" if row.is_from_admin or row.message_type == "ai" else "user" for row in history]
+        if "assistant" not in roles:
+            # Диалога ещё не было — общий ответ, одинаковый для всех, кто так спросит
+            messages.append({"role": "user", "content": question})
+            return Prompt(messages, question_key(question, snippets))
+
+        for row, role in zip(reversed(history), reversed(roles)):
+            messages.append({"role": role, "content": row.text})
+        # Вопрос обычно уже сохранён в истории — не дублируем
+        if history[0].text != question:
+            messages.append({"role": "user", "content": question})
+        return Prompt(messages, None)
+
+    async def _run_flight(self, key: Optional[str], flight: _Flight, messages: List[Dict[str, str]]):
+        started = time.perf_counter()
+        # Ожидание свободного слота — тоже в счёт таймаута
+        deadline = time.monotonic() + self.timeout
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), self.timeout)
+            try:
+                iterator = self.client.stream(messages).__aiter__()
+                while True:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise asyncio.TimeoutError()
+                    try:
+                        chunk = await asyncio.wait_for(iterator.__anext__(), remaining)
+                    except StopAsyncIteration:
+                        break
+                    flight.push(chunk)
+            finally:
+                self._semaphore.release()
+
+            answer = "".join(flight.chunks).strip()
+            if answer and key is not None:
+                self.cache.set(key, answer)
+            flight.finish()
+            AI_LATENCY.observe(time.perf_counter() - started)
+        except Exception as e:
+            flight.finish(e)
+        except BaseException:
+            # Отмена (остановка бота): подписчики не должны ждать вечно, но и чужой CancelledError им ни к чему
+            flight.finish(RuntimeError("генерация ответа прервана"))
+            raise
+        finally:
+            if key is not None:
+                self._flights.pop(key, None)
+
+    async def answer_stream(self, prompt: Prompt) -> AsyncIterator[str]:
+        """Текст ответа по мере генерации (каждый раз — весь текст целиком)"""
+        key = prompt.key
+        if key is None:
+            AI_REQUESTS.inc("personal")
+            flight = _Flight()
+            self._track(asyncio.create_task(self._run_flight(None, flight, prompt.messages)))
+            async for text in flight.subscribe():
+                yield text
+            return
+
+        cached = self.cache.get(key)
+        if cached is not None:
+            AI_REQUESTS.inc("cache")
+            yield cached
+            return
+
+        flight = self._flights.get(key)
+        if flight is None:
+            AI_REQUESTS.inc("model")
+            flight = self._flights[key] = _Flight()
+            self._track(asyncio.create_task(self._run_flight(key, flight, prompt.messages)))
+        else:
+            AI_REQUESTS.inc("coalesced")
+
+        async for text in flight.subscribe():
+            yield text
+
+    def spawn(self, coro: Awaitable):
+        """Ответ — фоновой задачей, вне хендлера"""
+        self._track(asyncio.create_task(coro))
+
+    def _track(self, task: asyncio.Task):
+        # Ссылка на задачу, пока она идёт: иначе сборщик мусора может снять её посреди ответа
+        self._tasks.add(task)
+        task.add_done_callback(self._task_done)
+
+    def _task_done(self, task: asyncio.Task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception():
+            logger.error("Ответ ИИ упал: %s", task.exception(), exc_info=task.exception())
+
+    async def reply(self, message: Message, prompt: Prompt) -> Optional[str]:
+        """
+        Ответить клиенту, редактируя сообщение по мере генерации.
+
+        prompt — из build_context. Возвращает итоговый текст или None, если модель не ответила.
+        """
+        placeholder = None
+        shown = ""
+        last_edit = 0.0
+        text = ""
+
+        try:
+            async for text in self.answer_stream(prompt):
+                now = time.monotonic()
+                if placeholder is None:
+                    placeholder = await message.answer(text + " …")
+                    shown, last_edit = text, now
+                elif now - last_edit >= self.edit_interval and text != shown:
+                    await _safe_edit(placeholder, text + " …")
+                    shown, last_edit = text, now
+        except Exception as e:
+            logger.warning("ИИ не ответил: %s", e)
+            if placeholder is not None:
+                await _safe_edit(placeholder, text or "…")
+            return None
+
+        if not text:
+            return None
+
+        if placeholder is None:
+            await message.answer(text)
+        else:
+            await _safe_edit(placeholder, text)
+        return text
+
+
+async def _safe_edit(message: Message, text: str):
+    try:
+        await message.edit_text(text)
+    except TelegramBadRequest:
+        # "message is not modified" и подобное — не критично
+        pass
+
+
+replies: Optional[ReplyService] = None
+
+
+def setup(client: LLMClient):
+    """Включить ИИ-слой с заданным клиентом"""
+    global replies
+    replies = ReplyService(
+        client,
+        max_concurrency=config.AI_MAX_CONCURRENCY,
+        timeout=config.AI_TIMEOUT,
+        cache_size=config.AI_CACHE_SIZE,
+        cache_ttl=config.AI_CACHE_TTL,
+        history_messages=config.AI_HISTORY_MESSAGES,
+    )
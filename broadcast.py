@@ -0,0 +1,358 @@
+"""
+Рассылки по всем пользователям бота (/broadcast).
+
+- получатели читаются пачками по users.id (keyset, без OFFSET), следующая
+  пачка грузится, пока отправляется текущая;
+- отправка — BROADCAST_WORKERS одновременных запросов, общий темп не выше
+  BROADCAST_RATE в секунду; 429 (retry_after) ставит на паузу всех;
+- после каждой пачки прогресс (cursor, счётчики) пишется в broadcasts —
+  после рестарта рассылка продолжается с места остановки; повторно может
+  уйти не больше одной пачки;
+- заблокировавшие бота помечаются users.is_blocked и дальше не получают;
+- у админа одно сообщение с прогрессом и скоростью (доставлено/с).
+
+Несколько инстансов: рассылку шлёт тот, кто её арендовал (locked_by);
+аренда продлевается на каждом сохранении прогресса.
+"""
+import asyncio
+import logging
+import os
+import socket
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import List, Optional
+
+from aiogram.exceptions import (
+    TelegramBadRequest,
+    TelegramForbiddenError,
+    TelegramNetworkError,
+    TelegramRetryAfter,
+    TelegramServerError,
+)
+from sqlalchemy import and_, func, or_, select, update
+
+import cache
+import config
+import metrics
+from database import Broadcast, User
+from keyboards import get_broadcast_progress_buttons
+
+logger = logging.getLogger(__name__)
+
+BROADCAST_MESSAGES = metrics.Counter("bot_broadcast_messages_total", "Сообщения рассылок по результату", ["result"])
+BROADCAST_PAUSES = metrics.Counter("bot_broadcast_retry_after_total", "Паузы рассылки по 429 retry_after")
+
+
+def recipients_filter():
+    # user_id < 0 — клиенты из импорта (legacy_import.py), в Telegram им не написать
+    return and_(User.is_blocked.isnot(True), User.user_id > 0)
+
+
+def count_recipients(db) -> int:
+    return db.scalar(select(func.count()).select_from(User).where(recipients_filter()))
+
+
+class RateLimiter:
+    """Не чаще rate отправок в секунду (равномерно); pause() — общая пауза по retry_after"""
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate
+        self._next = 0.0
+        self._paused_until = 0.0
+
+    async def acquire(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            now = loop.time()
+            slot = max(now, self._next, self._paused_until)
+            self._next = slot + self.interval
+            if slot > now:
+                await asyncio.sleep(slot - now)
+            # Пока ждали слот, кто-то мог получить 429
+            if loop.time() >= self._paused_until:
+                return
+
+    def pause(self, seconds: float):
+        loop = asyncio.get_running_loop()
+        self._paused_until = max(self._paused_until, loop.time() + seconds)
+
+
+def format_progress(broadcast: Broadcast, rate: float = None) -> str:
+    titles = {"running": "идёт", "done": "завершена", "cancelled": "остановлена", "draft": "не запущена"}
+    text = f"📣 Рассылка #{broadcast.id}: {titles.get(broadcast.status, broadcast.status)}\n\n"
+    text += f"Отправлено: {broadcast.sent} из ~{broadcast.total}\n"
+    text += f"Заблокировали бота: {broadcast.blocked}\n"
+    text += f"Не доставлено: {broadcast.failed}"
+    if rate:
+        text += f"\nСкорость: {rate:.1f} сообщ./с"
+    return text
+
+
+class BroadcastRunner:
+    def __init__(
+        self,
+        rate: float = 25.0,
+        workers: int = 10,
+        batch_size: int = 500,
+        lease: float = 120.0,
+        poll_interval: float = 30.0,
+        progress_interval: float = 5.0,
+        max_attempts: int = 3,
+    ):
+        self.rate = rate
+        self.workers = workers
+        self.batch_size = batch_size
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.progress_interval = progress_interval
+        self.max_attempts = max_attempts
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+        self.limiter = RateLimiter(rate)
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    # ---------- БД (в потоке) ----------
+
+    def _claim(self, session_factory) -> Optional[int]:
+        """Арендовать запущенную рассылку, которую никто не шлёт"""
+        now = datetime.utcnow()
+        free = or_(Broadcast.locked_until.is_(None), Broadcast.locked_until < now)
+        db = session_factory()
+        try:
+            for broadcast_id in db.scalars(
+                select(Broadcast.id).where(Broadcast.status == "running", free).order_by(Broadcast.id)
+            ).all():
+                claimed = db.execute(
+                    update(Broadcast)
+                    .where(Broadcast.id == broadcast_id, Broadcast.status == "running", free)
+                    .values(locked_by=self.worker_id, locked_until=now + timedelta(seconds=self.lease))
+                ).rowcount
+                db.commit()
+                if claimed:
+                    return broadcast_id
+            return None
+        finally:
+            db.close()
+
+    def _load(self, session_factory, broadcast_id: int) -> Broadcast:
+        db = session_factory()
+        try:
+            broadcast = db.get(Broadcast, broadcast_id)
+            db.expunge(broadcast)
+            return broadcast
+        finally:
+            db.close()
+
+    def _fetch_batch(self, session_factory, cursor: int) -> List[tuple]:
+        """Следующие получатели после cursor: [(users.id, telegram user_id)]"""
+        db = session_factory()
+        try:
+            return db.execute(
+                select(User.id, User.user_id)
+                .where(User.id > cursor, recipients_filter())
+                .order_by(User.id)
+                .limit(self.batch_size)
+            ).all()
+        finally:
+            db.close()
+
+    def _checkpoint(self, session_factory, broadcast: Broadcast, cursor: int, counts: dict, blocked_users: List[int]) -> bool:
+        """
+        Сохранить прогресс пачки; False — рассылку остановили или аренду
+        перехватил другой инстанс, продолжать нельзя.
+        """
+        now = datetime.utcnow()
+        db = session_factory()
+        try:
+            if blocked_users:
+                db.execute(update(User).where(User.user_id.in_(blocked_users)).values(is_blocked=True))
+            saved = db.execute(
+                update(Broadcast)
+                .where(Broadcast.id == broadcast.id, Broadcast.status == "running", Broadcast.locked_by == self.worker_id)
+                .values(
+                    cursor=cursor,
+                    sent=Broadcast.sent + counts["sent"],
+                    blocked=Broadcast.blocked + counts["blocked"],
+                    failed=Broadcast.failed + counts["failed"],
+                    locked_until=now + timedelta(seconds=self.lease),
+                )
+            ).rowcount
+            db.commit()
+        finally:
+            db.close()
+
+        if saved:
+            broadcast.cursor = cursor
+            broadcast.sent += counts["sent"]
+            broadcast.blocked += counts["blocked"]
+            broadcast.failed += counts["failed"]
+        return bool(saved)
+
+    def _finish(self, session_factory, broadcast: Broadcast):
+        db = session_factory()
+        try:
+            db.execute(
+                update(Broadcast)
+                .where(Broadcast.id == broadcast.id, Broadcast.status == "running", Broadcast.locked_by == self.worker_id)
+                .values(status="done", finished_at=datetime.utcnow(), locked_by=None, locked_until=None)
+            )
+            db.commit()
+        finally:
+            db.close()
+        broadcast.status = "done"
+
+    # ---------- Отправка ----------
+
+    async def _deliver(self, bot, broadcast: Broadcast, chat_id: int) -> str:
+        for attempt in range(self.max_attempts):
+            await self.limiter.acquire()
+            try:
+                if broadcast.source_message_id:
+                    await bot.copy_message(chat_id, broadcast.source_chat_id, broadcast.source_message_id)
+                else:
+                    await bot.send_message(chat_id, broadcast.text)
+                return "sent"
+            except TelegramRetryAfter as e:
+                BROADCAST_PAUSES.inc()
+                self.limiter.pause(e.retry_after)
+            except TelegramForbiddenError:
+                return "blocked"  # заблокировал бота или удалил аккаунт
+            except TelegramBadRequest as e:
+                logger.info("Рассылка #%s: %s не доставлено: %s", broadcast.id, chat_id, e)
+                return "failed"
+            except (TelegramNetworkError, TelegramServerError) as e:
+                logger.warning("Рассылка #%s: ошибка Bot API, повтор: %s", broadcast.id, e)
+                await asyncio.sleep(2 ** attempt)
+        return "failed"
+
+    async def _send_batch(self, bot, broadcast: Broadcast, batch: List[tuple]) -> tuple:
+        counts = {"sent": 0, "blocked": 0, "failed": 0}
+        blocked_users = []
+        queue: asyncio.Queue = asyncio.Queue()
+        for _, chat_id in batch:
+            queue.put_nowait(chat_id)
+
+        async def worker():
+            while not queue.empty():
+                chat_id = queue.get_nowait()
+                result = await self._deliver(bot, broadcast, chat_id)
+                counts[result] += 1
+                BROADCAST_MESSAGES.inc(result)
+                if result == "blocked":
+                    blocked_users.append(chat_id)
+
+        await asyncio.gather(*(worker() for _ in range(min(self.workers, len(batch)))))
+        return counts, blocked_users
+
+    async def _report(self, bot, broadcast: Broadcast, rate: float = None):
+        if not broadcast.progress_chat_id:
+            return
+        try:
+            await bot.edit_message_text(
+                chat_id=broadcast.progress_chat_id,
+                message_id=broadcast.progress_message_id,
+                text=format_progress(broadcast, rate),
+                reply_markup=get_broadcast_progress_buttons(broadcast.id) if broadcast.status == "running" else None,
+            )
+        except TelegramBadRequest as e:
+            if "not modified" not in str(e):
+                logger.info("Прогресс рассылки #%s не обновлён: %s", broadcast.id, e)
+
+    async def run_broadcast(self, bot, session_factory, broadcast_id: int):
+        """Отправить арендованную рассылку с сохранённого места до конца (или до остановки)"""
+        broadcast = await asyncio.to_thread(self._load, session_factory, broadcast_id)
+        logger.info("Рассылка #%s: старт с users.id > %s", broadcast.id, broadcast.cursor)
+
+        started = time.monotonic()
+        sent_before = broadcast.sent
+        reported_at = 0.0
+        rate = None
+
+        batch = await asyncio.to_thread(self._fetch_batch, session_factory, broadcast.cursor)
+        while batch:
+            prefetch = asyncio.create_task(asyncio.to_thread(self._fetch_batch, session_factory, batch[-1][0]))
+            try:
+                counts, blocked_users = await self._send_batch(bot, broadcast, batch)
+                alive = await asyncio.to_thread(
+                    self._checkpoint, session_factory, broadcast, batch[-1][0], counts, blocked_users
+                )
+            except BaseException:
+                prefetch.cancel()
+                raise
+            cache.hot.forget_users(blocked_users)
+            if not alive:
+                prefetch.cancel()
+                logger.info("Рассылка #%s остановлена", broadcast.id)
+                broadcast = await asyncio.to_thread(self._load, session_factory, broadcast_id)
+                await self._report(bot, broadcast)
+                return
+
+            rate = (broadcast.sent - sent_before) / max(time.monotonic() - started, 1e-6)
+            if time.monotonic() - reported_at >= self.progress_interval:
+                reported_at = time.monotonic()
+                await self._report(bot, broadcast, rate)
+
+            batch = await prefetch
+
+        await asyncio.to_thread(self._finish, session_factory, broadcast)
+        logger.info(
+            "Рассылка #%s завершена", broadcast.id,
+            extra={"sent": broadcast.sent, "blocked": broadcast.blocked, "failed": broadcast.failed, "rate": rate},
+        )
+        await self._report(bot, broadcast, rate)
+
+    # ---------- Фоновый цикл ----------
+
+    def wake(self):
+        """Запустили рассылку — не ждать poll_interval"""
+        self._wake.set()
+
+    async def run(self, bot, session_factory):
+        while True:
+            try:
+                broadcast_id = await asyncio.to_thread(self._claim, session_factory)
+                if broadcast_id is not None:
+                    await self.run_broadcast(bot, session_factory, broadcast_id)
+                    continue
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Ошибка рассылки: %s", e)
+
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self, bot, session_factory):
+        """Фоновая задача: подхватывает запущенные (и прерванные рестартом) рассылки"""
+        if self._task is None:
+            self._task = asyncio.create_task(self.run(bot, session_factory))
+
+    async def stop(self, session_factory):
+        """Остановить отправку и отпустить аренду — после рестарта продолжит любой инстанс"""
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+        db = session_factory()
+        try:
+            db.execute(
+                update(Broadcast)
+                .where(Broadcast.status == "running", Broadcast.locked_by == self.worker_id)
+                .values(locked_by=None, locked_until=None)
+            )
+            db.commit()
+        finally:
+            db.close()
+
+
+runner = BroadcastRunner(config.BROADCAST_RATE, config.BROADCAST_WORKERS, config.BROADCAST_BATCH)
@@ -0,0 +1,174 @@
+"""
+Горячие данные процесса и их прогрев после рестарта.
+
+Без прогрева первое сообщение каждого активного клиента после рестарта
+идёт в БД «с нуля»: пользователь, активная заявка, а шаг воронки и так
+потерян (MemoryStorage пуст) — клиент застревает посреди заявки.
+
+warm() в фоне, не задерживая polling, несколькими запросами на всех:
+- заявки NEW/IN_WORK (и заявки открытых диалогов с админом) → кэш
+  «клиент → активная заявка» и «пользователь уже есть в БД»;
+- последний шаг воронки каждого клиента за сутки (funnel_events) →
+  состояние FSM и данные воронки из заявки, как было до рестарта;
+  заодно телеметрия и напоминания продолжают с этого шага.
+
+Пока прогрев идёт, хендлеры работают как раньше — через БД;
+hot.ready — сигнал готовности (и лог с числом загруженного).
+"""
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Optional
+
+from aiogram.fsm.storage.base import BaseStorage, StorageKey
+from sqlalchemy import func, or_, select
+
+import funnel_state
+import metrics
+import telemetry
+from database import FunnelEvent, Lead, LeadStatus, User
+from states import FAQFlow, MainMenu, PPFFlow
+
+logger = logging.getLogger(__name__)
+
+WARMUP_READY = metrics.Gauge("bot_warmup_ready", "Прогрев кэшей после старта завершён (1)")
+
+ACTIVE_STATUSES = (LeadStatus.NEW, LeadStatus.IN_WORK)
+
+# Шаги, которые восстанавливаются после рестарта
+RESTORABLE_STEPS = {state.state for group in (MainMenu, PPFFlow, FAQFlow) for state in group.__states__}
+PPF_STEPS = {state.state for state in PPFFlow.__states__}
+
+
+class HotCache:
+    def __init__(self, size: int = 100000, user_ttl: float = 900.0, restore_window: timedelta = timedelta(hours=24)):
+        self.size = size
+        # Пользователь мог заблокировать бота на другом инстансе (рассылка) — через user_ttl проверим снова
+        self.user_ttl = user_ttl
+        self.restore_window = restore_window
+
+        self.users: "OrderedDict[int, float]" = OrderedDict()         # user_id → до когда верить
+        self.active_leads: "OrderedDict[int, int]" = OrderedDict()    # user_id → id активной заявки
+        self.ready = asyncio.Event()
+        self.stats: dict = {}
+
+    @staticmethod
+    def _put(cache: OrderedDict, key, value, size: int):
+        cache[key] = value
+        cache.move_to_end(key)
+        if len(cache) > size:
+            cache.popitem(last=False)
+
+    # ---------- Пользователи ----------
+
+    def user_known(self, user_id: int) -> bool:
+        """Пользователь есть в БД и не заблокировал бота (по данным не старше user_ttl)"""
+        until = self.users.get(user_id)
+        return until is not None and until > time.monotonic()
+
+    def remember_user(self, user_id: int):
+        self._put(self.users, user_id, time.monotonic() + self.user_ttl, self.size)
+
+    def forget_users(self, user_ids):
+        for user_id in user_ids:
+            self.users.pop(user_id, None)
+
+    # ---------- Активные заявки ----------
+
+    def active_lead(self, user_id: int) -> Optional[int]:
+        """id активной заявки клиента — подсказка: статус проверяет вызывающий"""
+        return self.active_leads.get(user_id)
+
+    def remember_lead(self, user_id: int, lead_id: int):
+        self._put(self.active_leads, user_id, lead_id, self.size)
+
+    # ---------- Прогрев ----------
+
+    def _load(self, session_factory) -> tuple:
+        since = datetime.utcnow() - self.restore_window
+        db = session_factory()
+        try:
+            # Активные заявки и их пользователи; заявка открытого диалога — поверх (её ждёт админ)
+            dialog_lead = select(User.admin_dialog_lead_id).where(
+                User.in_admin_dialog.is_(True), User.admin_dialog_lead_id.isnot(None)
+            )
+            leads = db.execute(
+                select(Lead, User.is_blocked)
+                .outerjoin(User, User.user_id == Lead.user_id)
+                .where(or_(Lead.status.in_(ACTIVE_STATUSES), Lead.id.in_(dialog_lead)))
+                .order_by(Lead.created_at)
+            ).all()
+            dialog_leads = set(db.scalars(dialog_lead))
+
+            # Последнее событие воронки каждого клиента; enter — клиент так и остался на шаге
+            latest = (
+                select(func.max(FunnelEvent.id))
+                .where(FunnelEvent.created_at >= since)
+                .group_by(FunnelEvent.user_id)
+            )
+            steps = db.execute(
+                select(FunnelEvent.user_id, FunnelEvent.step, FunnelEvent.lead_id, FunnelEvent.created_at)
+                .where(FunnelEvent.id.in_(latest), FunnelEvent.event == "enter")
+            ).all()
+
+            db.expunge_all()
+            return leads, dialog_leads, steps
+        finally:
+            db.close()
+
+    async def warm(self, session_factory, storage: BaseStorage, bot_id: int):
+        started = time.perf_counter()
+        leads, dialog_leads, steps = await asyncio.to_thread(self._load, session_factory)
+
+        leads_by_id = {}
+        for lead, is_blocked in leads:
+            leads_by_id[lead.id] = lead
+            # По порядку created_at: у клиента остаётся последняя, диалоговая — приоритетнее
+            if lead.id in dialog_leads or self.active_leads.get(lead.user_id) not in dialog_leads:
+                self.remember_lead(lead.user_id, lead.id)
+            if is_blocked is False:
+                self.remember_user(lead.user_id)
+
+        restored = 0
+        for user_id, step, lead_id, entered_at in steps:
+            if step not in RESTORABLE_STEPS:
+                continue
+            key = StorageKey(bot_id=bot_id, chat_id=user_id, user_id=user_id)
+            # Клиент уже написал после старта — его состояние свежее
+            if await storage.get_state(key) is not None:
+                continue
+
+            await storage.set_state(key, step)
+            # Не на каждом шаге событие несёт lead_id — тогда активная заявка клиента
+            lead = leads_by_id.get(lead_id or self.active_leads.get(user_id))
+            if lead is not None and step in PPF_STEPS:
+                funnel = funnel_state.FunnelData(
+                    service=lead.service,
+                    service_variant=lead.service_variant,
+                    lead_id=lead.id,
+                    car_brand=lead.car_brand,
+                    car_model=lead.car_model,
+                    car_year=lead.car_year,
+                    preferred_time=lead.preferred_time,
+                    phone=lead.phone,
+                    zones=lead.goal,
+                    is_urgent=bool(lead.is_urgent),
+                )
+                await storage.set_data(key, {funnel_state.KEY: funnel.pack()})
+            telemetry.funnel.restore(user_id, step, lead.id if lead else lead_id, entered_at)
+            restored += 1
+
+        self.stats = {
+            "active_leads": len(self.active_leads),
+            "users": len(self.users),
+            "restored_states": restored,
+            "duration_ms": round((time.perf_counter() - started) * 1000),
+        }
+        self.ready.set()
+        WARMUP_READY.set(1)
+        logger.info("Кэши прогреты", extra=self.stats)
+
+
+hot = HotCache()
@@ -0,0 +1,250 @@
+"""
+Карточки лидов для админа.
+
+Одна функция отрисовки (текст кешируется по версии лида) и реестр
+отправленных карточек lead_cards: при смене статуса карточки редактируются
+на месте, а списки /leads не дублируют карточки, которые уже есть в чате.
+"""
+import hashlib
+import json
+import logging
+from collections import OrderedDict
+from typing import Iterable, List, Optional, Tuple
+
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import InlineKeyboardMarkup, Message
+from sqlalchemy.orm import Session
+
+import clients
+import config
+from database import Lead, LeadCard, LeadStatus, User
+from keyboards import get_admin_dialog_buttons, get_lead_card_buttons
+
+logger = logging.getLogger(__name__)
+
+CACHE_SIZE = 1024
+
+SERVICE_NAMES = {
+    "ppf": "Оклейка плёнкой (PPF)",
+    "color_ppf": "Цветная полиуретановая плёнка",
+    "vinyl": "Винил (смена цвета)",
+    "polish": "Реставрация ЛКП",
+    "ceramic": "Керамика",
+    "wash": "Мойка",
+    "tint": "Тонировка",
+    "cleaning": "Химчистка"
+}
+
+STATUS_FOOTERS = {
+    LeadStatus.IN_WORK: "✅ Взято в работу",
+    LeadStatus.COMPLETED: "🏁 Выполнена",
+    LeadStatus.REJECTED: "❌ Отказ",
+}
+
+_cache: "OrderedDict[tuple, str]" = OrderedDict()
+
+
+# ==================== ОТРИСОВКА ====================
+
+def _dialog_open(lead: Lead, user: User) -> bool:
+    return bool(user.in_admin_dialog and user.admin_dialog_lead_id == lead.id)
+
+
+def _version(lead: Lead, user: User, previous: tuple) -> tuple:
+    """Всё, от чего зависит текст карточки"""
+    return (
+        lead.id, lead.updated_at, lead.status, lead.is_red_flag, _dialog_open(lead, user),
+        user.first_name, user.username, previous,
+    )
+
+
+def _render_text(lead: Lead, user: User, previous: tuple) -> str:
+    header = "🚨 ЕДЕТ СЕЙЧАС!" if lead.is_urgent else "🆕 Новая заявка"
+    service_name = SERVICE_NAMES.get(lead.service, lead.service or "Не указана")
+
+    card_text = f"{header}\n\n"
+    if lead.is_red_flag:
+        card_text += "🚩 Красный флаг — проверьте переписку\n\n"
+    card_text += f"👤 Клиент: {user.first_name or 'Не указано'}"
+
+    if user.username:
+        card_text += f" (@{user.username})"
+
+    card_text += f"\n\n📋 Услуга: {service_name}"
+
+    if lead.service_variant:
+        card_text += f"\nВариант: {lead.service_variant}"
+
+    # Авто
+    if lead.car_brand:
+        card_text += f"\n\n🚗 Авто: {lead.car_brand}"
+        if lead.car_model:
+            card_text += f" {lead.car_model}"
+        if lead.car_year:
+            card_text += f" ({lead.car_year} г.)"
+
+    # Когда удобно
+    if lead.preferred_time:
+        card_text += f"\n\n⏰ Когда удобно: {lead.preferred_time}"
+
+    # Телефон
+    if lead.phone:
+        card_text += f"\n\n📞 Телефон: {lead.phone}"
+
+    # Цель/комментарий
+    if lead.goal:
+        card_text += f"\n\n💬 Комментарий: {lead.goal}"
+
+    # Тот же телефон в прошлых заявках
+    if previous:
+        card_text += "\n\n🔁 Уже обращался: " + ", ".join(f"#{lead_id}" for lead_id, _ in previous)
+        if any(other_account for _, other_account in previous):
+            card_text += " (в т.ч. с другого аккаунта)"
+
+    # Статус
+    footer = STATUS_FOOTERS.get(lead.status)
+    if footer:
+        card_text += f"\n\n{footer}"
+    if _dialog_open(lead, user):
+        card_text += "\n\n💬 Диалог открыт"
+
+    return card_text
+
+
+def render(lead: Lead, user: User, previous: tuple = ()) -> Tuple[str, Optional[InlineKeyboardMarkup]]:
+    """
+    Текст и кнопки карточки (текст — из кеша, пока лид не изменился).
+
+    previous — прошлые заявки клиента (clients.previous_leads).
+    """
+    key = _version(lead, user, previous)
+    text = _cache.get(key)
+    if text is None:
+        text = _cache[key] = _render_text(lead, user, previous)
+        if len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    else:
+        _cache.move_to_end(key)
+
+    if _dialog_open(lead, user):
+        markup = get_admin_dialog_buttons(lead.id)
+    elif lead.status == LeadStatus.NEW:
+        markup = get_lead_card_buttons(lead.id)
+    elif lead.status == LeadStatus.IN_WORK:
+        markup = get_lead_card_buttons(lead.id, in_work=True)
+    else:
+        markup = None
+
+    return text, markup
+
+
+def _fingerprint(text: str, markup: Optional[InlineKeyboardMarkup]) -> str:
+    payload = text + (json.dumps(markup.model_dump(exclude_none=True), sort_keys=True) if markup else "")
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()[:16]
+
+
+# ==================== ОТПРАВКА И ОБНОВЛЕНИЕ ====================
+
+async def send(bot, db: Session, lead: Lead, user: User, chat_id: int) -> LeadCard:
+    """Отправить карточку в чат и запомнить её"""
+    text, markup = render(lead, user, clients.previous_leads(db, [lead]).get(lead.id, ()))
+    sent = await bot.send_message(chat_id=chat_id, text=text, reply_markup=markup)
+
+    card = LeadCard(
+        lead_id=lead.id,
+        chat_id=chat_id,
+        message_id=sent.message_id,
+        rendered_hash=_fingerprint(text, markup),
+    )
+    db.add(card)
+    db.commit()
+    return card
+
+
+async def send_to_admins(bot, db: Session, lead: Lead, user: User):
+    """Новая заявка: карточка админу, срочная — ещё и владельцу"""
+    await send(bot, db, lead, user, config.ADMIN_CHAT_ID)
+
+    if lead.is_urgent and config.OWNER_CHAT_ID != config.ADMIN_CHAT_ID:
+        await send(bot, db, lead, user, config.OWNER_CHAT_ID)
+
+
+async def _edit(bot, db: Session, card: LeadCard, text: str, markup, fingerprint: str) -> bool:
+    """Отредактировать одну карточку; пропавшие из чата убираем из реестра (False)"""
+    if card.rendered_hash == fingerprint:
+        return True
+
+    try:
+        await bot.edit_message_text(
+            chat_id=card.chat_id,
+            message_id=card.message_id,
+            text=text,
+            reply_markup=markup,
+        )
+    except TelegramBadRequest as e:
+        if "not modified" not in str(e):
+            logger.info("Карточка %s в чате %s недоступна, убираем: %s", card.message_id, card.chat_id, e)
+            db.delete(card)
+            return False
+
+    card.rendered_hash = fingerprint
+    return True
+
+
+async def refresh(bot, db: Session, lead: Lead, user: User, clicked: Message = None):
+    """
+    Обновить все отправленные карточки лида.
+
+    clicked — карточка, под которой нажали кнопку: если её нет в реестре
+    (отправлена до его появления), регистрируем и обновляем вместе с остальными.
+    """
+    text, markup = render(lead, user, clients.previous_leads(db, [lead]).get(lead.id, ()))
+    fingerprint = _fingerprint(text, markup)
+
+    cards = db.query(LeadCard).filter(LeadCard.lead_id == lead.id).all()
+
+    if clicked and not any(c.chat_id == clicked.chat.id and c.message_id == clicked.message_id for c in cards):
+        card = LeadCard(lead_id=lead.id, chat_id=clicked.chat.id, message_id=clicked.message_id)
+        db.add(card)
+        db.flush()
+        cards.append(card)
+
+    for card in cards:
+        await _edit(bot, db, card, text, markup, fingerprint)
+
+    db.commit()
+
+
+async def show(bot, db: Session, leads: Iterable[Tuple[Lead, User]], chat_id: int) -> List[int]:
+    """
+    Показать карточки в чате: новые отправляются, уже отправленные сюда
+    только обновляются на месте (если устарели).
+
+    Возвращает id лидов, чьи карточки уже были в чате.
+    """
+    leads = list(leads)
+    existing = {
+        card.lead_id: card
+        for card in db.query(LeadCard).filter(
+            LeadCard.chat_id == chat_id,
+            LeadCard.lead_id.in_([lead.id for lead, _ in leads]),
+        ).order_by(LeadCard.id)
+    }
+
+    previous = clients.previous_leads(db, [lead for lead, _ in leads])
+
+    already_shown = []
+    for lead, user in leads:
+        card = existing.get(lead.id)
+        if card is None:
+            await send(bot, db, lead, user, chat_id)
+            continue
+
+        text, markup = render(lead, user, previous.get(lead.id, ()))
+        if await _edit(bot, db, card, text, markup, _fingerprint(text, markup)):
+            already_shown.append(lead.id)
+        else:
+            await send(bot, db, lead, user, chat_id)
+
+    db.commit()
+    return already_shown
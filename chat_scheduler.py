@@ -0,0 +1,100 @@
+"""
+Планировщик апдейтов: внутри одного чата — строго по очереди,
+разные чаты — параллельно, но не больше N хендлеров одновременно.
+
+Встраивается в aiogram как events_isolation диспетчера: FSM-middleware
+берёт лок до чтения состояния, поэтому второй апдейт того же чата видит
+состояние уже после первого (двойной тап не создаёт второй Lead).
+
+Воркер занят, пока идёт хендлер, поэтому долгий I/O (ответ ИИ до AI_TIMEOUT)
+хендлеры выносят в отдельную задачу (ai.ReplyService.spawn) — иначе
+несколько таких вопросов разом останавливают все остальные чаты.
+"""
+import asyncio
+from contextlib import asynccontextmanager
+from typing import AsyncGenerator, Dict, Hashable
+
+from aiogram.fsm.storage.base import BaseEventIsolation, StorageKey
+
+import metrics
+
+CHAT_QUEUE_DEPTH = metrics.Histogram(
+    "bot_chat_queue_depth",
+    "Сколько апдейтов этого чата уже ждали или выполнялись, когда пришёл новый",
+    buckets=metrics.COUNT_BUCKETS,
+)
+WORKER_WAIT = metrics.Histogram("bot_worker_wait_seconds", "Ожидание свободного воркера")
+
+
+class _ChatSlot:
+    __slots__ = ("lock", "pending")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.pending = 0  # ждут лок + выполняется
+
+
+class ChatScheduler(BaseEventIsolation):
+    """Keyed-лок по чату + общий пул воркеров"""
+
+    def __init__(self, workers: int = 10):
+        self.workers = workers
+        self._slots: Dict[Hashable, _ChatSlot] = {}
+        self._semaphore = asyncio.Semaphore(workers)
+        self.busy = 0
+
+    @staticmethod
+    def _chat_key(key: StorageKey) -> Hashable:
+        # Стратегия FSM может включать user_id/thread_id — сериализуем весь чат
+        return key.bot_id, key.chat_id
+
+    @property
+    def active_chats(self) -> int:
+        return len(self._slots)
+
+    @property
+    def waiting(self) -> int:
+        return sum(slot.pending for slot in self._slots.values()) - self.busy
+
+    @asynccontextmanager
+    async def lock(self, key: StorageKey) -> AsyncGenerator[None, None]:
+        chat_key = self._chat_key(key)
+        slot = self._slots.get(chat_key)
+        if slot is None:
+            slot = self._slots[chat_key] = _ChatSlot()
+
+        CHAT_QUEUE_DEPTH.observe(slot.pending)
+        slot.pending += 1
+
+        try:
+            # asyncio.Lock будит ожидающих в порядке FIFO — порядок апдейтов сохраняется
+            async with slot.lock:
+                loop = asyncio.get_running_loop()
+                wait_started = loop.time()
+                async with self._semaphore:
+                    WORKER_WAIT.observe(loop.time() - wait_started)
+                    self.busy += 1
+                    try:
+                        yield
+                    finally:
+                        self.busy -= 1
+        finally:
+            slot.pending -= 1
+            # Пустые слоты удаляем, чтобы словарь не рос с числом клиентов
+            if slot.pending == 0 and self._slots.get(chat_key) is slot:
+                del self._slots[chat_key]
+
+    async def close(self) -> None:
+        self._slots.clear()
+
+
+ACTIVE_CHATS = metrics.Gauge("bot_scheduler_active_chats", "Чаты с апдейтами в работе или в очереди")
+WAITING_UPDATES = metrics.Gauge("bot_scheduler_waiting_updates", "Апдейты, ждущие своей очереди в чате или воркера")
+BUSY_WORKERS = metrics.Gauge("bot_scheduler_busy_workers", "Занятые воркеры")
+
+
+def register_metrics(scheduler: ChatScheduler):
+    """Привязать gauge'и к планировщику диспетчера"""
+    ACTIVE_CHATS.set_function(lambda: scheduler.active_chats)
+    WAITING_UPDATES.set_function(lambda: scheduler.waiting)
+    BUSY_WORKERS.set_function(lambda: scheduler.busy)
@@ -0,0 +1,214 @@
+"""
+Клиенты по телефону: один номер — один клиент, сколько бы заявок и
+Telegram-аккаунтов у него ни было.
+
+Телефон хранится в leads нормализованным (+7XXXXXXXXXX, parser.parse_phone);
+ключ клиента — sha256 от него (уникальный индекс clients.phone_hash).
+Когда у заявки появляется телефон, она сразу получает client_id: поиск
+клиента — словарь в памяти, при промахе — один запрос по индексу.
+В словарь клиент попадает только после commit сессии (after_commit):
+при откате транзакции созданного в ней клиента нет, и id в кеше был бы чужим.
+В карточке админа повторное обращение видно по прошлым заявкам клиента.
+
+Заявки, созданные до появления clients, связывает пакетный проход:
+
+    python clients.py [--batch-size 5000]
+"""
+import argparse
+import hashlib
+import logging
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import event, func, select, update
+from sqlalchemy.orm import Session
+
+import metrics
+import parser
+from database import Client, Lead, insert_ignore
+
+logger = logging.getLogger(__name__)
+
+CLIENT_LINKS = metrics.Counter("bot_client_links_total", "Заявки, связанные с клиентом по телефону", ["source"])
+
+CACHE_SIZE = 100000
+PREVIOUS_LIMIT = 5
+
+_cache: "OrderedDict[str, int]" = OrderedDict()
+# Найденные в ещё не закоммиченной транзакции: session.info[_PENDING] = {key: client_id}
+_PENDING = "clients_pending"
+
+
+def phone_hash(phone: str) -> str:
+    return hashlib.sha256(phone.encode("utf-8")).hexdigest()
+
+
+def _remember(key: str, client_id: int):
+    _cache[key] = client_id
+    if len(_cache) > CACHE_SIZE:
+        _cache.popitem(last=False)
+
+
+@event.listens_for(Session, "after_commit")
+def _commit_pending(session: Session):
+    for key, client_id in session.info.pop(_PENDING, {}).items():
+        _remember(key, client_id)
+
+
+@event.listens_for(Session, "after_rollback")
+def _drop_pending(session: Session):
+    session.info.pop(_PENDING, None)
+
+
+def _resolve(db: Session, keys: Iterable[str]) -> Dict[str, int]:
+    """client_id по хешам телефонов; недостающих клиентов создаёт"""
+    keys = set(keys)
+    pending = db.info.setdefault(_PENDING, {})
+    found = {key: _cache[key] for key in keys if key in _cache}
+    found.update((key, pending[key]) for key in keys - found.keys() if key in pending)
+    missing = keys - found.keys()
+    if missing:
+        insert_ignore(db, Client, [{"phone_hash": key} for key in missing])
+        for client_id, key in db.execute(select(Client.id, Client.phone_hash).where(Client.phone_hash.in_(missing))):
+            found[key] = pending[key] = client_id
+    return found
+
+
+def client_ids(db: Session, phones: Iterable[str]) -> Dict[str, int]:
+    """client_id по нормализованным телефонам, недостающих клиентов создаёт (без commit)"""
+    keys = {phone: phone_hash(phone) for phone in set(phones)}
+    resolved = _resolve(db, keys.values())
+    return {phone: resolved[key] for phone, key in keys.items()}
+
+
+# ==================== ПРИ ЗАПИСИ ТЕЛЕФОНА ====================
+
+def link_lead(db: Session, lead: Lead) -> Optional[int]:
+    """Привязать заявку к клиенту по её телефону (без commit — его делает вызывающий)"""
+    if not lead.phone:
+        return None
+
+    key = phone_hash(lead.phone)
+    source = "cache" if key in _cache else "db"
+    client_id = _resolve(db, [key])[key]
+    if lead.client_id != client_id:
+        CLIENT_LINKS.inc(source)
+        lead.client_id = client_id
+    return client_id
+
+
+def previous_leads(db: Session, leads: List[Lead]) -> Dict[int, Tuple[Tuple[int, bool], ...]]:
+    """
+    Прошлые заявки того же клиента для карточек: {lead.id: ((id, с другого аккаунта), ...)}.
+
+    Один запрос на весь список.
+    """
+    client_ids = {lead.client_id for lead in leads if lead.client_id}
+    if not client_ids:
+        return {}
+
+    by_client: Dict[int, list] = {}
+    rows = db.query(Lead.id, Lead.client_id, Lead.user_id).filter(
+        Lead.client_id.in_(client_ids)
+    ).order_by(Lead.id.desc())
+    for lead_id, client_id, user_id in rows:
+        by_client.setdefault(client_id, []).append((lead_id, user_id))
+
+    result = {}
+    for lead in leads:
+        earlier = [
+            (lead_id, user_id != lead.user_id)
+            for lead_id, user_id in by_client.get(lead.client_id, ())
+            if lead_id < lead.id
+        ]
+        if earlier:
+            result[lead.id] = tuple(earlier[:PREVIOUS_LIMIT])
+    return result
+
+
+# ==================== ПАКЕТНЫЙ ПРОХОД ПО СТАРЫМ ЗАЯВКАМ ====================
+
+def link_existing(db: Session, batch_size: int = 5000, progress=print) -> dict:
+    """
+    Связать с клиентами все заявки с телефоном и без client_id.
+
+    Идёт по id (keyset), пачка — три запроса: заявки, клиенты, UPDATE.
+    Можно прерывать и запускать снова — продолжит с непривязанных.
+    """
+    stats = {"leads": 0, "linked": 0, "invalid": 0}
+    last_id = 0
+    started = time.monotonic()
+
+    while True:
+        rows = db.execute(
+            select(Lead.id, Lead.phone)
+            .where(Lead.id > last_id, Lead.phone.isnot(None), Lead.client_id.is_(None))
+            .order_by(Lead.id)
+            .limit(batch_size)
+        ).all()
+        if not rows:
+            break
+        last_id = rows[-1].id
+        stats["leads"] += len(rows)
+
+        keys = {}
+        for lead_id, phone in rows:
+            normalized = parser.parse_phone(phone)
+            if normalized:
+                keys[lead_id] = phone_hash(normalized)
+            else:
+                stats["invalid"] += 1
+
+        client_ids = _resolve(db, keys.values())
+        if keys:
+            db.execute(update(Lead), [{"id": lead_id, "client_id": client_ids[key]} for lead_id, key in keys.items()])
+        db.commit()
+        stats["linked"] += len(keys)
+
+        elapsed = time.monotonic() - started
+        progress(f"  заявок {stats['leads']}, связано {stats['linked']} ({stats['leads'] / elapsed:.0f}/с)")
+
+    repeat = select(Lead.client_id).where(Lead.client_id.isnot(None)).group_by(Lead.client_id)
+    stats["clients"] = db.scalar(select(func.count()).select_from(repeat.subquery()))
+    stats["repeat_clients"] = db.scalar(
+        select(func.count()).select_from(repeat.having(func.count() > 1).subquery())
+    )
+    stats["multi_account_clients"] = db.scalar(
+        select(func.count()).select_from(repeat.having(func.count(Lead.user_id.distinct()) > 1).subquery())
+    )
+    return stats
+
+
+# ==================== CLI ====================
+
+def main():
+    import config
+    from database import init_db
+
+    arg_parser = argparse.ArgumentParser(description="Связать старые заявки с клиентами по телефону")
+    arg_parser.add_argument("--batch-size", type=int, default=5000)
+    arg_parser.add_argument("--database-url", default=config.DATABASE_URL)
+    args = arg_parser.parse_args()
+
+    if not args.database_url:
+        arg_parser.error("DATABASE_URL не установлен")
+
+    engine, SessionLocal = init_db(args.database_url)
+    db = SessionLocal()
+    try:
+        stats = link_existing(db, args.batch_size)
+    finally:
+        db.close()
+        engine.dispose()
+
+    print(
+        f"Заявок с телефоном: {stats['leads']}, связано: {stats['linked']}, "
+        f"телефон не распознан: {stats['invalid']}\n"
+        f"Клиентов: {stats['clients']}, повторных: {stats['repeat_clients']}, "
+        f"с нескольких аккаунтов: {stats['multi_account_clients']}"
+    )
+
+
+if __name__ == "__main__":
+    main()
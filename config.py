@@ -5,13 +5,30 @@ BOT_TOKEN = os.getenv("BOT_TOKEN")
 
 # Database
 DATABASE_URL = os.getenv("DATABASE_URL")
+# Реплики для чтения (админские списки, отчёты) через запятую; пусто — всё на primary
+DATABASE_REPLICA_URLS = [url.strip() for url in os.getenv("DATABASE_REPLICA_URLS", "").split(",") if url.strip()]
+REPLICA_MAX_LAG_S = float(os.getenv("REPLICA_MAX_LAG_S", "10"))
+
+# БД недоступна/тормозит (spool.py): таймауты, предохранитель, локальный журнал заявок
+DB_CONNECT_TIMEOUT = int(os.getenv("DB_CONNECT_TIMEOUT", "3"))
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "5000"))
+DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", "5"))
+DB_BREAKER_FAILURES = int(os.getenv("DB_BREAKER_FAILURES", "3"))   # ошибок подряд до размыкания
+DB_BREAKER_RESET_S = float(os.getenv("DB_BREAKER_RESET_S", "15"))  # пробный запрос не чаще
+SPOOL_PATH = os.getenv("SPOOL_PATH", "spool.db")
 
 # Admin & Owner
 ADMIN_CHAT_ID = int(os.getenv("ADMIN_CHAT_ID", "0"))
 OWNER_CHAT_ID = int(os.getenv("OWNER_CHAT_ID", "0"))
 
-# OpenAI (для ИИ-слоя, потом)
+# OpenAI (ИИ-ответы на вопросы, которых нет в FAQ; без ключа — выключено)
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
+OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
+AI_MAX_CONCURRENCY = int(os.getenv("AI_MAX_CONCURRENCY", "4"))
+AI_TIMEOUT = float(os.getenv("AI_TIMEOUT", "30"))
+AI_CACHE_SIZE = int(os.getenv("AI_CACHE_SIZE", "1000"))
+AI_CACHE_TTL = int(os.getenv("AI_CACHE_TTL", "3600"))
+AI_HISTORY_MESSAGES = int(os.getenv("AI_HISTORY_MESSAGES", "10"))
 
 # Studio Info
 STUDIO_ADDRESS = "Инсайд Детейлинг\nТамбов, д. Красненькое. Северная 16в"
@@ -21,6 +38,54 @@ STUDIO_MAP_URL = "https://yandex.ru/maps/-/CLhLBV0T"
 WEEKDAY_HOURS = "10:00–19:00"
 SATURDAY_HOURS = "11:00–18:00"
 SUNDAY_HOURS = "выходной (но принять авто можно, админ подтвердит)"
+STUDIO_UTC_OFFSET = int(os.getenv("STUDIO_UTC_OFFSET", "3"))  # Тамбов — UTC+3
+
+# Запись на время (slots.py): боксы и шаг сетки слотов
+STUDIO_BAYS = int(os.getenv("STUDIO_BAYS", "2"))
+SLOT_STEP_MIN = int(os.getenv("SLOT_STEP_MIN", "60"))
+
+# Reminders (отложенные сообщения)
+NUDGE_AFTER_MIN = int(os.getenv("NUDGE_AFTER_MIN", "120"))        # "Вы не закончили заявку" после N мин на шаге
+FOLLOWUP_AFTER_MIN = int(os.getenv("FOLLOWUP_AFTER_MIN", "30"))   # Напомнить админу о новой заявке через N мин
+FOLLOWUP_REPEATS = int(os.getenv("FOLLOWUP_REPEATS", "3"))
+
+# Рассылки (/broadcast): лимит Telegram ~30 сообщений/с на бота, оставляем запас под обычные ответы
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))
+BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", "10"))   # одновременных запросов к Bot API
+BROADCAST_BATCH = int(os.getenv("BROADCAST_BATCH", "500"))      # получателей между сохранениями прогресса
+
+# Выгрузка заявок в CRM (outbox.py): пусто — выгрузка выключена
+CRM_WEBHOOK_URL = os.getenv("CRM_WEBHOOK_URL", "")
+CRM_WEBHOOK_TOKEN = os.getenv("CRM_WEBHOOK_TOKEN", "")          # Authorization: Bearer ...
+CRM_BATCH = int(os.getenv("CRM_BATCH", "100"))                  # событий в одном POST
+
+# Классификатор красных флагов (lead_score.py): файл модели; нет файла — правила parser.is_red_flag
+LEAD_SCORE_MODEL = os.getenv("LEAD_SCORE_MODEL", "lead_score.npz")
+
+# Фото от клиентов (оригиналы и превью)
+MEDIA_DIR = os.getenv("MEDIA_DIR", "media")
+MEDIA_THUMB_SIZE = int(os.getenv("MEDIA_THUMB_SIZE", "320"))
+MEDIA_WORKERS = int(os.getenv("MEDIA_WORKERS", "2"))  # процессы для превью
+
+# Update scheduler: сколько хендлеров выполняется одновременно.
+# Хендлеры держат соединение с БД через await — держим не больше пула SQLAlchemy (5 + 10)
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "10"))
+
+# Metrics (Prometheus /metrics; порт 0 — выключено)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))
+
+# Diagnostics (детектор блокировок event loop и профайлер хендлеров)
+DIAGNOSTICS = os.getenv("DIAGNOSTICS", "").lower() in ("1", "true", "yes")
+LOOP_BLOCK_THRESHOLD_MS = int(os.getenv("LOOP_BLOCK_THRESHOLD_MS", "100"))
+PROFILE_HANDLERS = os.getenv("PROFILE_HANDLERS", "").split(",")  # например: ppf_collect_car,ppf_collect_time
+PROFILE_OUTPUT_DIR = os.getenv("PROFILE_OUTPUT_DIR", "profiles")
+
+# Logging
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+LOG_JSON = os.getenv("LOG_JSON", "true").lower() in ("1", "true", "yes")
+LOG_DEBUG_SAMPLE_EVERY = int(os.getenv("LOG_DEBUG_SAMPLE_EVERY", "100"))  # из DEBUG пишем каждую N-ю
+SLOW_HANDLER_MS = int(os.getenv("SLOW_HANDLER_MS", "500"))
 
 # Mode
 MODE = os.getenv("MODE", "production")
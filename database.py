@@ -1,8 +1,14 @@
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Boolean, Text, Enum
+from sqlalchemy import bindparam, create_engine, inspect, select, text, Column, Integer, BigInteger, String, DateTime, Boolean, Text, Enum, Float, Index, UniqueConstraint
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.types import UserDefinedType
 from datetime import datetime
 import enum
+import logging
+
+logger = logging.getLogger(__name__)
 
 Base = declarative_base()
 
@@ -20,11 +26,14 @@ class User(Base):
     __tablename__ = "users"
     
     id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, unique=True, nullable=False)  # Telegram user_id
+    user_id = Column(Integer, unique=True, nullable=False)  # Telegram user_id (< 0 — клиент из импорта, legacy_import.py)
     username = Column(String(255), nullable=True)            # @username
     first_name = Column(String(255), nullable=True)
     last_name = Column(String(255), nullable=True)
     
+    # Рассылки: бот заблокирован — не слать (снимается, когда клиент снова пишет)
+    is_blocked = Column(Boolean, default=False)
+    
     # Режим диалога с админом
     in_admin_dialog = Column(Boolean, default=False)
     admin_dialog_lead_id = Column(Integer, nullable=True)   # ID заявки, по которой идёт диалог
@@ -43,6 +52,7 @@ class Lead(Base):
     
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, nullable=False)  # Telegram user_id
+    client_id = Column(Integer, nullable=True, index=True)  # Клиент по телефону (clients.py), общий для его заявок
     
     # Чек-лист данных
     service = Column(String(100), nullable=True)          # Услуга (ppf/vinyl/polish/etc)
@@ -60,6 +70,9 @@ class Lead(Base):
     # Признаки
     is_urgent = Column(Boolean, default=False)            # "Еду сейчас"
     is_red_flag = Column(Boolean, default=False)          # Красный флаг (претензия/нестандарт)
+    red_flag_score = Column(Float, nullable=True)         # Оценка классификатора 0..1 (lead_score.py); None — не оценивалась
+    import_key = Column(String(64), nullable=True, unique=True)  # Хеш строки старой выгрузки (legacy_import.py); у заявок бота — None
+    spool_key = Column(String(32), nullable=True, unique=True)   # Воронка без БД (spool.py): заявка создана из журнала по этому ключу
     
     # Статус
     status = Column(Enum(LeadStatus), default=LeadStatus.NEW)
@@ -70,6 +83,16 @@ class Lead(Base):
     completed_at = Column(DateTime, nullable=True)        # Когда закрыта
 
 
+class Client(Base):
+    """Клиент, опознанный по телефону: заявки с одним номером (в т.ч. с разных аккаунтов) ссылаются на него"""
+    __tablename__ = "clients"
+    
+    id = Column(Integer, primary_key=True)
+    phone_hash = Column(String(64), nullable=False, unique=True)  # sha256 от +7XXXXXXXXXX
+    
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
 class Message(Base):
     """История сообщений (для диалога админ-клиент и контекста ИИ)"""
     __tablename__ = "messages"
@@ -83,14 +106,414 @@ class Message(Base):
     
     # Содержимое
     text = Column(Text, nullable=True)
-    message_type = Column(String(50), default="text")     # text/photo/document
+    message_type = Column(String(50), default="text")     # text/photo/document/ai (ответ ИИ)
     
     created_at = Column(DateTime, default=datetime.utcnow)
 
 
-def init_db(database_url: str):
-    """Инициализация базы данных"""
-    engine = create_engine(database_url)
-    Base.metadata.create_all(engine)
+class FunnelEvent(Base):
+    """Событие телеметрии воронки: вход/выход клиента из шага FSM"""
+    __tablename__ = "funnel_events"
+    
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, nullable=False)
+    lead_id = Column(Integer, nullable=True)
+    
+    step = Column(String(100), nullable=False)            # "PPFFlow:collecting_car"
+    event = Column(String(10), nullable=False)            # enter/exit
+    next_step = Column(String(100), nullable=True)        # Куда ушёл (шаг или completed/menu/restart)
+    duration_ms = Column(Integer, nullable=True)          # Сколько пробыл на шаге (для exit)
+    
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
+
+
+# Размерность векторов FAQ (хешированные n-граммы, см. faq.py): при 256 разные вопросы
+# сталкивались в одних корзинах и похожими казались чужие ответы; 2000 — предел HNSW в pgvector
+FAQ_VECTOR_DIM = 2000
+
+
+class Vector(UserDefinedType):
+    """
+    Тип vector(dim) из pgvector.
+
+    Сам pgvector (и numpy за ним) импортируется при первом чтении/записи
+    колонки, а не при импорте моделей — на старте бота он не нужен.
+    """
+    cache_ok = True
+    
+    def __init__(self, dim: int):
+        super().__init__()
+        self.dim = dim
+    
+    def get_col_spec(self, **kw):
+        return f"VECTOR({self.dim})"
+    
+    def _impl(self):
+        from pgvector.sqlalchemy import Vector as PgVector
+        return PgVector(self.dim)
+    
+    def bind_processor(self, dialect):
+        return self._impl().bind_processor(dialect)
+    
+    def literal_processor(self, dialect):
+        return self._impl().literal_processor(dialect)
+    
+    def result_processor(self, dialect, coltype):
+        return self._impl().result_processor(dialect, coltype)
+    
+    class comparator_factory(UserDefinedType.Comparator):
+        def cosine_distance(self, other):
+            return self.op("<=>", return_type=Float)(other)
+
+
+class FaqEntry(Base):
+    """Вопрос-ответ базы знаний студии с вектором для поиска"""
+    __tablename__ = "faq_entries"
+    
+    id = Column(Integer, primary_key=True)
+    question = Column(Text, nullable=False)
+    answer = Column(Text, nullable=False)
+    embedding = Column(Vector(FAQ_VECTOR_DIM), nullable=False)
+    is_builtin = Column(Boolean, default=False)           # Из FAQ_ENTRIES в коде (пересоздаются при изменении)
+    
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
+class LeadCard(Base):
+    """Отправленная карточка лида: где она лежит, чтобы обновлять её, а не слать новую"""
+    __tablename__ = "lead_cards"
+    __table_args__ = (UniqueConstraint("chat_id", "message_id"),)
+    
+    id = Column(Integer, primary_key=True)
+    lead_id = Column(Integer, nullable=False, index=True)
+    chat_id = Column(BigInteger, nullable=False)
+    message_id = Column(Integer, nullable=False)
+    rendered_hash = Column(String(16), nullable=True)     # Хеш текста + кнопок, которые сейчас в карточке
+    
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
+class LeadMedia(Base):
+    """Фото к заявке от клиента (файл в MEDIA_DIR, превью, file_id для пересылки)"""
+    __tablename__ = "lead_media"
+    __table_args__ = (UniqueConstraint("lead_id", "sha256"),)
+    
+    id = Column(Integer, primary_key=True)
+    lead_id = Column(Integer, nullable=False, index=True)
+    user_id = Column(BigInteger, nullable=False)
+    
+    kind = Column(String(20), nullable=False)             # photo/document
+    file_id = Column(String(255), nullable=False)
+    file_unique_id = Column(String(100), nullable=False, index=True)
+    sha256 = Column(String(64), nullable=False)
+    size = Column(Integer, nullable=True)
+    path = Column(String(500), nullable=False)
+    thumb_path = Column(String(500), nullable=True)       # None — Pillow не установлен или файл не картинка
+    
+    sent_to_admin = Column(Boolean, default=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
+class ScheduledJob(Base):
+    """Отложенная задача (напоминание, дожим); key — одна задача на смысл, перепланирование её заменяет"""
+    __tablename__ = "scheduled_jobs"
+    
+    id = Column(Integer, primary_key=True)
+    key = Column(String(100), nullable=False, unique=True)   # "nudge:123", "followup:45", "visit:45:2h"
+    kind = Column(String(50), nullable=False)
+    payload = Column(Text, nullable=True)                     # JSON
+    run_at = Column(DateTime, nullable=False)
+    
+    status = Column(String(20), nullable=False, default="pending")  # pending/running/done/cancelled/failed
+    attempts = Column(Integer, nullable=False, default=0)
+    locked_by = Column(String(64), nullable=True)             # Воркер, который выполняет
+    locked_until = Column(DateTime, nullable=True)            # Аренда: после — задачу может взять другой
+    
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
+Index("ix_scheduled_jobs_status_run_at", ScheduledJob.status, ScheduledJob.run_at)
+
+
+class Booking(Base):
+    """Запись заявки на бокс (slots.py); время — местное время студии"""
+    __tablename__ = "bookings"
+    
+    id = Column(Integer, primary_key=True)
+    lead_id = Column(Integer, nullable=False, index=True)
+    bay = Column(Integer, nullable=False)                 # Номер бокса, 1..STUDIO_BAYS
+    starts_at = Column(DateTime, nullable=False)
+    ends_at = Column(DateTime, nullable=False)            # С учётом нерабочих часов между днями
+    status = Column(String(20), nullable=False, default="active")  # active/cancelled
+    
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
+Index("ix_bookings_bay_starts_at", Booking.bay, Booking.starts_at)
+
+
+class Broadcast(Base):
+    """Рассылка по users; cursor — users.id последнего обработанного получателя (продолжение после рестарта)"""
+    __tablename__ = "broadcasts"
+    
+    id = Column(Integer, primary_key=True)
+    text = Column(Text, nullable=True)                        # Текст или копия сообщения админа (source_*)
+    source_chat_id = Column(BigInteger, nullable=True)
+    source_message_id = Column(Integer, nullable=True)
+    created_by = Column(BigInteger, nullable=False)
+    
+    status = Column(String(20), nullable=False, default="draft")  # draft/running/done/cancelled
+    total = Column(Integer, nullable=False, default=0)            # Получателей на момент создания
+    cursor = Column(Integer, nullable=False, default=0)
+    sent = Column(Integer, nullable=False, default=0)
+    blocked = Column(Integer, nullable=False, default=0)
+    failed = Column(Integer, nullable=False, default=0)
+    
+    locked_by = Column(String(64), nullable=True)             # Инстанс, который сейчас шлёт
+    locked_until = Column(DateTime, nullable=True)
+    progress_chat_id = Column(BigInteger, nullable=True)      # Сообщение с прогрессом у админа
+    progress_message_id = Column(Integer, nullable=True)
+    
+    created_at = Column(DateTime, default=datetime.utcnow)
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
+class OutboxEvent(Base):
+    """Изменение заявки для выгрузки в CRM (outbox.py); пишется в той же транзакции, что и сама заявка"""
+    __tablename__ = "outbox_events"
+    
+    id = Column(Integer, primary_key=True)                # Порядок отправки; "lead-{lead_id}-{id}" — ключ идемпотентности
+    lead_id = Column(Integer, nullable=False, index=True)
+    event_type = Column(String(30), nullable=False)       # lead.created/lead.updated
+    payload = Column(Text, nullable=False)                # JSON: снимок заявки на момент изменения
+    
+    status = Column(String(20), nullable=False, default="pending")  # pending/sent/dead
+    attempts = Column(Integer, nullable=False, default=0)
+    last_error = Column(Text, nullable=True)
+    claimed_until = Column(DateTime, nullable=True)       # Пачка отправляется (outbox.OutboxRelay); после — None
+    next_attempt_at = Column(DateTime, nullable=True)     # После ошибки: раньше не повторять, события заявки ждут
+    
+    created_at = Column(DateTime, default=datetime.utcnow)
+    sent_at = Column(DateTime, nullable=True)
+
+
+Index("ix_outbox_events_status_id", OutboxEvent.status, OutboxEvent.id)
+
+
+class ProcessedUpdate(Base):
+    """Обработанные update_id Telegram (защита от повторной обработки)"""
+    __tablename__ = "processed_updates"
+    
+    update_id = Column(BigInteger, primary_key=True, autoincrement=False)
+    processed_at = Column(DateTime, default=datetime.utcnow, index=True)
+
+
+class SchemaMeta(Base):
+    """Версия схемы БД (одна строка)"""
+    __tablename__ = "schema_meta"
+    
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
+# ==================== МИГРАЦИИ ====================
+# Новые таблицы создаёт create_all; сюда — то, что он не умеет:
+# новые колонки и индексы в существующих таблицах.
+# Каждая миграция — (версия, описание, функция(conn)) и должна быть
+# идемпотентной: на базе без schema_meta выполняются все.
+
+def add_column(conn, table: str, column: str, ddl: str):
+    """ALTER TABLE ... ADD COLUMN, если такой колонки ещё нет"""
+    columns = {c["name"] for c in inspect(conn).get_columns(table)}
+    if column not in columns:
+        conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+
+
+# Выражения индексов /find; search.py ищет ровно по ним — иначе Postgres индексы не использует
+LEAD_DOCUMENT_SQL = (
+    "to_tsvector('russian', coalesce(car_brand, '') || ' ' || coalesce(car_model, '') || ' ' || "
+    "coalesce(CAST(car_year AS text), '') || ' ' || coalesce(service_variant, '') || ' ' || coalesce(goal, '') || ' ' || "
+    "coalesce(comment, '') || ' ' || coalesce(preferred_time, ''))"
+)
+MESSAGE_DOCUMENT_SQL = "to_tsvector('russian', coalesce(text, ''))"
+LEAD_CAR_SQL = "(coalesce(car_brand, '') || ' ' || coalesce(car_model, ''))"
+
+
+def create_search_indexes(conn):
+    """Полнотекстовые и триграммные индексы (в SQLite поиск идёт по индексу в памяти)"""
+    if conn.dialect.name != "postgresql":
+        return
+    conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+    conn.execute(text(f"CREATE INDEX IF NOT EXISTS ix_leads_fts ON leads USING gin ({LEAD_DOCUMENT_SQL})"))
+    conn.execute(text(f"CREATE INDEX IF NOT EXISTS ix_messages_fts ON messages USING gin ({MESSAGE_DOCUMENT_SQL})"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_leads_phone_trgm ON leads USING gin (phone gin_trgm_ops)"))
+    conn.execute(text(f"CREATE INDEX IF NOT EXISTS ix_leads_car_trgm ON leads USING gin ({LEAD_CAR_SQL} gin_trgm_ops)"))
+
+
+def add_lead_client_id(conn):
+    """Ссылка заявки на клиента; старые заявки связывает python clients.py"""
+    add_column(conn, "leads", "client_id", "INTEGER")
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_leads_client_id ON leads (client_id)"))
+
+
+def reembed_faq(conn):
+    """Вектора FAQ другой размерности и признаков (faq.embed): колонку меняем, вектора считаем заново"""
+    from faq import embed   # faq импортирует database — только здесь, при миграции
+
+    if conn.dialect.name == "postgresql":
+        conn.execute(text("DROP INDEX IF EXISTS faq_entries_embedding_hnsw"))
+        conn.execute(text("ALTER TABLE faq_entries ALTER COLUMN embedding DROP NOT NULL"))
+        conn.execute(text(f"ALTER TABLE faq_entries ALTER COLUMN embedding TYPE vector({FAQ_VECTOR_DIM}) USING NULL"))
+
+    rows = conn.execute(select(FaqEntry.id, FaqEntry.question)).all()
+    if rows:
+        conn.execute(
+            FaqEntry.__table__.update().where(FaqEntry.id == bindparam("entry_id")).values(embedding=bindparam("vector")),
+            [{"entry_id": row.id, "vector": embed(row.question)} for row in rows],
+        )
+
+    if conn.dialect.name == "postgresql":
+        conn.execute(text("ALTER TABLE faq_entries ALTER COLUMN embedding SET NOT NULL"))
+
+
+def add_lead_import_key(conn):
+    """
+    Ключ повторного импорта; NULL у заявок бота уникальности не мешает.
+
+    Уже импортированным (user_id < 0) ключ считается по сохранённым полям:
+    совпадёт у строк с датой (у строк без даты в базе — дата того импорта).
+    """
+    from legacy_import import row_key   # импортирует database — только здесь, при миграции
+
+    add_column(conn, "leads", "import_key", "VARCHAR(64)")
+    rows = conn.execute(
+        select(Lead.id, Lead.phone, Lead.created_at, Lead.car_brand, Lead.car_model, Lead.car_year, Lead.service, Lead.comment)
+        .where(Lead.user_id < 0, Lead.import_key.is_(None))
+    ).all()
+    keys, values = set(), []
+    for row in rows:
+        key = row_key(row.phone, row.created_at, row.car_brand, row.car_model, row.car_year, row.service, row.comment)
+        # Дубли прошлых запусков — ключ только у первой
+        if key not in keys:
+            keys.add(key)
+            values.append({"lead_id": row.id, "key": key})
+    if values:
+        conn.execute(
+            Lead.__table__.update().where(Lead.id == bindparam("lead_id")).values(import_key=bindparam("key")),
+            values,
+        )
+    conn.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS ix_leads_import_key ON leads (import_key)"))
+
+
+def add_lead_spool_key(conn):
+    """Ключ воронки, прошедшей без БД: перенос журнала создаёт по нему ровно одну заявку"""
+    add_column(conn, "leads", "spool_key", "VARCHAR(32)")
+    conn.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS ix_leads_spool_key ON leads (spool_key)"))
+
+
+def rebuild_lead_fts(conn):
+    """Выражение LEAD_DOCUMENT_SQL изменилось (год авто) — индекс строится заново"""
+    if conn.dialect.name != "postgresql":
+        return
+    conn.execute(text("DROP INDEX IF EXISTS ix_leads_fts"))
+    conn.execute(text(f"CREATE INDEX IF NOT EXISTS ix_leads_fts ON leads USING gin ({LEAD_DOCUMENT_SQL})"))
+
+
+MIGRATIONS = [
+    (1, "Базовая схема (create_all)", lambda conn: None),
+    (2, "Фото к заявкам: lead_media", lambda conn: None),
+    (3, "Напоминания: scheduled_jobs", lambda conn: None),
+    (4, "Поиск /find: tsvector и pg_trgm", create_search_indexes),
+    (5, "Клиенты по телефону: clients, leads.client_id", add_lead_client_id),
+    (6, "Рассылки: broadcasts, users.is_blocked",
+     lambda conn: add_column(conn, "users", "is_blocked", "BOOLEAN DEFAULT FALSE")),
+    (7, "Запись на время: bookings", lambda conn: None),
+    (8, "Выгрузка в CRM: outbox_events", lambda conn: None),
+    (9, "Классификатор красных флагов: leads.red_flag_score",
+     lambda conn: add_column(conn, "leads", "red_flag_score", "REAL")),
+    (10, "FAQ: вектора 2000 вместо 256, без служебных слов", reembed_faq),
+    (11, "Импорт старых заявок: leads.import_key", add_lead_import_key),
+    (12, "Перенос журнала: leads.spool_key", add_lead_spool_key),
+    (13, "Выгрузка в CRM: outbox_events.claimed_until",
+     lambda conn: add_column(conn, "outbox_events", "claimed_until", "TIMESTAMP")),
+    (14, "Поиск /find: год авто в полнотекстовом индексе заявок", rebuild_lead_fts),
+    (15, "Выгрузка в CRM: outbox_events.next_attempt_at",
+     lambda conn: add_column(conn, "outbox_events", "next_attempt_at", "TIMESTAMP")),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def get_schema_version(engine):
+    """Версия схемы из schema_meta или None (таблицы нет — новая или старая база)"""
+    try:
+        with engine.connect() as conn:
+            return conn.execute(text("SELECT version FROM schema_meta WHERE id = 1")).scalar()
+    except SQLAlchemyError:
+        return None
+
+
+def migrate(engine, current_version=None):
+    """Довести схему до SCHEMA_VERSION"""
+    with engine.begin() as conn:
+        if engine.dialect.name == "postgresql":
+            # Два инстанса при деплое не мигрируют одновременно
+            conn.execute(text("SELECT pg_advisory_xact_lock(7031)"))
+            # Тип vector для faq_entries (в SQLite колонка хранится как текст)
+            conn.execute(text("CREATE EXTENSION IF NOT EXISTS vector"))
+        
+        Base.metadata.create_all(conn)
+        
+        for version, description, apply in MIGRATIONS:
+            if current_version is None or version > current_version:
+                logger.info("Миграция схемы %d: %s", version, description)
+                apply(conn)
+        
+        updated = conn.execute(
+            SchemaMeta.__table__.update().where(SchemaMeta.id == 1).values(version=SCHEMA_VERSION, updated_at=datetime.utcnow())
+        ).rowcount
+        if not updated:
+            conn.execute(SchemaMeta.__table__.insert().values(id=1, version=SCHEMA_VERSION, updated_at=datetime.utcnow()))
+
+
+def init_db(database_url: str, **engine_kwargs):
+    """
+    Инициализация базы данных.
+    
+    На старте — один SELECT версии схемы; DDL выполняется, только если
+    версия в базе отстаёт от SCHEMA_VERSION.
+    """
+    engine = create_engine(database_url, **engine_kwargs)
+    
+    current_version = get_schema_version(engine)
+    if current_version is None or current_version < SCHEMA_VERSION:
+        migrate(engine, current_version)
+    elif current_version > SCHEMA_VERSION:
+        logger.warning("Схема БД новее кода (%s > %s) — миграции пропущены", current_version, SCHEMA_VERSION)
+    
     SessionLocal = sessionmaker(bind=engine)
     return engine, SessionLocal
+
+
+def insert_ignore(db, model, rows: list):
+    """INSERT ... ON CONFLICT DO NOTHING (Postgres/SQLite), иначе построчно"""
+    if not rows:
+        return
+    
+    dialect = db.get_bind().dialect.name
+    
+    if dialect == "postgresql":
+        db.execute(postgresql.insert(model).on_conflict_do_nothing(), rows)
+    elif dialect == "sqlite":
+        db.execute(sqlite.insert(model).on_conflict_do_nothing(), rows)
+    else:
+        for row in rows:
+            try:
+                with db.begin_nested():
+                    db.execute(model.__table__.insert(), row)
+            except IntegrityError:
+                pass
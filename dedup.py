@@ -0,0 +1,157 @@
+"""
+Защита от повторной обработки одного и того же апдейта
+(рестарт посреди обработки, повторная доставка вебхука).
+
+Проверка — O(1) по кольцу последних update_id в памяти. Кольцо
+переживает рестарт: обработанные id пачками пишутся в processed_updates,
+при старте последние из них загружаются обратно.
+"""
+import asyncio
+import logging
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from aiogram import BaseMiddleware
+from aiogram.dispatcher.event.bases import UNHANDLED
+from sqlalchemy import delete, select
+
+import metrics
+from database import ProcessedUpdate, insert_ignore
+
+logger = logging.getLogger(__name__)
+
+DUPLICATES = metrics.Counter("bot_duplicate_updates_total", "Отброшенные повторные апдейты")
+
+
+class UpdateDeduplicator:
+    """Кольцо последних update_id + отложенная запись в БД"""
+
+    def __init__(self, capacity: int = 100000, flush_interval: float = 1.0, retention: timedelta = timedelta(days=2)):
+        self.capacity = capacity
+        self.flush_interval = flush_interval
+        self.retention = retention
+
+        self._ring = deque()
+        self._seen = set()
+        self._to_persist = []
+        self._task: Optional[asyncio.Task] = None
+
+    def _remember(self, update_id: int):
+        if len(self._ring) >= self.capacity:
+            self._seen.discard(self._ring.popleft())
+        self._ring.append(update_id)
+        self._seen.add(update_id)
+
+    def claim(self, update_id: int) -> bool:
+        """Занять update_id. False — такой апдейт уже обработан или обрабатывается"""
+        if update_id in self._seen:
+            return False
+        self._remember(update_id)
+        return True
+
+    def release(self, update_id: int):
+        """Обработка упала — апдейт можно будет обработать повторно"""
+        if update_id not in self._seen:
+            return
+        self._seen.discard(update_id)
+        # Из кольца — тоже: иначе повторный claim положит id второй раз, а вытеснение
+        # старой копии удалит из _seen живую. Обычно это последний занятый id
+        if self._ring[-1] == update_id:
+            self._ring.pop()
+        else:
+            self._ring.remove(update_id)
+
+    def done(self, update_id: int):
+        self._to_persist.append(update_id)
+
+    # ---------- БД ----------
+
+    def load(self, session_factory):
+        """Загрузить последние обработанные update_id (при старте)"""
+        db = session_factory()
+        try:
+            rows = db.execute(
+                select(ProcessedUpdate.update_id)
+                .order_by(ProcessedUpdate.update_id.desc())
+                .limit(self.capacity)
+            ).scalars().all()
+        finally:
+            db.close()
+
+        for update_id in reversed(rows):
+            self._remember(update_id)
+        logger.info("Загружено %d обработанных update_id", len(rows))
+
+    def _write(self, session_factory, update_ids: list, prune: bool):
+        now = datetime.utcnow()
+        db = session_factory()
+        try:
+            insert_ignore(db, ProcessedUpdate, [{"update_id": update_id, "processed_at": now} for update_id in update_ids])
+            if prune:
+                db.execute(delete(ProcessedUpdate).where(ProcessedUpdate.processed_at < now - self.retention))
+            db.commit()
+        finally:
+            db.close()
+
+    async def flush(self, session_factory, prune: bool = False):
+        if not self._to_persist and not prune:
+            return
+
+        batch, self._to_persist = self._to_persist, []
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(None, self._write, session_factory, batch, prune)
+        except Exception as e:
+            # В памяти id остались — повтор в этом процессе всё равно отсечём
+            self._to_persist[:0] = batch
+            logger.warning("Не удалось записать %d update_id: %s", len(batch), e)
+
+    async def run(self, session_factory):
+        flushes = 0
+        prune_every = max(1, int(3600 / self.flush_interval))
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            flushes += 1
+            await self.flush(session_factory, prune=flushes % prune_every == 0)
+
+    def start(self, session_factory):
+        self._task = asyncio.create_task(self.run(session_factory))
+
+    async def stop(self, session_factory):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        await self.flush(session_factory)
+
+
+class DeduplicationMiddleware(BaseMiddleware):
+    """Outer middleware на dp.update: повторный update_id до хендлеров не доходит"""
+
+    def __init__(self, deduplicator: UpdateDeduplicator):
+        self.deduplicator = deduplicator
+
+    async def __call__(
+        self,
+        handler: Callable[[Any, Dict[str, Any]], Awaitable[Any]],
+        event: Any,
+        data: Dict[str, Any],
+    ) -> Any:
+        update_id = event.update_id
+
+        if not self.deduplicator.claim(update_id):
+            DUPLICATES.inc()
+            logger.info("Повторный апдейт %s пропущен", update_id)
+            return UNHANDLED
+
+        try:
+            result = await handler(event, data)
+        except Exception:
+            self.deduplicator.release(update_id)
+            raise
+
+        self.deduplicator.done(update_id)
+        return result
+
+
+updates = UpdateDeduplicator()
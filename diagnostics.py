@@ -0,0 +1,260 @@
+"""
+Диагностика (включается через DIAGNOSTICS=1):
+
+- детектор блокировок event loop: сторожевой поток замечает, что loop
+  не отвечает дольше порога, и пишет в лог стек того кода, который его держит
+  (например, синхронный db.query внутри ppf_collect_car);
+- сэмплирующий профайлер выбранных хендлеров: стеки loop-потока снимаются
+  каждые несколько миллисекунд, пока такой хендлер выполняется, и сохраняются
+  в folded-формате (flamegraph.pl, speedscope, inferno).
+"""
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, Iterable, Optional
+
+from aiogram import BaseMiddleware
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+LOOP_BLOCKED = metrics.Histogram(
+    "bot_event_loop_blocked_seconds",
+    "Длительность блокировок event loop дольше порога",
+    buckets=(0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0),
+)
+
+# Фреймы самого asyncio/aiogram отрезаем — в профиле интересен код хендлера
+_SKIP_PREFIXES = (os.path.dirname(asyncio.__file__),)
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+
+
+def _stack(frame) -> list:
+    """Стек от корня к листу"""
+    frames = []
+    while frame is not None:
+        frames.append(frame)
+        frame = frame.f_back
+    frames.reverse()
+    return frames
+
+
+# ==================== ДЕТЕКТОР БЛОКИРОВОК ====================
+
+class LoopBlockDetector:
+    """Сторожевой поток, который ловит event loop на долгой синхронной работе"""
+
+    def __init__(self, threshold: float = 0.1):
+        self.threshold = threshold
+        self.blocks = 0
+        self._loop_thread_id: Optional[int] = None
+        self._last_beat = time.monotonic()
+        self._stop = threading.Event()
+        self._heartbeat_task: Optional[asyncio.Task] = None
+        self._thread: Optional[threading.Thread] = None
+
+    async def _heartbeat(self):
+        interval = self.threshold / 4
+        while True:
+            self._last_beat = time.monotonic()
+            await asyncio.sleep(interval)
+
+    def _watch(self):
+        interval = self.threshold / 4
+        reported_beat = None
+        blocked_since = None
+
+        while not self._stop.wait(interval):
+            beat = self._last_beat
+            stalled = time.monotonic() - beat
+
+            if stalled < self.threshold:
+                if blocked_since is not None:
+                    LOOP_BLOCKED.observe(time.monotonic() - blocked_since)
+                    blocked_since = None
+                continue
+
+            # Про одну и ту же блокировку пишем один раз
+            if reported_beat == beat:
+                continue
+            reported_beat = beat
+            blocked_since = beat
+            self.blocks += 1
+
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+
+            stack = "\n".join(
+                f"  {_frame_label(f)}" for f in _stack(frame)
+                if not f.f_code.co_filename.startswith(_SKIP_PREFIXES)
+            )
+            logger.warning(
+                "Event loop заблокирован уже %.0f мс, стек:\n%s",
+                stalled * 1000, stack,
+            )
+
+    def start(self):
+        self._loop_thread_id = threading.get_ident()
+        self._heartbeat_task = asyncio.create_task(self._heartbeat())
+        self._thread = threading.Thread(target=self._watch, name="loop-block-detector", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._heartbeat_task:
+            self._heartbeat_task.cancel()
+
+
+# ==================== ПРОФАЙЛЕР ХЕНДЛЕРОВ ====================
+
+class HandlerProfiler:
+    """Сэмплирующий профайлер выбранных хендлеров с выводом в folded-формате"""
+
+    def __init__(self, handlers: Iterable[str], output_dir: str, interval: float = 0.005):
+        self.handler_names = set(handlers)
+        self.output_dir = output_dir
+        self.interval = interval
+
+        # folded-стек -> число сэмплов; пишет поток сэмплера, забирает dump — под _samples_lock
+        self.samples: Dict[str, int] = {}
+        self._samples_lock = threading.Lock()
+        self._target_codes = set()
+        self._in_flight = 0
+        self._active = threading.Event()
+        self._stop = threading.Event()
+        self._loop_thread_id: Optional[int] = None
+        self._thread: Optional[threading.Thread] = None
+
+    def enter(self, callback):
+        self._target_codes.add(callback.__code__)
+        self._in_flight += 1
+        if self._in_flight == 1:
+            self._active.set()
+
+    def exit(self):
+        self._in_flight -= 1
+        if self._in_flight == 0:
+            self._active.clear()
+
+    def _sample_once(self):
+        frame = sys._current_frames().get(self._loop_thread_id)
+        if frame is None:
+            return
+
+        stack = _stack(frame)
+
+        # Сэмпл засчитывается, только если на стеке сейчас профилируемый хендлер
+        for index, f in enumerate(stack):
+            if f.f_code in self._target_codes:
+                folded = ";".join(_frame_label(item) for item in stack[index:])
+                with self._samples_lock:
+                    self.samples[folded] = self.samples.get(folded, 0) + 1
+                return
+
+    def _run(self):
+        while not self._stop.is_set():
+            if not self._active.wait(timeout=0.5):
+                continue
+            self._sample_once()
+            time.sleep(self.interval)
+
+    def dump(self) -> Optional[str]:
+        """Сохранить накопленные сэмплы в файл .folded"""
+        with self._samples_lock:
+            samples, self.samples = self.samples, {}
+        if not samples:
+            return None
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        path = os.path.join(self.output_dir, f"profile-{int(time.time())}.folded")
+
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in sorted(samples.items()):
+                f.write(f"{stack} {count}\n")
+
+        logger.info("Профиль хендлеров сохранён: %s (%d стеков)", path, len(samples))
+        return path
+
+    def start(self):
+        self._loop_thread_id = threading.get_ident()
+        self._thread = threading.Thread(target=self._run, name="handler-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._active.set()
+        if self._thread:
+            self._thread.join(timeout=1)
+        self.dump()
+
+
+class ProfilerMiddleware(BaseMiddleware):
+    """Inner middleware: включает сэмплирование, пока работает выбранный хендлер"""
+
+    def __init__(self, profiler: HandlerProfiler):
+        self.profiler = profiler
+
+    async def __call__(
+        self,
+        handler: Callable[[Any, Dict[str, Any]], Awaitable[Any]],
+        event: Any,
+        data: Dict[str, Any],
+    ) -> Any:
+        handler_object = data.get("handler")
+        if handler_object is None or handler_object.callback.__name__ not in self.profiler.handler_names:
+            return await handler(event, data)
+
+        self.profiler.enter(handler_object.callback)
+        try:
+            return await handler(event, data)
+        finally:
+            self.profiler.exit()
+
+
+# ==================== ЗАПУСК ====================
+
+class Diagnostics:
+    """Детектор блокировок + профайлер, управляемые из config"""
+
+    def __init__(self, threshold_ms: int, profile_handlers: Iterable[str], output_dir: str, dump_interval: float = 60.0):
+        self.detector = LoopBlockDetector(threshold=threshold_ms / 1000)
+        handlers = [name for name in profile_handlers if name]
+        self.profiler = HandlerProfiler(handlers, output_dir) if handlers else None
+        self.dump_interval = dump_interval
+        self._dump_task: Optional[asyncio.Task] = None
+
+    def setup_dispatcher(self, dp):
+        if self.profiler:
+            dp.message.middleware(ProfilerMiddleware(self.profiler))
+            dp.callback_query.middleware(ProfilerMiddleware(self.profiler))
+
+    async def _periodic_dump(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.dump_interval)
+            await loop.run_in_executor(None, self.profiler.dump)
+
+    def start(self):
+        self.detector.start()
+        logger.info("Детектор блокировок event loop включён (порог %.0f мс)", self.detector.threshold * 1000)
+
+        if self.profiler:
+            self.profiler.start()
+            self._dump_task = asyncio.create_task(self._periodic_dump())
+            logger.info("Профилируются хендлеры: %s", ", ".join(sorted(self.profiler.handler_names)))
+
+    def stop(self):
+        self.detector.stop()
+        if self._dump_task:
+            self._dump_task.cancel()
+        if self.profiler:
+            self.profiler.stop()
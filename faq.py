@@ -0,0 +1,283 @@
+"""
+Ответы на вопросы клиентов по базе знаний студии ("❓ Задать вопрос").
+
+Вопрос превращается в вектор хешированных символьных n-грамм (без моделей
+и сети, устойчиво к опечаткам и окончаниям), поиск — косинусная близость.
+Вектора хранятся в faq_entries (pgvector); для небольшой базы поиск идёт
+в памяти через NumPy, для большой в Postgres — через HNSW-индекс pgvector.
+NumPy импортируется при первом построении индекса, а не при старте бота.
+"""
+import logging
+import re
+import zlib
+from collections import OrderedDict
+from typing import TYPE_CHECKING, List, Optional, Tuple
+
+from sqlalchemy import delete, select, text
+
+import config
+from database import FAQ_VECTOR_DIM, FaqEntry
+
+if TYPE_CHECKING:
+    import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Ниже этого сходства считаем, что ответа в базе нет
+MIN_SCORE = 0.45
+# Насколько лучший ответ должен обгонять второй: почти равные — вопрос «между» темами,
+# уверенно отвечать нельзя (пусть ответит ИИ или администратор)
+MIN_MARGIN = 0.1
+
+# До какого размера базы ищем в памяти, а не запросом в pgvector
+IN_MEMORY_LIMIT = 5000
+
+CACHE_SIZE = 1024
+
+
+# ==================== БАЗА ЗНАНИЙ ====================
+
+# Только то, что уже есть в config и текстах воронки. Цены, сроки, гарантию, оплату
+# здесь не придумываем: пока владелец студии не добавит их (сюда или строкой
+# в faq_entries с is_builtin = False), такие вопросы уходят ИИ или администратору.
+FAQ_ENTRIES = [
+    {
+        "question": "Где вы находитесь? Какой адрес студии? Как доехать?",
+        "answer": f"Мы находимся по адресу:\n\n{config.STUDIO_ADDRESS}\n\nКарта: {config.STUDIO_MAP_URL}",
+    },
+    {
+        "question": "Какой график работы? Во сколько открываетесь и до скольки работаете? Работаете в выходные?",
+        "answer": (
+            f"Пн–Пт: {config.WEEKDAY_HOURS}\n"
+            f"Сб: {config.SATURDAY_HOURS}\n"
+            f"Вс: {config.SUNDAY_HOURS}"
+        ),
+    },
+    {
+        "question": "Какие услуги вы делаете? Чем занимается студия?",
+        "answer": (
+            "Оклейка защитной плёнкой (PPF), цветная полиуретановая плёнка, винил (смена цвета), "
+            "реставрация ЛКП и полировка, керамика, мойка, тонировка, химчистка. "
+            "Выберите услугу в главном меню — бот соберёт данные для записи."
+        ),
+    },
+    {
+        "question": "Какие варианты оклейки плёнкой? Что входит в базу, зоны риска, полную оклейку?",
+        "answer": (
+            "База — обычно капот, бампер, крылья, полоса на крышу или целиком, оптика. "
+            "Зоны риска — выбираете сами, какие элементы защитить. "
+            "Все элементы в цвет кузова — полная оклейка, по желанию добавляются пороги и пластик. "
+            "Состав уточним по вашему авто на осмотре."
+        ),
+    },
+    {
+        "question": "Можно ли оклеить матовой плёнкой? Мат или сатин?",
+        "answer": (
+            "Да: матовая или сатиновая фактура + родной цвет + полная защита. "
+            "Мат или сатин подберём на осмотре, дадим образцы, сравните на кузове."
+        ),
+    },
+    {
+        "question": "Можно поменять цвет машины плёнкой? Цветная полиуретановая плёнка",
+        "answer": (
+            "Да: цветная полиуретановая плёнка — смена цвета и защита ЛКП, оклейка только в круг. "
+            "Есть и винил — смена цвета без защиты. Оба варианта есть в главном меню."
+        ),
+    },
+    {
+        "question": "Как записаться? Можно приехать прямо сейчас?",
+        "answer": (
+            "Выберите услугу в главном меню — бот спросит авто, удобное время и телефон, "
+            "администратор позвонит и подтвердит время. "
+            "Если едете прямо сейчас — так и напишите, заявку увидят сразу."
+        ),
+    },
+]
+
+
+# ==================== ВЕКТОРИЗАЦИЯ ====================
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+# Служебные слова в признаки не идут: "есть ли у вас гарантия" иначе похоже на "есть ли у вас где подождать"
+STOP_WORDS = frozenset((
+    "а", "и", "или", "но", "да", "не", "ли", "же", "бы", "то", "ну", "так", "там", "еще", "уже",
+    "в", "во", "на", "по", "с", "со", "к", "ко", "о", "об", "у", "до", "за", "из", "от",
+    "я", "мы", "вы", "мне", "меня", "нас", "вас", "вам", "ваш", "ваша", "ваше", "мой", "моя", "это", "есть",
+))
+
+
+def normalize(text: str) -> str:
+    """Нижний регистр, ё→е, только слова через пробел"""
+    return " ".join(_WORD_RE.findall(text.lower().replace("ё", "е")))
+
+
+def ngram_features(normalized: str) -> List[str]:
+    features = []
+    for word in normalized.split():
+        features.append("w:" + word)
+        padded = f" {word} "
+        for n in (3, 4):
+            for i in range(len(padded) - n + 1):
+                features.append(padded[i:i + n])
+    return features
+
+
+def embed(text: str, dim: int = FAQ_VECTOR_DIM) -> "np.ndarray":
+    """Вектор хешированных n-грамм (L2-нормированный, float32)"""
+    import numpy as np
+
+    vector = np.zeros(dim, dtype=np.float32)
+    features = ngram_features(" ".join(word for word in normalize(text).split() if word not in STOP_WORDS))
+    if not features:
+        return vector
+
+    hashes = np.fromiter((zlib.crc32(f.encode("utf-8")) for f in features), dtype=np.uint32, count=len(features))
+    signs = np.where(hashes & 0x80000000, -1.0, 1.0).astype(np.float32)
+    np.add.at(vector, hashes % dim, signs)
+
+    norm = np.linalg.norm(vector)
+    if norm:
+        vector /= norm
+    return vector
+
+
+# ==================== ИНДЕКС ====================
+
+class FaqIndex:
+    """Поиск top-k ответов по базе знаний"""
+
+    def __init__(self):
+        self.questions: List[str] = []
+        self.answers: List[str] = []
+        self.ids: List[int] = []
+        self.matrix: Optional["np.ndarray"] = None
+        self.session_factory = None
+        self.use_pgvector = False
+        self._cache: "OrderedDict[Tuple[str, int], list]" = OrderedDict()
+
+    def build_in_memory(self, entries: list = None):
+        """Индекс только из FAQ_ENTRIES, без БД"""
+        import numpy as np
+
+        entries = entries if entries is not None else FAQ_ENTRIES
+        self.questions = [entry["question"] for entry in entries]
+        self.answers = [entry["answer"] for entry in entries]
+        self.ids = list(range(len(entries)))
+        self.matrix = np.vstack([embed(q) for q in self.questions]) if entries else None
+        self._cache.clear()
+
+    def fetch(self, session_factory) -> dict:
+        """
+        Синхронизировать FAQ_ENTRIES с faq_entries и прочитать индекс из БД.
+
+        Встроенные вопросы пересоздаются, если база знаний в коде изменилась;
+        добавленные вручную (is_builtin = False) не трогаем. Индекс не
+        меняется — результат применяет apply (можно вызывать из потока).
+        """
+        import numpy as np
+
+        db = session_factory()
+        try:
+            stored = db.execute(
+                select(FaqEntry.question, FaqEntry.answer).where(FaqEntry.is_builtin.is_(True)).order_by(FaqEntry.id)
+            ).all()
+            builtin = [(entry["question"], entry["answer"]) for entry in FAQ_ENTRIES]
+
+            if [tuple(row) for row in stored] != builtin:
+                db.execute(delete(FaqEntry).where(FaqEntry.is_builtin.is_(True)))
+                for question, answer in builtin:
+                    db.add(FaqEntry(question=question, answer=answer, embedding=embed(question), is_builtin=True))
+                db.commit()
+                logger.info("База знаний FAQ обновлена: %d вопросов", len(builtin))
+
+            rows = db.execute(select(FaqEntry.id, FaqEntry.question, FaqEntry.answer, FaqEntry.embedding).order_by(FaqEntry.id)).all()
+            is_postgres = db.get_bind().dialect.name == "postgresql"
+
+            if is_postgres and len(rows) > IN_MEMORY_LIMIT:
+                db.execute(text(
+                    "CREATE INDEX IF NOT EXISTS faq_entries_embedding_hnsw "
+                    "ON faq_entries USING hnsw (embedding vector_cosine_ops)"
+                ))
+                db.commit()
+        finally:
+            db.close()
+
+        use_pgvector = is_postgres and len(rows) > IN_MEMORY_LIMIT
+        return {
+            "session_factory": session_factory,
+            "ids": [row.id for row in rows],
+            "questions": [row.question for row in rows],
+            "answers": [row.answer for row in rows],
+            "use_pgvector": use_pgvector,
+            "matrix": (
+                None if use_pgvector or not rows
+                else np.vstack([np.asarray(row.embedding, dtype=np.float32) for row in rows])
+            ),
+        }
+
+    def apply(self, snapshot: dict):
+        """Подменить индекс результатом fetch (в потоке event loop, без await между полями)"""
+        for name, value in snapshot.items():
+            setattr(self, name, value)
+        self._cache.clear()
+
+    def load(self, session_factory):
+        """Синхронизировать базу знаний с БД и загрузить индекс"""
+        self.apply(self.fetch(session_factory))
+
+    def _search_pgvector(self, vector: "np.ndarray", k: int) -> list:
+        db = self.session_factory()
+        try:
+            distance = FaqEntry.embedding.cosine_distance(vector)
+            rows = db.execute(
+                select(FaqEntry.question, FaqEntry.answer, distance.label("distance")).order_by(distance).limit(k)
+            ).all()
+        finally:
+            db.close()
+        return [(1 - row.distance, row.question, row.answer) for row in rows]
+
+    def _search_numpy(self, vector: "np.ndarray", k: int) -> list:
+        import numpy as np
+
+        if self.matrix is None:
+            return []
+        scores = self.matrix @ vector
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(float(scores[i]), self.questions[i], self.answers[i]) for i in top]
+
+    def search(self, question: str, k: int = 3) -> List[Tuple[float, str, str]]:
+        """Top-k (сходство, вопрос, ответ), лучшие первыми"""
+        if not self.questions and not self.use_pgvector:
+            self.build_in_memory()
+
+        key = (normalize(question), k)
+        cached = self._cache.get(key)
+        if cached is not None:
+            self._cache.move_to_end(key)
+            return cached
+
+        vector = embed(question)
+        if self.use_pgvector:
+            results = self._search_pgvector(vector, k)
+        else:
+            results = self._search_numpy(vector, k)
+
+        self._cache[key] = results
+        if len(self._cache) > CACHE_SIZE:
+            self._cache.popitem(last=False)
+        return results
+
+    def answer(self, question: str) -> Optional[str]:
+        """Лучший ответ или None, если в базе ничего подходящего или лучший не выделяется"""
+        results = self.search(question, k=2)
+        if not results or results[0][0] < MIN_SCORE:
+            return None
+        if len(results) > 1 and results[0][0] - results[1][0] < MIN_MARGIN:
+            return None
+        return results[0][2]
+
+
+index = FaqIndex()
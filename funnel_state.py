@@ -0,0 +1,157 @@
+"""
+Данные воронки в FSM: типизированный объект вместо словаря.
+
+Раньше каждое поле (service, lead_id, car_brand, ...) было отдельным
+ключом в state.update_data: на каждом шаге — копия словаря при чтении и
+при записи, а постоянное хранилище FSM (Redis и т.п.) сериализовало бы
+весь словарь с именами ключей.
+
+Теперь в данных FSM один ключ — упакованная строка: версия, битовая
+маска заполненных полей, затем значения по порядку LAYOUT (числа — struct,
+строки — длина + UTF-8), всё в base64 (ASCII, без экранирования в JSON
+любого хранилища). Пустые поля места не занимают, "еду сейчас" — бит маски.
+
+    funnel = await funnel_state.load(state)
+    funnel.phone = phone
+    await funnel_state.save(state, funnel)      # не изменилось — записи нет
+
+    await funnel_state.update(state, car_brand=..., car_model=...)
+"""
+import base64
+import logging
+import struct
+from typing import Optional
+
+from aiogram.fsm.context import FSMContext
+
+logger = logging.getLogger(__name__)
+
+# Ключ в данных FSM
+KEY = "f"
+VERSION = 1
+
+# Порядок полей в упакованном виде; новые поля — только в конец (и VERSION не менять)
+LAYOUT = (
+    ("service", str),
+    ("service_variant", str),
+    ("lead_id", int),
+    ("car_brand", str),
+    ("car_model", str),
+    ("car_year", int),
+    ("preferred_time", str),
+    ("phone", str),
+    ("zones", str),
+    ("spool_key", str),   # заявки в БД нет (spool.py) — ключ, по которому её создаст перенос журнала
+)
+URGENT_BIT = 1 << 15
+
+_HEADER = struct.Struct("<BH")   # версия, маска
+_INT = struct.Struct("<q")
+_LENGTH = struct.Struct("<H")    # сообщение Telegram — до 4096 символов, в UTF-8 меньше 64 КБ
+
+
+class FunnelData:
+    """Поля заявки, собранные в воронке; None — ещё не известно"""
+    __slots__ = tuple(name for name, _ in LAYOUT) + ("is_urgent", "_packed")
+
+    def __init__(
+        self,
+        service: Optional[str] = None,
+        service_variant: Optional[str] = None,
+        lead_id: Optional[int] = None,
+        car_brand: Optional[str] = None,
+        car_model: Optional[str] = None,
+        car_year: Optional[int] = None,
+        preferred_time: Optional[str] = None,
+        phone: Optional[str] = None,
+        zones: Optional[str] = None,
+        spool_key: Optional[str] = None,
+        is_urgent: bool = False,
+    ):
+        self.service = service
+        self.service_variant = service_variant
+        self.lead_id = lead_id
+        self.car_brand = car_brand
+        self.car_model = car_model
+        self.car_year = car_year
+        self.preferred_time = preferred_time
+        self.phone = phone
+        self.zones = zones
+        self.spool_key = spool_key
+        self.is_urgent = is_urgent
+        self._packed: Optional[str] = None   # как лежит в FSM сейчас
+
+    def pack(self) -> str:
+        mask = URGENT_BIT if self.is_urgent else 0
+        parts = []
+        for bit, (name, kind) in enumerate(LAYOUT):
+            value = getattr(self, name)
+            if value is None:
+                continue
+            mask |= 1 << bit
+            if kind is int:
+                parts.append(_INT.pack(value))
+            else:
+                raw = value.encode("utf-8")
+                parts.append(_LENGTH.pack(len(raw)))
+                parts.append(raw)
+        return base64.b64encode(_HEADER.pack(VERSION, mask) + b"".join(parts)).decode("ascii")
+
+    @classmethod
+    def unpack(cls, packed: str) -> "FunnelData":
+        raw = base64.b64decode(packed)
+        version, mask = _HEADER.unpack_from(raw)
+        if version != VERSION:
+            raise ValueError(f"unknown funnel state version {version}")
+
+        data = cls(is_urgent=bool(mask & URGENT_BIT))
+        offset = _HEADER.size
+        for bit, (name, kind) in enumerate(LAYOUT):
+            if not mask & (1 << bit):
+                continue
+            if kind is int:
+                value = _INT.unpack_from(raw, offset)[0]
+                offset += _INT.size
+            else:
+                length = _LENGTH.unpack_from(raw, offset)[0]
+                offset += _LENGTH.size
+                value = raw[offset:offset + length].decode("utf-8")
+                offset += length
+            setattr(data, name, value)
+        data._packed = packed
+        return data
+
+    def __repr__(self) -> str:
+        fields = ", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__[:-1] if getattr(self, name))
+        return f"FunnelData({fields})"
+
+
+async def load(state: FSMContext) -> FunnelData:
+    packed = (await state.get_data()).get(KEY)
+    if not packed:
+        return FunnelData()
+    try:
+        return FunnelData.unpack(packed)
+    except (ValueError, struct.error) as e:
+        # Данные от другой версии бота (или битые) — воронку продолжаем с пустыми полями
+        logger.warning("Данные воронки не прочитаны: %s", e)
+        return FunnelData()
+
+
+async def save(state: FSMContext, data: FunnelData) -> bool:
+    """Записать в FSM, если что-то изменилось; True — была запись"""
+    packed = data.pack()
+    if packed == data._packed:
+        return False
+    await state.set_data({KEY: packed})
+    data._packed = packed
+    return True
+
+
+async def update(state: FSMContext, **fields) -> FunnelData:
+    """Изменить несколько полей за одно чтение и одну запись"""
+    data = await load(state)
+    for name, value in fields.items():
+        setattr(data, name, value)
+    await save(state, data)
+    return data
@@ -1,25 +1 @@
 # Инициализация пакета handlers
-```
-
-4. **Commit changes**
-
----
-
-**ВСЁ!** Теперь структура проекта готова! ✅
-
----
-
-## Текущая структура:
-```
-detailing-bot/
-├── requirements.txt
-├── config.py
-├── database.py
-├── states.py
-├── keyboards.py
-├── parser.py
-├── main.py
-└── handlers/
-    ├── __init__.py
-    ├── client.py
-    └── admin.py
@@ -1,13 +1,21 @@
+import asyncio
 import logging
+from datetime import timedelta
 from aiogram import Router, F
-from aiogram.filters import Command
-from aiogram.types import Message, CallbackQuery
+from aiogram.filters import Command, CommandObject
+from aiogram.types import Message, CallbackQuery, BufferedInputFile
 from sqlalchemy.orm import Session
-from sqlalchemy import desc
+from sqlalchemy import desc, func
 
+import broadcast
+import cache
+import cards
 import config
-from database import User, Lead, LeadStatus
-from keyboards import get_lead_card_buttons, get_leads_menu, get_admin_dialog_buttons
+import reports
+import search
+import slots
+from database import Broadcast, User, Lead, LeadStatus
+from keyboards import get_broadcast_confirm_buttons, get_broadcast_progress_buttons, get_leads_menu, get_search_results_buttons
 
 router = Router()
 logger = logging.getLogger(__name__)
@@ -18,89 +26,10 @@ def is_admin(user_id: int) -> bool:
     return user_id in [config.ADMIN_CHAT_ID, config.OWNER_CHAT_ID]
 
 
-# ==================== ОТПРАВКА КАРТОЧКИ ЛИДА АДМИНУ ====================
-
-async def send_lead_card_to_admin(bot, lead: Lead, user: User):
-    """
-    Отправить карточку лида администратору
-    
-    Args:
-        bot: Экземпляр бота
-        lead: Объект лида
-        user: Объект пользователя (клиента)
-    """
-    
-    # Формируем заголовок
-    if lead.is_urgent:
-        header = "🚨 ЕДЕТ СЕЙЧАС!"
-    else:
-        header = "🆕 Новая заявка"
-    
-    # Формируем текст карточки
-    service_names = {
-        "ppf": "Оклейка плёнкой (PPF)",
-        "color_ppf": "Цветная полиуретановая плёнка",
-        "vinyl": "Винил (смена цвета)",
-        "polish": "Реставрация ЛКП",
-        "ceramic": "Керамика",
-        "wash": "Мойка",
-        "tint": "Тонировка",
-        "cleaning": "Химчистка"
-    }
-    
-    service_name = service_names.get(lead.service, lead.service or "Не указана")
-    
-    card_text = f"{header}\n\n"
-    card_text += f"👤 Клиент: {user.first_name or 'Не указано'}"
-    
-    if user.username:
-        card_text += f" (@{user.username})"
-    
-    card_text += f"\n\n📋 Услуга: {service_name}"
-    
-    if lead.service_variant:
-        card_text += f"\nВариант: {lead.service_variant}"
-    
-    # Авто
-    if lead.car_brand:
-        card_text += f"\n\n🚗 Авто: {lead.car_brand}"
-        if lead.car_model:
-            card_text += f" {lead.car_model}"
-        if lead.car_year:
-            card_text += f" ({lead.car_year} г.)"
-    
-    # Когда удобно
-    if lead.preferred_time:
-        card_text += f"\n\n⏰ Когда удобно: {lead.preferred_time}"
-    
-    # Телефон
-    if lead.phone:
-        card_text += f"\n\n📞 Телефон: {lead.phone}"
-    
-    # Цель/комментарий
-    if lead.goal:
-        card_text += f"\n\n💬 Комментарий: {lead.goal}"
-    
-    # Отправляем админу
-    await bot.send_message(
-        chat_id=config.ADMIN_CHAT_ID,
-        text=card_text,
-        reply_markup=get_lead_card_buttons(lead.id)
-    )
-    
-    # Если срочная заявка — отправляем владельцу
-    if lead.is_urgent and config.OWNER_CHAT_ID != config.ADMIN_CHAT_ID:
-        await bot.send_message(
-            chat_id=config.OWNER_CHAT_ID,
-            text=card_text,
-            reply_markup=get_lead_card_buttons(lead.id)
-        )
-
-
 # ==================== КОМАНДА /LEADS (СПИСОК ЗАЯВОК) ====================
 
 @router.message(Command("leads"))
-async def cmd_leads(message: Message, db_session):
+async def cmd_leads(message: Message, db_read_session):
     """Команда /leads - список заявок для админа"""
     
     # Проверка прав
@@ -108,7 +37,7 @@ async def cmd_leads(message: Message, db_session):
         await message.answer("У вас нет доступа к этой команде.")
         return
     
-    db: Session = db_session()
+    db: Session = db_read_session()
     
     try:
         # Считаем заявки
@@ -126,51 +55,337 @@ async def cmd_leads(message: Message, db_session):
         db.close()
 
 
+# ==================== КОМАНДА /REPORT (ОТЧЁТ ДЛЯ ВЛАДЕЛЬЦА) ====================
+
+def build_report_sync(db_session, builder, days: int = None):
+    """Построить отчёт в отдельном потоке (полный проход по таблице)"""
+    since = datetime.utcnow() - timedelta(days=days) if days else None
+    db: Session = db_session()
+    try:
+        return builder(db, since=since)
+    finally:
+        db.close()
+
+
+@router.message(Command("report"))
+async def cmd_report(message: Message, command: CommandObject, db_read_session):
+    """
+    Команда /report [дней] [csv] - отчёт по воронке и скорости ответа
+
+    Примеры: /report, /report 30, /report 7 csv
+    """
+    if not is_admin(message.from_user.id):
+        await message.answer("У вас нет доступа к этой команде.")
+        return
+    
+    args = (command.args or "").split()
+    days = next((int(arg) for arg in args if arg.isdigit()), None)
+    with_files = "csv" in args
+    
+    # Проход по всем заявкам не должен блокировать event loop
+    loop = asyncio.get_running_loop()
+    report = await loop.run_in_executor(None, build_report_sync, db_read_session, reports.build_report, days)
+    
+    await message.answer(report.as_text())
+    
+    if with_files:
+        for name, columns in report.tables().items():
+            await message.answer_document(
+                BufferedInputFile(reports.table_to_csv(columns), filename=f"{name}.csv")
+            )
+
+
+@router.message(Command("funnel"))
+async def cmd_funnel(message: Message, command: CommandObject, db_read_session):
+    """Команда /funnel [дней] - где клиенты бросают заявку"""
+    if not is_admin(message.from_user.id):
+        await message.answer("У вас нет доступа к этой команде.")
+        return
+    
+    args = (command.args or "").split()
+    days = next((int(arg) for arg in args if arg.isdigit()), None)
+    
+    loop = asyncio.get_running_loop()
+    report = await loop.run_in_executor(None, build_report_sync, db_read_session, reports.build_funnel_report, days)
+    
+    await message.answer(report.as_text())
+
+
+# ==================== КОМАНДА /FIND (ПОИСК ПО ЗАЯВКАМ) ====================
+
+STATUS_ICONS = {
+    LeadStatus.NEW: "🆕",
+    LeadStatus.IN_WORK: "🔧",
+    LeadStatus.COMPLETED: "🏁",
+    LeadStatus.REJECTED: "❌",
+}
+
+
+def find_leads_sync(db_session, query: str, limit: int = 10) -> list:
+    """Найти заявки и подтянуть их клиентов: [(lead, user или None)]"""
+    db: Session = db_session()
+    try:
+        found = search.leads.find(db, query, limit)
+        ids = [lead_id for lead_id, _ in found]
+        leads = {lead.id: lead for lead in db.query(Lead).filter(Lead.id.in_(ids))}
+        users = {
+            user.user_id: user
+            for user in db.query(User).filter(User.user_id.in_([lead.user_id for lead in leads.values()]))
+        }
+        db.expunge_all()
+        return [(leads[lead_id], users.get(leads[lead_id].user_id)) for lead_id in ids if lead_id in leads]
+    finally:
+        db.close()
+
+
+def format_search_result(lead: Lead, user: User) -> str:
+    car = " ".join(filter(None, (lead.car_brand, lead.car_model))) or "авто не указано"
+    name = (user.first_name or user.username) if user else None
+    line = f"{STATUS_ICONS.get(lead.status, '')} #{lead.id} · {car}"
+    if lead.phone:
+        line += f" · {lead.phone}"
+    if name:
+        line += f" · {name}"
+    if lead.created_at:
+        line += f" · {lead.created_at:%d.%m.%Y}"
+    return line
+
+
+@router.message(Command("find"))
+async def cmd_find(message: Message, command: CommandObject, db_read_session):
+    """
+    Команда /find <запрос> - поиск по заявкам и переписке
+
+    Примеры: /find белая камри, /find 4567, /find скол на капоте
+    """
+    if not is_admin(message.from_user.id):
+        await message.answer("У вас нет доступа к этой команде.")
+        return
+    
+    query = (command.args or "").strip()
+    if not query:
+        await message.answer("Что ищем? Например: /find белая камри или /find 4567")
+        return
+    
+    loop = asyncio.get_running_loop()
+    results = await loop.run_in_executor(None, find_leads_sync, db_read_session, query)
+    
+    if not results:
+        await message.answer(f"По запросу «{query}» ничего не найдено")
+        return
+    
+    text = f"🔎 «{query}»:\n\n" + "\n".join(format_search_result(lead, user) for lead, user in results)
+    await message.answer(text, reply_markup=get_search_results_buttons([lead.id for lead, _ in results]))
+
+
+@router.callback_query(F.data.startswith("find_card_"))
+async def show_found_lead(callback: CallbackQuery, db_session, db_read_session):
+    """Карточка заявки из результатов /find"""
+    
+    if not is_admin(callback.from_user.id):
+        await callback.answer("У вас нет доступа", show_alert=True)
+        return
+    
+    lead_id = int(callback.data.split("_")[-1])
+    
+    db: Session = db_read_session()
+    
+    try:
+        lead = db.query(Lead).filter(Lead.id == lead_id).first()
+        
+        if not lead:
+            await callback.answer("Заявка не найдена", show_alert=True)
+            return
+        
+        await show_lead_cards(callback, db_session, [lead.id])
+    
+    finally:
+        db.close()
+
+
+# ==================== КОМАНДА /BROADCAST (РАССЫЛКА) ====================
+
+@router.message(Command("broadcast"))
+async def cmd_broadcast(message: Message, command: CommandObject, db_session):
+    """
+    Команда /broadcast <текст> - рассылка всем пользователям бота
+
+    Ответом на сообщение (/broadcast без текста) — рассылается копия
+    этого сообщения (фото, форматирование). Перед отправкой — подтверждение.
+    """
+    if not is_admin(message.from_user.id):
+        await message.answer("У вас нет доступа к этой команде.")
+        return
+    
+    text = (command.args or "").strip()
+    source = message.reply_to_message
+    if not text and not source:
+        await message.answer("Напишите /broadcast <текст> или ответьте командой /broadcast на сообщение для рассылки")
+        return
+    
+    db: Session = db_session()
+    
+    try:
+        draft = Broadcast(
+            text=text or None,
+            source_chat_id=source.chat.id if source and not text else None,
+            source_message_id=source.message_id if source and not text else None,
+            created_by=message.from_user.id,
+            total=broadcast.count_recipients(db),
+        )
+        db.add(draft)
+        db.commit()
+        
+        preview = f"«{text}»" if text else "сообщение, на которое вы ответили"
+        await message.answer(
+            f"📣 Рассылка #{draft.id}: {preview}\n\nПолучателей: {draft.total}. Отправить?",
+            reply_markup=get_broadcast_confirm_buttons(draft.id, draft.total),
+        )
+    
+    finally:
+        db.close()
+
+
+@router.callback_query(F.data.startswith("broadcast_start_"))
+async def broadcast_start(callback: CallbackQuery, db_session):
+    """Админ подтвердил рассылку"""
+    
+    if not is_admin(callback.from_user.id):
+        await callback.answer("У вас нет доступа", show_alert=True)
+        return
+    
+    broadcast_id = int(callback.data.split("_")[-1])
+    
+    db: Session = db_session()
+    
+    try:
+        # Только из черновика: повторное нажатие не запустит рассылку дважды
+        started = db.query(Broadcast).filter(
+            Broadcast.id == broadcast_id, Broadcast.status == "draft"
+        ).update({
+            "status": "running",
+            "started_at": datetime.utcnow(),
+            "progress_chat_id": callback.message.chat.id,
+            "progress_message_id": callback.message.message_id,
+        })
+        db.commit()
+        
+        if not started:
+            await callback.answer("Рассылка уже запущена или отменена", show_alert=True)
+            return
+        
+        item = db.query(Broadcast).filter(Broadcast.id == broadcast_id).first()
+        await callback.message.edit_text(
+            broadcast.format_progress(item),
+            reply_markup=get_broadcast_progress_buttons(broadcast_id),
+        )
+        broadcast.runner.wake()
+        await callback.answer("Рассылка запущена")
+    
+    finally:
+        db.close()
+
+
+@router.callback_query(F.data.startswith("broadcast_stop_"))
+async def broadcast_stop(callback: CallbackQuery, db_session):
+    """Отмена черновика или остановка идущей рассылки"""
+    
+    if not is_admin(callback.from_user.id):
+        await callback.answer("У вас нет доступа", show_alert=True)
+        return
+    
+    broadcast_id = int(callback.data.split("_")[-1])
+    
+    db: Session = db_session()
+    
+    try:
+        stopped = db.query(Broadcast).filter(
+            Broadcast.id == broadcast_id, Broadcast.status.in_(["draft", "running"])
+        ).update({"status": "cancelled", "finished_at": datetime.utcnow()})
+        db.commit()
+        
+        if stopped:
+            # Идущая пачка досылается, дальше рассылка не продолжится
+            item = db.query(Broadcast).filter(Broadcast.id == broadcast_id).first()
+            await callback.message.edit_text(broadcast.format_progress(item))
+            await callback.answer("Рассылка остановлена")
+        else:
+            await callback.answer("Рассылка уже завершена")
+    
+    finally:
+        db.close()
+
+
 # ==================== КНОПКИ СПИСКА ЗАЯВОК ====================
 
+async def show_lead_cards(callback: CallbackQuery, db_session, lead_ids: list):
+    """
+    Карточки в чат админа: уже отправленные сюда не дублируются, а обновляются.
+
+    Список выбирается на реплике, а сами заявки читаются с primary: реплика
+    отстаёт, и правка карточки на месте вернула бы взятой заявке кнопку «взять».
+    """
+    db: Session = db_session()
+    try:
+        leads = {lead.id: lead for lead in db.query(Lead).filter(Lead.id.in_(lead_ids))}
+        users = {
+            user.user_id: user
+            for user in db.query(User).filter(User.user_id.in_({lead.user_id for lead in leads.values()}))
+        }
+        pairs = [
+            (leads[lead_id], users[leads[lead_id].user_id])
+            for lead_id in lead_ids
+            if lead_id in leads and leads[lead_id].user_id in users
+        ]
+        already_shown = await cards.show(callback.bot, db, pairs, callback.message.chat.id)
+    finally:
+        db.close()
+    
+    if already_shown:
+        await callback.answer(f"Уже в чате выше (обновлены): {len(already_shown)}")
+    else:
+        await callback.answer()
+
+
 @router.callback_query(F.data == "leads_new")
-async def show_new_leads(callback: CallbackQuery, db_session):
+async def show_new_leads(callback: CallbackQuery, db_session, db_read_session):
     """Показать новые заявки"""
     
     if not is_admin(callback.from_user.id):
         await callback.answer("У вас нет доступа", show_alert=True)
         return
     
-    db: Session = db_session()
+    db: Session = db_read_session()
     
     try:
         # Получаем новые заявки
+        # Красные флаги — первыми, среди них — с более высокой оценкой
         leads = db.query(Lead).filter(
             Lead.status == LeadStatus.NEW
-        ).order_by(desc(Lead.created_at)).limit(10).all()
+        ).order_by(
+            desc(Lead.is_red_flag), desc(func.coalesce(Lead.red_flag_score, 0)), desc(Lead.created_at)
+        ).limit(10).all()
         
         if not leads:
             await callback.message.answer("Нет новых заявок")
             await callback.answer()
             return
         
-        # Формируем карточки
-        for lead in leads:
-            user = db.query(User).filter(User.user_id == lead.user_id).first()
-            
-            if user:
-                await send_lead_card_to_admin(callback.bot, lead, user)
-        
-        await callback.answer()
+        await show_lead_cards(callback, db_session, [lead.id for lead in leads])
     
     finally:
         db.close()
 
 
 @router.callback_query(F.data == "leads_in_work")
-async def show_in_work_leads(callback: CallbackQuery, db_session):
+async def show_in_work_leads(callback: CallbackQuery, db_session, db_read_session):
     """Показать заявки в работе"""
     
     if not is_admin(callback.from_user.id):
         await callback.answer("У вас нет доступа", show_alert=True)
         return
     
-    db: Session = db_session()
+    db: Session = db_read_session()
     
     try:
         # Получаем заявки в работе
@@ -183,14 +398,7 @@ async def show_in_work_leads(callback: CallbackQuery, db_session):
             await callback.answer()
             return
         
-        # Формируем карточки
-        for lead in leads:
-            user = db.query(User).filter(User.user_id == lead.user_id).first()
-            
-            if user:
-                await send_lead_card_to_admin(callback.bot, lead, user)
-        
-        await callback.answer()
+        await show_lead_cards(callback, db_session, [lead.id for lead in leads])
     
     finally:
         db.close()
@@ -218,10 +426,10 @@ async def admin_set_in_work(callback: CallbackQuery, db_session):
             lead.updated_at = datetime.utcnow()
             db.commit()
             
-            await callback.message.edit_text(
-                callback.message.text + "\n\n✅ Взято в работу",
-                reply_markup=None
-            )
+            # Обновляем все карточки этой заявки (у админа и владельца)
+            user = db.query(User).filter(User.user_id == lead.user_id).first()
+            if user:
+                await cards.refresh(callback.bot, db, lead, user, clicked=callback.message)
             
             await callback.answer("Заявка в работе")
         else:
@@ -251,10 +459,13 @@ async def admin_reject_lead(callback: CallbackQuery, db_session):
             lead.updated_at = datetime.utcnow()
             db.commit()
             
-            await callback.message.edit_text(
-                callback.message.text + "\n\n❌ Отказ",
-                reply_markup=None
-            )
+            # Бокс, занятый под заявку, освобождается
+            slots.engine.release(db, lead.id)
+            
+            # Обновляем все карточки этой заявки (у админа и владельца)
+            user = db.query(User).filter(User.user_id == lead.user_id).first()
+            if user:
+                await cards.refresh(callback.bot, db, lead, user, clicked=callback.message)
             
             await callback.answer("Заявка отклонена")
         else:
@@ -293,16 +504,15 @@ async def admin_start_reply(callback: CallbackQuery, db_session):
         user.in_admin_dialog = True
         user.admin_dialog_lead_id = lead_id
         db.commit()
+        cache.hot.remember_lead(user.user_id, lead_id)
         
         # Меняем статус лида
         lead.status = LeadStatus.IN_WORK
+        lead.updated_at = datetime.utcnow()
         db.commit()
         
-        # Обновляем карточку админа
-        await callback.message.edit_text(
-            callback.message.text + "\n\n💬 Диалог открыт",
-            reply_markup=get_admin_dialog_buttons(lead_id)
-        )
+        # Обновляем карточки заявки: "Диалог открыт" + кнопка завершения
+        await cards.refresh(callback.bot, db, lead, user, clicked=callback.message)
         
         # Уведомляем админа
         await callback.message.answer(
@@ -1,19 +1,37 @@
 import logging
+import uuid
 from datetime import datetime, timedelta
 from aiogram import Router, F
 from aiogram.filters import Command, StateFilter
-from aiogram.types import Message
+from aiogram.types import CallbackQuery, Message
 from aiogram.fsm.context import FSMContext
+from aiogram.fsm.state import State
+from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.orm import Session
 
+import ai
+import cache
+import cards
+import clients
 import config
+import faq
+import funnel_state
+import lead_score
+import logging_setup
+import media
 import parser
+import reminders
+import slots
+import spool
+import telemetry
 from database import User, Lead, Message as DBMessage, LeadStatus
-from states import MainMenu, PPFFlow
+from states import MainMenu, PPFFlow, FAQFlow
 from keyboards import (
     get_main_menu,
+    get_faq_keyboard,
     get_ppf_variants,
     get_ppf_zones_examples,
+    get_slot_buttons,
 )
 
 router = Router()
@@ -31,62 +49,158 @@ def get_user_name(message: Message) -> str:
     return "друг"
 
 
+# Функции ниже не падают, если БД недоступна (spool.py): данные воронки
+# остаются в FSM, сообщения уходят в локальный журнал, заявка — в finish_lead_collection.
+
+def db_failed(db: Session, e: Exception, action: str):
+    db.rollback()
+    logger.warning("БД недоступна (%s): %s", action, e)
+
+
 async def get_or_create_user(db: Session, user_id: int, username: str = None, first_name: str = None, last_name: str = None) -> User:
-    """Получить или создать пользователя"""
-    user = db.query(User).filter(User.user_id == user_id).first()
-    
-    if not user:
-        user = User(
-            user_id=user_id,
-            username=username,
-            first_name=first_name,
-            last_name=last_name
-        )
-        db.add(user)
-        db.commit()
-        db.refresh(user)
-    
+    """Получить или создать пользователя (None — БД недоступна)"""
+    try:
+        user = db.query(User).filter(User.user_id == user_id).first()
+        
+        if not user:
+            user = User(
+                user_id=user_id,
+                username=username,
+                first_name=first_name,
+                last_name=last_name
+            )
+            db.add(user)
+            db.commit()
+            db.refresh(user)
+        elif user.is_blocked:
+            # Пишет боту — значит, разблокировал: снова получает рассылки
+            user.is_blocked = False
+            db.commit()
+    except SQLAlchemyError as e:
+        db_failed(db, e, "пользователь")
+        return None
+    
+    cache.hot.remember_user(user_id)
     return user
 
 
-async def save_message(db: Session, user_id: int, text: str, lead_id: int = None, is_from_admin: bool = False):
-    """Сохранить сообщение в историю"""
+async def save_message(db: Session, user_id: int, text: str, lead_id: int = None, is_from_admin: bool = False, message_type: str = "text", spool_key: str = None):
+    """
+    Сохранить сообщение в историю (БД недоступна — в локальный журнал).
+
+    spool_key — ключ воронки без заявки в БД: при переносе журнала сообщение попадёт в её заявку.
+    """
     msg = DBMessage(
         user_id=user_id,
         text=text,
         lead_id=lead_id,
-        is_from_admin=is_from_admin
+        is_from_admin=is_from_admin,
+        message_type=message_type,
+        created_at=datetime.utcnow()
     )
-    db.add(msg)
-    db.commit()
+    # Оценка красного флага — в памяти, в заявку попадёт при её завершении
+    if lead_id and text and not is_from_admin and message_type == "text":
+        lead_score.scorer.observe(lead_id, text)
+    try:
+        db.add(msg)
+        db.commit()
+    except SQLAlchemyError as e:
+        db_failed(db, e, "сообщение")
+        spool.journal.append("message", {
+            "user_id": user_id,
+            "text": text,
+            "lead_id": lead_id,
+            "is_from_admin": is_from_admin,
+            "message_type": message_type,
+            "spool_key": spool_key,
+            "created_at": msg.created_at.isoformat(),
+        })
 
 
 async def get_or_create_lead(db: Session, user_id: int) -> Lead:
-    """Получить активный лид или создать новый"""
-    # Ищем активный лид (NEW или IN_WORK)
-    lead = db.query(Lead).filter(
-        Lead.user_id == user_id,
-        Lead.status.in_([LeadStatus.NEW, LeadStatus.IN_WORK])
-    ).order_by(Lead.created_at.desc()).first()
-    
-    if not lead:
-        lead = Lead(user_id=user_id)
-        db.add(lead)
-        db.commit()
-        db.refresh(lead)
-    
+    """Получить активный лид или создать новый (None — БД недоступна)"""
+    try:
+        # Активный лид из кэша — выборка по первичному ключу; статус мог смениться
+        lead = None
+        cached_id = cache.hot.active_lead(user_id)
+        if cached_id:
+            lead = db.get(Lead, cached_id)
+            if lead and lead.status not in (LeadStatus.NEW, LeadStatus.IN_WORK):
+                lead = None
+        
+        # Ищем активный лид (NEW или IN_WORK)
+        if not lead:
+            lead = db.query(Lead).filter(
+                Lead.user_id == user_id,
+                Lead.status.in_([LeadStatus.NEW, LeadStatus.IN_WORK])
+            ).order_by(Lead.created_at.desc()).first()
+        
+        if not lead:
+            lead = Lead(user_id=user_id)
+            db.add(lead)
+            db.commit()
+            db.refresh(lead)
+            lead_score.scorer.new_lead(lead.id)
+    except SQLAlchemyError as e:
+        db_failed(db, e, "заявка")
+        return None
+    
+    cache.hot.remember_lead(user_id, lead.id)
     return lead
 
 
+def get_lead(db: Session, lead_id: int) -> Lead:
+    """Лид по id (None — нет такого или БД недоступна)"""
+    if not lead_id:
+        return None
+    try:
+        return db.query(Lead).filter(Lead.id == lead_id).first()
+    except SQLAlchemyError as e:
+        db_failed(db, e, "заявка")
+        return None
+
+
 async def update_lead_data(db: Session, lead: Lead, **kwargs):
-    """Обновить данные лида"""
-    for key, value in kwargs.items():
-        if value is not None:
-            setattr(lead, key, value)
+    """Обновить данные лида (при недоступной БД — пропускаем: данные есть в FSM)"""
+    if lead is None:
+        return
     
-    lead.updated_at = datetime.utcnow()
-    db.commit()
-    db.refresh(lead)
+    try:
+        for key, value in kwargs.items():
+            if value is not None:
+                setattr(lead, key, value)
+        
+        # Новый телефон — ищем клиента с этим номером (повторное обращение)
+        if kwargs.get("phone"):
+            clients.link_lead(db, lead)
+        
+        lead.updated_at = datetime.utcnow()
+        db.commit()
+        db.refresh(lead)
+    except SQLAlchemyError as e:
+        db_failed(db, e, "данные заявки")
+
+
+async def attach_spool_key(db: Session, funnel: funnel_state.FunnelData, lead: Lead):
+    """
+    Заявки нет (БД недоступна) — завести воронке ключ журнала, по нему заявку создаст перенос.
+    Заявка есть, а ключ уже заведён — отдать его заявке: записанные без БД сообщения придут в неё.
+    """
+    if lead is None:
+        funnel.spool_key = funnel.spool_key or uuid.uuid4().hex
+    elif funnel.spool_key and not lead.spool_key:
+        await update_lead_data(db, lead, spool_key=funnel.spool_key)
+
+
+async def set_step(state: FSMContext, step: State, user_id: int, lead_id: int = None):
+    """Перейти на шаг воронки и записать событие телеметрии"""
+    await state.set_state(step)
+    telemetry.funnel.step(user_id, step.state, lead_id)
+    # Застрянет на шаге воронки — напомним (каждый новый шаг переносит напоминание)
+    if step in PPFFlow:
+        reminders.schedule_funnel_nudge(user_id, step.state)
+    if lead_id:
+        logging_setup.bind(lead_id=lead_id)
 
 
 def check_antispam(db: Session, user_id: int) -> tuple[bool, str]:
@@ -121,79 +235,6 @@ def check_antispam(db: Session, user_id: int) -> tuple[bool, str]:
     return True, ""
 
 
-async def send_lead_card_to_admin(bot, lead: Lead, user: User):
-    """Отправить карточку лида администратору"""
-    
-    # Формируем заголовок
-    if lead.is_urgent:
-        header = "🚨 ЕДЕТ СЕЙЧАС!"
-    else:
-        header = "🆕 Новая заявка"
-    
-    # Формируем текст карточки
-    service_names = {
-        "ppf": "Оклейка плёнкой (PPF)",
-        "color_ppf": "Цветная полиуретановая плёнка",
-        "vinyl": "Винил (смена цвета)",
-        "polish": "Реставрация ЛКП",
-        "ceramic": "Керамика",
-        "wash": "Мойка",
-        "tint": "Тонировка",
-        "cleaning": "Химчистка"
-    }
-    
-    service_name = service_names.get(lead.service, lead.service or "Не указана")
-    
-    card_text = f"{header}\n\n"
-    card_text += f"👤 Клиент: {user.first_name or 'Не указано'}"
-    
-    if user.username:
-        card_text += f" (@{user.username})"
-    
-    card_text += f"\n\n📋 Услуга: {service_name}"
-    
-    if lead.service_variant:
-        card_text += f"\nВариант: {lead.service_variant}"
-    
-    # Авто
-    if lead.car_brand:
-        card_text += f"\n\n🚗 Авто: {lead.car_brand}"
-        if lead.car_model:
-            card_text += f" {lead.car_model}"
-        if lead.car_year:
-            card_text += f" ({lead.car_year} г.)"
-    
-    # Когда удобно
-    if lead.preferred_time:
-        card_text += f"\n\n⏰ Когда удобно: {lead.preferred_time}"
-    
-    # Телефон
-    if lead.phone:
-        card_text += f"\n\n📞 Телефон: {lead.phone}"
-    
-    # Цель/комментарий
-    if lead.goal:
-        card_text += f"\n\n💬 Комментарий: {lead.goal}"
-    
-    # Импортируем здесь, чтобы избежать циклического импорта
-    from keyboards import get_lead_card_buttons
-    
-    # Отправляем админу
-    await bot.send_message(
-        chat_id=config.ADMIN_CHAT_ID,
-        text=card_text,
-        reply_markup=get_lead_card_buttons(lead.id)
-    )
-    
-    # Если срочная заявка — отправляем владельцу
-    if lead.is_urgent and config.OWNER_CHAT_ID != config.ADMIN_CHAT_ID:
-        await bot.send_message(
-            chat_id=config.OWNER_CHAT_ID,
-            text=card_text,
-            reply_markup=get_lead_card_buttons(lead.id)
-        )
-
-
 # ==================== ОБРАБОТЧИК /START ====================
 
 @router.message(Command("start"))
@@ -202,17 +243,20 @@ async def cmd_start(message: Message, state: FSMContext, db_session):
     db: Session = db_session()
     
     try:
-        # Создаём/обновляем пользователя
-        await get_or_create_user(
-            db,
-            user_id=message.from_user.id,
-            username=message.from_user.username,
-            first_name=message.from_user.first_name,
-            last_name=message.from_user.last_name
-        )
+        # Создаём/обновляем пользователя (уже известного после прогрева — без запроса)
+        if not cache.hot.user_known(message.from_user.id):
+            await get_or_create_user(
+                db,
+                user_id=message.from_user.id,
+                username=message.from_user.username,
+                first_name=message.from_user.first_name,
+                last_name=message.from_user.last_name
+            )
         
         # Сбрасываем состояние
         await state.clear()
+        telemetry.funnel.leave(message.from_user.id, "restart")
+        reminders.cancel_funnel_nudge(message.from_user.id)
         
         name = get_user_name(message)
         
@@ -223,7 +267,7 @@ async def cmd_start(message: Message, state: FSMContext, db_session):
             reply_markup=get_main_menu()
         )
         
-        await state.set_state(MainMenu.choosing_service)
+        await set_step(state, MainMenu.choosing_service, message.from_user.id)
         
     finally:
         db.close()
@@ -235,13 +279,15 @@ async def cmd_start(message: Message, state: FSMContext, db_session):
 async def back_to_menu(message: Message, state: FSMContext):
     """Возврат в главное меню"""
     await state.clear()
+    telemetry.funnel.leave(message.from_user.id, "menu")
+    reminders.cancel_funnel_nudge(message.from_user.id)
     
     await message.answer(
         "Выберите услугу:",
         reply_markup=get_main_menu()
     )
     
-    await state.set_state(MainMenu.choosing_service)
+    await set_step(state, MainMenu.choosing_service, message.from_user.id)
 
 
 # ==================== PPF (ОКЛЕЙКА ПЛЁНКОЙ) ====================
@@ -255,7 +301,7 @@ async def ppf_start(message: Message, state: FSMContext):
         reply_markup=get_ppf_variants()
     )
     
-    await state.set_state(PPFFlow.choosing_variant)
+    await set_step(state, PPFFlow.choosing_variant, message.from_user.id)
 
 
 @router.message(PPFFlow.choosing_variant, F.text.in_([
@@ -271,15 +317,16 @@ async def ppf_variant_selected(message: Message, state: FSMContext, db_session):
     try:
         variant = message.text
         
-        # Сохраняем вариант в state
-        await state.update_data(service="ppf", service_variant=variant)
-        
         # Создаём/получаем лид
         lead = await get_or_create_lead(db, message.from_user.id)
         await update_lead_data(db, lead, service="ppf", service_variant=variant)
         
-        # Сохраняем ID лида в state
-        await state.update_data(lead_id=lead.id)
+        # Вариант и ID лида — в state (БД недоступна — заявка будет создана из журнала в конце)
+        lead_id = lead.id if lead else None
+        funnel = await funnel_state.load(state)
+        funnel.service, funnel.service_variant, funnel.lead_id = "ppf", variant, lead_id
+        await attach_spool_key(db, funnel, lead)
+        await funnel_state.save(state, funnel)
         
         # Разная логика в зависимости от варианта
         if variant == "Зоны риска":
@@ -288,7 +335,7 @@ async def ppf_variant_selected(message: Message, state: FSMContext, db_session):
                 "Вы можете выбрать из примеров или описать своими словами:",
                 reply_markup=get_ppf_zones_examples()
             )
-            await state.set_state(PPFFlow.asking_zones)
+            await set_step(state, PPFFlow.asking_zones, message.from_user.id, lead_id)
         
         elif variant == "Матовый полиуретан":
             await message.answer(
@@ -296,7 +343,7 @@ async def ppf_variant_selected(message: Message, state: FSMContext, db_session):
                 "Мат или сатин подберём на осмотре, дадим образцы, сравните на кузове.\n\n"
                 "Подскажите марку, модель и год вашего автомобиля:"
             )
-            await state.set_state(PPFFlow.collecting_car)
+            await set_step(state, PPFFlow.collecting_car, message.from_user.id, lead_id)
         
         else:
             # База или Вкруг
@@ -313,7 +360,52 @@ async def ppf_variant_selected(message: Message, state: FSMContext, db_session):
                     "Подскажите марку, модель и год автомобиля:"
                 )
             
-            await state.set_state(PPFFlow.collecting_car)
+            await set_step(state, PPFFlow.collecting_car, message.from_user.id, lead_id)
+    
+    finally:
+        db.close()
+
+
+# ==================== ФОТО АВТО ====================
+# Регистрируется раньше текстовых шагов воронки: они ждут message.text
+
+@router.message(
+    StateFilter(PPFFlow),
+    F.photo | F.document.mime_type.startswith("image/"),
+)
+async def funnel_photo(message: Message, state: FSMContext, db_session):
+    """Фото авто/повреждений на любом шаге воронки — прикрепляем к заявке"""
+    db: Session = db_session()
+    
+    try:
+        funnel = await funnel_state.load(state)
+        lead_id = funnel.lead_id
+        
+        # Фото прислали раньше, чем выбрали вариант — заявку заводим сейчас
+        if not lead_id:
+            lead = await get_or_create_lead(db, message.from_user.id)
+            lead_id = lead.id if lead else None
+            funnel.lead_id = lead_id
+            await attach_spool_key(db, funnel, lead)
+            await funnel_state.save(state, funnel)
+        logging_setup.bind(lead_id=lead_id)
+        
+        await save_message(db, message.from_user.id, message.caption, lead_id, message_type="photo", spool_key=funnel.spool_key)
+        
+        try:
+            if not lead_id:
+                raise spool.DatabaseUnavailable("no lead for photo")
+            await media.photos.intake(message, db, lead_id)
+        except ValueError:
+            await message.answer("Файл слишком большой 🙏 Пришлите, пожалуйста, фото поменьше (до 20 МБ).")
+            return
+        except SQLAlchemyError as e:
+            db_failed(db, e, "фото")
+            await message.answer("Фото сейчас не сохранилось 🙏 Продолжим заявку, а фото пришлите администратору, когда он позвонит.")
+            return
+        
+        if media.photos.first_in_album(message):
+            await message.answer("Фото добавлено к заявке 👍 Продолжим — ответьте, пожалуйста, на вопрос выше.")
     
     finally:
         db.close()
@@ -328,21 +420,23 @@ async def ppf_zones_selected(message: Message, state: FSMContext, db_session):
         zones = message.text
         
         # Сохраняем
-        data = await state.get_data()
-        lead_id = data.get("lead_id")
+        funnel = await funnel_state.load(state)
+        lead_id = funnel.lead_id
+        logging_setup.bind(lead_id=lead_id)
         
         if lead_id:
-            lead = db.query(Lead).filter(Lead.id == lead_id).first()
+            lead = get_lead(db, lead_id)
             if lead:
                 await update_lead_data(db, lead, goal=zones)
         
-        await state.update_data(zones=zones)
+        funnel.zones = zones
+        await funnel_state.save(state, funnel)
         
         await message.answer(
             "Понял. Подскажите марку, модель и год автомобиля:"
         )
         
-        await state.set_state(PPFFlow.collecting_car)
+        await set_step(state, PPFFlow.collecting_car, message.from_user.id)
     
     finally:
         db.close()
@@ -360,9 +454,10 @@ async def ppf_collect_car(message: Message, state: FSMContext, db_session):
         parsed = parser.parse_message(text)
         
         # Сохраняем сообщение
-        data = await state.get_data()
-        lead_id = data.get("lead_id")
-        await save_message(db, message.from_user.id, text, lead_id)
+        funnel = await funnel_state.load(state)
+        lead_id = funnel.lead_id
+        logging_setup.bind(lead_id=lead_id)
+        await save_message(db, message.from_user.id, text, lead_id, spool_key=funnel.spool_key)
         
         # Проверяем наличие авто
         if parsed["car"]:
@@ -370,7 +465,7 @@ async def ppf_collect_car(message: Message, state: FSMContext, db_session):
             
             # Обновляем лид
             if lead_id:
-                lead = db.query(Lead).filter(Lead.id == lead_id).first()
+                lead = get_lead(db, lead_id)
                 if lead:
                     await update_lead_data(
                         db, lead,
@@ -379,34 +474,49 @@ async def ppf_collect_car(message: Message, state: FSMContext, db_session):
                         car_year=car["year"]
                     )
             
-            await state.update_data(
-                car_brand=car["brand"],
-                car_model=car["model"],
-                car_year=car["year"]
-            )
+            funnel.car_brand = car["brand"]
+            funnel.car_model = car["model"]
+            funnel.car_year = car["year"]
             
             # Проверяем телефон и время
             if parsed["phone"]:
-                await state.update_data(phone=parsed["phone"])
+                funnel.phone = parsed["phone"]
                 if lead_id:
-                    lead = db.query(Lead).filter(Lead.id == lead_id).first()
+                    lead = get_lead(db, lead_id)
                     if lead:
                         await update_lead_data(db, lead, phone=parsed["phone"])
             
             if parsed["datetime"]:
-                await state.update_data(preferred_time=parsed["datetime"])
+                funnel.preferred_time = parsed["datetime"]
                 if lead_id:
-                    lead = db.query(Lead).filter(Lead.id == lead_id).first()
+                    lead = get_lead(db, lead_id)
                     if lead:
                         await update_lead_data(db, lead, preferred_time=parsed["datetime"])
             
-            # Переходим к времени
-            await message.answer(
-                f"Отлично, {car['brand']} {car['model']} {car['year']}.\n\n"
-                "Когда вам удобно заехать? (например: завтра после 18, в пятницу утром)"
-            )
+            await funnel_state.save(state, funnel)
+            
+            # Переходим к времени: свободные слоты кнопками, можно и текстом
+            free_slots = []
+            try:
+                slots.engine.ensure_loaded(db)
+                free_slots = slots.engine.free_slots(funnel.service)
+            except Exception as e:
+                logger.warning("Свободные слоты не получены: %s", e)
+            
+            if free_slots:
+                await message.answer(
+                    f"Отлично, {car['brand']} {car['model']} {car['year']}.\n\n"
+                    "Когда вам удобно заехать? Выберите свободное время "
+                    "или напишите своё (например: завтра после 18, в пятницу утром)",
+                    reply_markup=get_slot_buttons(free_slots)
+                )
+            else:
+                await message.answer(
+                    f"Отлично, {car['brand']} {car['model']} {car['year']}.\n\n"
+                    "Когда вам удобно заехать? (например: завтра после 18, в пятницу утром)"
+                )
             
-            await state.set_state(PPFFlow.collecting_time)
+            await set_step(state, PPFFlow.collecting_time, message.from_user.id)
         
         else:
             # Год не найден
@@ -431,9 +541,10 @@ async def ppf_collect_time(message: Message, state: FSMContext, db_session):
         parsed = parser.parse_message(text)
         
         # Сохраняем сообщение
-        data = await state.get_data()
-        lead_id = data.get("lead_id")
-        await save_message(db, message.from_user.id, text, lead_id)
+        funnel = await funnel_state.load(state)
+        lead_id = funnel.lead_id
+        logging_setup.bind(lead_id=lead_id)
+        await save_message(db, message.from_user.id, text, lead_id, spool_key=funnel.spool_key)
         
         # Извлекаем дату/время
         preferred_time = parsed["datetime"] if parsed["datetime"] else text
@@ -447,45 +558,110 @@ async def ppf_collect_time(message: Message, state: FSMContext, db_session):
             return
         
         # Сохраняем
-        await state.update_data(preferred_time=preferred_time)
+        funnel.preferred_time = preferred_time
         
         if lead_id:
-            lead = db.query(Lead).filter(Lead.id == lead_id).first()
+            lead = get_lead(db, lead_id)
             if lead:
                 await update_lead_data(db, lead, preferred_time=preferred_time)
         
         # Проверяем телефон из парсинга
         if parsed["phone"]:
-            await state.update_data(phone=parsed["phone"])
+            funnel.phone = parsed["phone"]
             if lead_id:
-                lead = db.query(Lead).filter(Lead.id == lead_id).first()
+                lead = get_lead(db, lead_id)
                 if lead:
                     await update_lead_data(db, lead, phone=parsed["phone"])
         
         # Проверяем срочность
         if parsed["is_urgent"]:
-            await state.update_data(is_urgent=True)
+            funnel.is_urgent = True
             if lead_id:
-                lead = db.query(Lead).filter(Lead.id == lead_id).first()
+                lead = get_lead(db, lead_id)
                 if lead:
                     await update_lead_data(db, lead, is_urgent=True)
         
-        # Переходим к телефону
-        phone = (await state.get_data()).get("phone")
+        await funnel_state.save(state, funnel)
+        await ask_phone_or_finish(message, state, db, message.from_user.id, funnel)
+    
+    finally:
+        db.close()
+
+
+async def ask_phone_or_finish(message: Message, state: FSMContext, db: Session, user_id: int, funnel: funnel_state.FunnelData):
+    """Время есть — спросить телефон или, если он уже известен, завершить заявку"""
+    if funnel.phone:
+        # Телефон уже есть — завершаем
+        await finish_lead_collection(message, state, db, user_id, funnel)
+    else:
+        await message.answer(
+            "Хорошо. Напишите, пожалуйста, номер телефона для подтверждения записи:"
+        )
+        await set_step(state, PPFFlow.collecting_phone, user_id)
+
+
+@router.callback_query(PPFFlow.collecting_time, F.data.startswith("slot_"))
+async def ppf_pick_slot(callback: CallbackQuery, state: FSMContext, db_session):
+    """Клиент выбрал свободный слот кнопкой"""
+    # callback data присылает клиент: бокс и время проверяет ещё и slots.engine.book
+    try:
+        _, bay, stamp = callback.data.split("_")
+        bay, start = int(bay), datetime.strptime(stamp, "%Y%m%d%H%M")
+    except ValueError:
+        await callback.answer()
+        return
+    user_id = callback.from_user.id
+    
+    db: Session = db_session()
+    
+    try:
+        funnel = await funnel_state.load(state)
+        lead_id = funnel.lead_id
+        logging_setup.bind(lead_id=lead_id)
+        try:
+            if not lead_id:
+                raise spool.DatabaseUnavailable("no lead for booking")
+            slots.engine.ensure_loaded(db)
+            booking = slots.engine.book(db, lead_id, funnel.service, bay, start)
+        except SQLAlchemyError as e:
+            db_failed(db, e, "запись на время")
+            await callback.answer("Не получилось записать 🙏 Напишите удобное время сообщением", show_alert=True)
+            return
+        
+        if booking is None:
+            # Слот успели занять — предлагаем актуальные
+            free_slots = slots.engine.free_slots(funnel.service)
+            await callback.message.edit_reply_markup(reply_markup=get_slot_buttons(free_slots) if free_slots else None)
+            await callback.answer("Это время уже заняли, выберите другое", show_alert=True)
+            return
         
-        if phone:
-            # Телефон уже есть — завершаем
-            await finish_lead_collection(message, state, db)
-        else:
-            await message.answer(
-                "Хорошо. Напишите, пожалуйста, номер телефона для подтверждения записи:"
-            )
-            await state.set_state(PPFFlow.collecting_phone)
+        preferred_time = slots.format_slot(start)
+        funnel.preferred_time = preferred_time
+        await funnel_state.save(state, funnel)
+        lead = get_lead(db, lead_id)
+        if lead:
+            await update_lead_data(db, lead, preferred_time=preferred_time)
+        await save_message(db, user_id, preferred_time, lead_id)
+        
+        # Напомним о визите за сутки и за 2 часа
+        reminders.schedule_visit_reminder(lead_id, user_id, start)
+        
+        await callback.message.edit_reply_markup(reply_markup=None)
+        await callback.answer()
+        await callback.message.answer(f"Записали вас: {preferred_time} ✅")
+        
+        await ask_phone_or_finish(callback.message, state, db, user_id, funnel)
     
     finally:
         db.close()
 
 
+@router.callback_query(F.data.startswith("slot_"))
+async def stale_slot(callback: CallbackQuery):
+    """Кнопка слота из старого сообщения (заявка уже отправлена или начата заново)"""
+    await callback.answer("Выбор времени уже неактуален", show_alert=True)
+
+
 @router.message(PPFFlow.collecting_phone)
 async def ppf_collect_phone(message: Message, state: FSMContext, db_session):
     """Сбор телефона для PPF"""
@@ -505,36 +681,36 @@ async def ppf_collect_phone(message: Message, state: FSMContext, db_session):
             return
         
         # Сохраняем
-        await state.update_data(phone=phone)
-        
-        data = await state.get_data()
-        lead_id = data.get("lead_id")
+        funnel = await funnel_state.update(state, phone=phone)
+        lead_id = funnel.lead_id
+        logging_setup.bind(lead_id=lead_id)
         
         if lead_id:
-            lead = db.query(Lead).filter(Lead.id == lead_id).first()
+            lead = get_lead(db, lead_id)
             if lead:
                 await update_lead_data(db, lead, phone=phone)
         
         # Завершаем сбор
-        await finish_lead_collection(message, state, db)
+        await finish_lead_collection(message, state, db, message.from_user.id, funnel)
     
     finally:
         db.close()
 
 
-async def finish_lead_collection(message: Message, state: FSMContext, db: Session):
-    """Завершение сбора данных и отправка админу"""
-    data = await state.get_data()
-    
-    lead_id = data.get("lead_id")
-    car_brand = data.get("car_brand", "")
-    car_model = data.get("car_model", "")
-    car_year = data.get("car_year", "")
-    preferred_time = data.get("preferred_time", "")
-    phone = data.get("phone", "")
-    service = data.get("service", "")
-    service_variant = data.get("service_variant", "")
-    is_urgent = data.get("is_urgent", False)
+async def finish_lead_collection(message: Message, state: FSMContext, db: Session, user_id: int, funnel: funnel_state.FunnelData):
+    """
+    Завершение сбора данных и отправка админу.
+
+    user_id — клиент (message может быть сообщением бота, если шаг завершён кнопкой).
+    """
+    lead_id = funnel.lead_id
+    logging_setup.bind(lead_id=lead_id)
+    car_brand = funnel.car_brand or ""
+    car_model = funnel.car_model or ""
+    car_year = funnel.car_year or ""
+    preferred_time = funnel.preferred_time or ""
+    phone = funnel.phone or ""
+    is_urgent = funnel.is_urgent
     
     # Финальное сообщение клиенту
     await message.answer(
@@ -556,22 +732,140 @@ async def finish_lead_collection(message: Message, state: FSMContext, db: Sessio
     )
     
     # Отправка карточки админу
-    if lead_id:
-        lead = db.query(Lead).filter(Lead.id == lead_id).first()
-        user = db.query(User).filter(User.user_id == message.from_user.id).first()
-        
-        if lead and user:
-            await send_lead_card_to_admin(message.bot, lead, user)
+    lead = user = None
+    try:
+        if lead_id:
+            lead = db.query(Lead).filter(Lead.id == lead_id).first()
+        user = db.query(User).filter(User.user_id == user_id).first()
+        # Красный флаг — отдельным commit до карточки: не держать UPDATE открытым на время запросов к Telegram
+        if lead and lead_score.scorer.apply(db, lead):
+            db.commit()
+    except SQLAlchemyError as e:
+        db_failed(db, e, "завершение заявки")
+    
+    if lead and user:
+        await cards.send_to_admins(message.bot, db, lead, user)
+        # Фото, присланные по ходу воронки, — альбомом к карточке
+        await media.photos.send_to_admins(message.bot, db, lead.id)
+        # Не возьмут в работу — напомним админу
+        reminders.schedule_admin_followup(lead.id)
+    else:
+        # БД недоступна: заявка — в локальный журнал, в БД и карточкой админу уйдёт после восстановления
+        from_client = message.from_user.id == user_id
+        spool.journal.append("lead", {
+            "lead_id": lead_id,
+            # Ключ — и для идемпотентности: перенос, прерванный после commit, второй заявки не создаст
+            "spool_key": None if lead_id else funnel.spool_key or uuid.uuid4().hex,
+            "user_id": user_id,
+            "user": {
+                "username": message.from_user.username if from_client else None,
+                "first_name": message.from_user.first_name if from_client else None,
+                "last_name": message.from_user.last_name if from_client else None,
+            },
+            "fields": {
+                "service": funnel.service,
+                "service_variant": funnel.service_variant,
+                "goal": funnel.zones,
+                "car_brand": car_brand or None,
+                "car_model": car_model or None,
+                "car_year": car_year or None,
+                "preferred_time": preferred_time or None,
+                "phone": phone or None,
+                "is_urgent": is_urgent,
+            },
+            "created_at": datetime.utcnow().isoformat(),
+        })
+        await message.bot.send_message(
+            config.ADMIN_CHAT_ID,
+            f"{'🚨 ЕДЕТ СЕЙЧАС! ' if is_urgent else ''}🆕 Заявка принята без БД (карточка придёт после восстановления)\n\n"
+            f"Авто: {car_brand} {car_model} {car_year}\n"
+            f"Когда: {preferred_time}\n"
+            f"Телефон: {phone}"
+        )
     
     # Сбрасываем состояние
     await state.clear()
+    telemetry.funnel.leave(user_id, "completed")
+    reminders.cancel_funnel_nudge(user_id)
     
     await message.answer(
         "Если есть ещё вопросы — пишите! 😊",
         reply_markup=get_main_menu()
     )
     
-    await state.set_state(MainMenu.choosing_service)
+    await set_step(state, MainMenu.choosing_service, user_id)
+
+
+# ==================== ВОПРОСЫ (FAQ) ====================
+
+@router.message(MainMenu.choosing_service, F.text == "❓ Задать вопрос")
+async def faq_start(message: Message, state: FSMContext):
+    """Начало режима вопросов"""
+    await message.answer(
+        "Напишите ваш вопрос — постараюсь ответить сразу.\n\n"
+        "Например: какие варианты оклейки, как записаться, где вы находитесь.",
+        reply_markup=get_faq_keyboard()
+    )
+    
+    await set_step(state, FAQFlow.asking, message.from_user.id)
+
+
+@router.message(FAQFlow.asking, F.text)
+async def faq_question(message: Message, db_session):
+    """Ответ на вопрос по базе знаний"""
+    db: Session = db_session()
+    
+    try:
+        text = message.text
+        await save_message(db, message.from_user.id, text)
+        
+        answer = faq.index.answer(text)
+        
+        if answer:
+            await message.answer(
+                f"{answer}\n\n"
+                "Если остались вопросы — пишите. Чтобы записаться, вернитесь в главное меню."
+            )
+            return
+        
+        # Нет в базе знаний — пробуем ИИ (если включён). Ответ генерируется отдельной задачей:
+        # хендлер не держит воркер планировщика, пока модель отвечает (до AI_TIMEOUT)
+        if ai.replies:
+            prompt = ai.replies.build_context(db, message.from_user.id, text)
+            ai.replies.spawn(answer_with_ai(message, prompt, db_session))
+            return
+        
+        await forward_question_to_admin(message)
+    
+    finally:
+        db.close()
+
+
+async def answer_with_ai(message: Message, prompt: ai.Prompt, db_session):
+    """Ответ ИИ вне хендлера; модель не ответила — вопрос администратору"""
+    ai_answer = await ai.replies.reply(message, prompt)
+    if not ai_answer:
+        await forward_question_to_admin(message)
+        return
+    
+    db: Session = db_session()
+    try:
+        await save_message(db, message.from_user.id, ai_answer, message_type="ai")
+    finally:
+        db.close()
+
+
+async def forward_question_to_admin(message: Message):
+    await message.answer(
+        "Хороший вопрос 🙂 Передам администратору — он ответит вам в ближайшее время."
+    )
+    
+    name = get_user_name(message)
+    username = f" (@{message.from_user.username})" if message.from_user.username else ""
+    await message.bot.send_message(
+        chat_id=config.ADMIN_CHAT_ID,
+        text=f"❓ Вопрос от клиента {name}{username}:\n\n{message.text}"
+    )
 
 
 # ==================== ЗАГЛУШКИ ДЛЯ ДРУГИХ УСЛУГ ====================
@@ -162,13 +162,24 @@ def get_cleaning_zones() -> ReplyKeyboardMarkup:
     return kb.as_markup(resize_keyboard=True)
 
 
+# ==================== ВОПРОСЫ (FAQ) ====================
+
+def get_faq_keyboard() -> ReplyKeyboardMarkup:
+    """Клавиатура в режиме вопросов"""
+    kb = ReplyKeyboardBuilder()
+    kb.button(text="🏠 В главное меню")
+    kb.adjust(1)
+    return kb.as_markup(resize_keyboard=True)
+
+
 # ==================== АДМИНСКИЕ КНОПКИ ====================
 
-def get_lead_card_buttons(lead_id: int) -> InlineKeyboardMarkup:
-    """Кнопки под карточкой лида для админа"""
+def get_lead_card_buttons(lead_id: int, in_work: bool = False) -> InlineKeyboardMarkup:
+    """Кнопки под карточкой лида для админа (у заявки в работе — без "В работу")"""
     kb = InlineKeyboardBuilder()
     kb.button(text="💬 Ответить клиенту", callback_data=f"admin_reply_{lead_id}")
-    kb.button(text="✅ В работу", callback_data=f"admin_in_work_{lead_id}")
+    if not in_work:
+        kb.button(text="✅ В работу", callback_data=f"admin_in_work_{lead_id}")
     kb.button(text="❌ Отказ", callback_data=f"admin_reject_{lead_id}")
     kb.adjust(1)
     return kb.as_markup()
@@ -189,3 +200,39 @@ def get_leads_menu() -> InlineKeyboardMarkup:
     kb.button(text="🔧 В работе", callback_data="leads_in_work")
     kb.adjust(1)
     return kb.as_markup()
+
+
+def get_search_results_buttons(lead_ids: list) -> InlineKeyboardMarkup:
+    """Кнопки "открыть карточку" под результатами /find"""
+    kb = InlineKeyboardBuilder()
+    for lead_id in lead_ids:
+        kb.button(text=f"#{lead_id}", callback_data=f"find_card_{lead_id}")
+    kb.adjust(5)
+    return kb.as_markup()
+
+
+def get_broadcast_confirm_buttons(broadcast_id: int, recipients: int) -> InlineKeyboardMarkup:
+    """Подтверждение рассылки"""
+    kb = InlineKeyboardBuilder()
+    kb.button(text=f"▶️ Отправить ({recipients})", callback_data=f"broadcast_start_{broadcast_id}")
+    kb.button(text="✖️ Отмена", callback_data=f"broadcast_stop_{broadcast_id}")
+    kb.adjust(1)
+    return kb.as_markup()
+
+
+def get_broadcast_progress_buttons(broadcast_id: int) -> InlineKeyboardMarkup:
+    """Кнопка под прогрессом идущей рассылки"""
+    kb = InlineKeyboardBuilder()
+    kb.button(text="⏹ Остановить", callback_data=f"broadcast_stop_{broadcast_id}")
+    return kb.as_markup()
+
+
+def get_slot_buttons(free_slots: list) -> InlineKeyboardMarkup:
+    """Свободные слоты записи: [(бокс, начало)]"""
+    from slots import format_slot
+
+    kb = InlineKeyboardBuilder()
+    for bay, start in free_slots:
+        kb.button(text=format_slot(start), callback_data=f"slot_{bay}_{start:%Y%m%d%H%M}")
+    kb.adjust(2)
+    return kb.as_markup()
@@ -0,0 +1,527 @@
+"""
+Классификатор красных флагов заявки (претензии, сложные и нестандартные кейсы).
+
+parser.is_red_flag — список подстрок: пропускает перефразировки
+("плёнка отошла через месяц") и срабатывает на лишнем ("хамелеон" в обычном
+вопросе о цвете). Здесь — логистическая регрессия на тех же хешированных
+n-граммах, что и faq.embed (плюс пары слов), обученная на размеченных
+заявках. Без внешних моделей и сети, только NumPy.
+
+- Текст заявки — сообщения клиента по ней одной строкой (и комментарий).
+- Оценка 0..1 → Lead.red_flag_score, is_red_flag — оценка не ниже порога,
+  подобранного при обучении (лучший F1 на отложенной части разметки).
+- Оценка идёт пачкой: признаки всех текстов — в одном массиве, сумма весов
+  по строкам — один np.bincount. Хеши слова кэшируются, потому что слова
+  в переписке повторяются.
+- Нет файла модели (или NumPy) — флаг по parser.is_red_flag, оценка не пишется;
+  так же — пока модель грузится в фоне (main.py), observe её не ждёт.
+- Текст заявки в боте копится в памяти по сообщениям; заявки нет в кэше
+  (перезапуск, вытеснение) — apply собирает его заново из БД (lead_texts).
+
+    python lead_score.py export leads.csv            # тексты заявок с текущими флагами — на разметку
+    python lead_score.py train leads.csv [more.csv]  # колонки text,label → LEAD_SCORE_MODEL
+    python lead_score.py rescore [--all]             # пересчитать оценки открытых (или всех) заявок
+    python lead_score.py bench                       # время оценки одного сообщения
+"""
+import argparse
+import csv
+import logging
+import os
+import sys
+import time
+import zlib
+from collections import OrderedDict
+from functools import lru_cache
+from typing import TYPE_CHECKING, Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple
+
+from sqlalchemy import select, update
+from sqlalchemy.orm import Session
+
+import config
+import metrics
+import parser
+from database import Lead, LeadStatus, Message
+from faq import ngram_features, normalize
+
+if TYPE_CHECKING:
+    import numpy as np
+
+logger = logging.getLogger(__name__)
+
+SCORE_LATENCY = metrics.Histogram(
+    "bot_lead_score_seconds",
+    "Оценка текста заявки классификатором красных флагов",
+    buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01),
+)
+
+DIM = 1 << 18
+FORMAT_VERSION = 1
+
+# Дальше текст заявки не смотрим: суть претензии — в начале, а время оценки растёт с длиной
+MAX_TEXT_CHARS = 2000
+
+
+# ==================== ПРИЗНАКИ ====================
+
+@lru_cache(maxsize=100000)
+def _word_hashes(word: str) -> Tuple[int, ...]:
+    return tuple(zlib.crc32(feature.encode("utf-8")) for feature in ngram_features(word))
+
+
+def _hashes(text: str) -> List[int]:
+    words = normalize(text[:MAX_TEXT_CHARS]).split()
+    hashes = []
+    for word in words:
+        hashes.extend(_word_hashes(word))
+    # Пары слов: "не приехал", "плёнка отошла"
+    for first, second in zip(words, words[1:]):
+        hashes.append(zlib.crc32(f"b:{first} {second}".encode("utf-8")))
+    return hashes
+
+
+def featurize(texts: Sequence[str], dim: int = DIM) -> tuple:
+    """
+    Пачка текстов → разреженная матрица тройками (строка, колонка, значение).
+
+    Знак — старший бит хеша (как в faq.embed), строка нормирована
+    на корень из числа признаков: длинный текст не «перевешивает» короткий.
+    """
+    import numpy as np
+
+    per_text = [_hashes(text) for text in texts]
+    lengths = np.fromiter((len(hashes) for hashes in per_text), dtype=np.int64, count=len(per_text))
+    hashes = np.fromiter(
+        (h for text_hashes in per_text for h in text_hashes), dtype=np.uint32, count=int(lengths.sum())
+    )
+    rows = np.repeat(np.arange(len(per_text)), lengths)
+    cols = (hashes % dim).astype(np.int64)
+    scale = (1.0 / np.sqrt(np.maximum(lengths, 1))).astype(np.float32)
+    values = np.where(hashes & 0x80000000, -1.0, 1.0).astype(np.float32) * scale[rows]
+    return rows, cols, values
+
+
+def _sigmoid(margin: "np.ndarray") -> "np.ndarray":
+    import numpy as np
+
+    return 1.0 / (1.0 + np.exp(-np.clip(margin, -30.0, 30.0)))
+
+
+# ==================== МОДЕЛЬ ====================
+
+class RedFlagModel:
+    """Линейная модель над хешированными признаками"""
+
+    def __init__(self, weights: "np.ndarray", bias: float, threshold: float = 0.5):
+        self.weights = weights
+        self.bias = float(bias)
+        self.threshold = float(threshold)
+
+    @property
+    def dim(self) -> int:
+        return len(self.weights)
+
+    def _margin(self, rows, cols, values, n: int) -> "np.ndarray":
+        import numpy as np
+
+        return np.bincount(rows, weights=self.weights[cols] * values, minlength=n) + self.bias
+
+    def score_batch(self, texts: Sequence[str]) -> "np.ndarray":
+        """Оценки 0..1 для пачки текстов"""
+        import numpy as np
+
+        if not texts:
+            return np.zeros(0)
+        return _sigmoid(self._margin(*featurize(texts, self.dim), len(texts)))
+
+    def score(self, text: str) -> float:
+        return float(self.score_batch([text])[0])
+
+    @classmethod
+    def fit(
+        cls,
+        texts: Sequence[str],
+        labels: Sequence[int],
+        dim: int = DIM,
+        epochs: int = 150,
+        learning_rate: float = 0.5,
+        l2: float = 1e-5,
+    ) -> "RedFlagModel":
+        """
+        Логистическая регрессия, полный градиент + AdaGrad (у редких n-грамм —
+        свой шаг). Красных флагов в разметке мало — классы уравниваются весами.
+        """
+        import numpy as np
+
+        rows, cols, values = featurize(texts, dim)
+        y = np.asarray(labels, dtype=np.float64)
+        n = len(y)
+        positives = y.sum()
+        if not 0 < positives < n:
+            raise ValueError("в разметке нужны оба класса")
+        sample_weight = np.where(y == 1, n / (2 * positives), n / (2 * (n - positives))) / n
+
+        model = cls(np.zeros(dim, dtype=np.float64), 0.0)
+        squared = np.zeros(dim)
+        squared_bias = 0.0
+        for _ in range(epochs):
+            error = (_sigmoid(model._margin(rows, cols, values, n)) - y) * sample_weight
+            gradient = np.bincount(cols, weights=values * error[rows], minlength=dim) + l2 * model.weights
+            gradient_bias = error.sum()
+
+            squared += gradient ** 2
+            model.weights -= learning_rate * gradient / (np.sqrt(squared) + 1e-8)
+            squared_bias += gradient_bias ** 2
+            model.bias -= learning_rate * gradient_bias / (squared_bias ** 0.5 + 1e-8)
+
+        model.weights = model.weights.astype(np.float32)
+        return model
+
+    def save(self, path: str):
+        import numpy as np
+
+        # Через временный файл: бот может читать модель в этот момент
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as file:
+            np.savez_compressed(
+                file, version=FORMAT_VERSION, weights=self.weights, bias=self.bias, threshold=self.threshold
+            )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "RedFlagModel":
+        import numpy as np
+
+        with np.load(path) as data:
+            version = int(data["version"])
+            if version != FORMAT_VERSION:
+                raise ValueError(f"unknown model format version {version}")
+            return cls(data["weights"].astype(np.float32), float(data["bias"]), float(data["threshold"]))
+
+
+def best_threshold(scores: "np.ndarray", labels: "np.ndarray") -> Tuple[float, float, float, float]:
+    """Порог с лучшим F1: (порог, точность, полнота, F1)"""
+    import numpy as np
+
+    order = np.argsort(-scores, kind="stable")
+    sorted_labels = labels[order]
+    true_positives = np.cumsum(sorted_labels)
+    flagged = np.arange(1, len(scores) + 1)
+    precision = true_positives / flagged
+    recall = true_positives / max(sorted_labels.sum(), 1)
+    f1 = np.where(precision + recall > 0, 2 * precision * recall / np.maximum(precision + recall, 1e-12), 0.0)
+    best = int(np.argmax(f1))
+    # Посередине до следующей оценки, а не ровно на последнем красном флаге проверки
+    threshold = scores[order[best]]
+    if best + 1 < len(scores):
+        threshold = (threshold + scores[order[best + 1]]) / 2
+    return float(threshold), float(precision[best]), float(recall[best]), float(f1[best])
+
+
+# ==================== В БОТЕ ====================
+
+class _Observed(NamedTuple):
+    text: str
+    score: float
+    complete: bool                    # весь текст заявки (иначе — только сообщения с момента промаха кэша)
+    model: Optional[RedFlagModel]     # чем оценено; None — правилами parser
+
+
+class LeadScorer:
+    """
+    Оценка заявки по ходу воронки: каждое сообщение клиента пересчитывает
+    оценку всего текста заявки в памяти (без I/O), в Lead её переносит apply().
+    """
+
+    def __init__(self, path: str, cache_size: int = 10000):
+        self.path = path
+        self.cache_size = cache_size
+        self.model: Optional[RedFlagModel] = None
+        self._leads: "OrderedDict[int, _Observed]" = OrderedDict()
+
+    def load(self) -> bool:
+        """Загрузить модель (при старте — в потоке); False — работаем по правилам parser"""
+        if not os.path.exists(self.path):
+            logger.info("Модели красных флагов нет (%s) — флаги по правилам", self.path)
+            return False
+        try:
+            self.model = RedFlagModel.load(self.path)
+        except (ImportError, OSError, ValueError, KeyError) as e:
+            logger.warning("Модель красных флагов не загружена, флаги по правилам: %s", e)
+            return False
+        logger.info("Модель красных флагов загружена", extra={"path": self.path, "threshold": self.model.threshold})
+        return True
+
+    def _score(self, text: str) -> float:
+        started = time.perf_counter()
+        if self.model is not None:
+            score = self.model.score(text)
+        else:
+            score = 1.0 if parser.is_red_flag(text) else 0.0
+        SCORE_LATENCY.observe(time.perf_counter() - started)
+        return score
+
+    def _remember(self, lead_id: int, observed: _Observed):
+        self._leads[lead_id] = observed
+        self._leads.move_to_end(lead_id)
+        if len(self._leads) > self.cache_size:
+            self._leads.popitem(last=False)
+
+    def new_lead(self, lead_id: int):
+        """Заявка только что создана: весь её текст пройдёт через observe"""
+        self._remember(lead_id, _Observed("", 0.0, True, self.model))
+
+    def observe(self, lead_id: int, text: str) -> float:
+        """Сообщение клиента по заявке → оценка заявки"""
+        previous = self._leads.get(lead_id)
+        if previous is None:
+            # Начало текста не в памяти — полностью его соберёт apply
+            previous = _Observed("", 0.0, False, self.model)
+        lead_text = f"{previous.text}\n{text}"[:MAX_TEXT_CHARS] if previous.text else text
+
+        score = self._score(lead_text)
+        self._remember(lead_id, _Observed(lead_text, score, previous.complete, self.model))
+        return score
+
+    def apply(self, db: Session, lead: Lead) -> bool:
+        """
+        Оценку — в поля заявки (без commit); True — поля изменились.
+
+        Текста в памяти нет или он неполный — заново из БД (один запрос).
+        """
+        observed = self._leads.get(lead.id)
+        if observed is None or not observed.complete:
+            text = lead_texts(db, [lead]).get(lead.id, "")
+            observed = _Observed(text, self._score(text) if text else 0.0, True, self.model)
+            self._remember(lead.id, observed)
+        elif observed.text and observed.model is not self.model:
+            # Оценено правилами до загрузки модели
+            observed = observed._replace(score=self._score(observed.text), model=self.model)
+            self._remember(lead.id, observed)
+        if not observed.text:
+            return False
+
+        score = observed.score
+        before = (lead.red_flag_score, bool(lead.is_red_flag))
+        if self.model is not None:
+            lead.red_flag_score = round(score, 4)
+            lead.is_red_flag = score >= self.model.threshold
+        else:
+            lead.is_red_flag = score >= 0.5
+        return (lead.red_flag_score, lead.is_red_flag) != before
+
+
+scorer = LeadScorer(config.LEAD_SCORE_MODEL)
+
+
+# ==================== ЗАЯВКИ ИЗ БД ====================
+
+def lead_texts(db: Session, leads: Iterable[Lead]) -> Dict[int, str]:
+    """Текст каждой заявки: комментарий и сообщения клиента по порядку"""
+    texts = {lead.id: lead.comment for lead in leads if lead.comment}
+    rows = db.execute(
+        select(Message.lead_id, Message.text)
+        .where(
+            Message.lead_id.in_([lead.id for lead in leads]),
+            Message.is_from_admin.isnot(True),
+            Message.message_type != "ai",
+            Message.text.isnot(None),
+        )
+        .order_by(Message.id)
+    )
+    for lead_id, text in rows:
+        texts[lead_id] = f"{texts[lead_id]}\n{text}" if lead_id in texts else text
+    return {lead_id: text[:MAX_TEXT_CHARS] for lead_id, text in texts.items()}
+
+
+def _lead_batches(db: Session, only_open: bool, batch_size: int):
+    last_id = 0
+    while True:
+        query = select(Lead).where(Lead.id > last_id).order_by(Lead.id).limit(batch_size)
+        if only_open:
+            query = query.where(Lead.status.in_((LeadStatus.NEW, LeadStatus.IN_WORK)))
+        leads = db.scalars(query).all()
+        if not leads:
+            return
+        last_id = leads[-1].id
+        yield leads
+
+
+def export(db: Session, path: str, batch_size: int = 1000) -> int:
+    """Тексты заявок с текущим флагом — CSV для разметки (колонка label)"""
+    exported = 0
+    with open(path, "w", newline="", encoding="utf-8") as file:
+        writer = csv.writer(file)
+        writer.writerow(["lead_id", "label", "text"])
+        for leads in _lead_batches(db, False, batch_size):
+            texts = lead_texts(db, leads)
+            for lead in leads:
+                if lead.id in texts:
+                    writer.writerow([lead.id, int(bool(lead.is_red_flag)), texts[lead.id]])
+                    exported += 1
+            db.expunge_all()
+    return exported
+
+
+def rescore(db: Session, model: RedFlagModel, only_open: bool = True, batch_size: int = 1000, progress=print) -> int:
+    """
+    Пересчитать оценки заявок пачками: одна оценка и один UPDATE на пачку.
+
+    UPDATE по первичному ключу идёт мимо flush — событий для CRM (outbox.py) не создаёт.
+    """
+    scored = 0
+    started = time.monotonic()
+    for leads in _lead_batches(db, only_open, batch_size):
+        texts = lead_texts(db, leads)
+        lead_ids = list(texts)
+        db.expunge_all()
+        if not lead_ids:
+            continue
+
+        scores = model.score_batch([texts[lead_id] for lead_id in lead_ids])
+        db.execute(update(Lead), [
+            {"id": lead_id, "red_flag_score": round(float(score), 4), "is_red_flag": bool(score >= model.threshold)}
+            for lead_id, score in zip(lead_ids, scores)
+        ])
+        db.commit()
+        scored += len(lead_ids)
+        progress(f"  оценено {scored} ({scored / max(time.monotonic() - started, 1e-6):.0f}/с)")
+    return scored
+
+
+# ==================== ОБУЧЕНИЕ ====================
+
+LABEL_VALUES = {"1": 1, "0": 0, "true": 1, "false": 0, "да": 1, "нет": 0, "yes": 1, "no": 0}
+
+
+def read_labelled(path: str) -> Tuple[List[str], List[int]]:
+    """CSV с колонками text и label (1/0, да/нет); строки без метки пропускаются"""
+    texts, labels = [], []
+    with open(path, newline="", encoding="utf-8-sig") as file:
+        for row in csv.DictReader(file):
+            label = LABEL_VALUES.get((row.get("label") or "").strip().lower())
+            text = (row.get("text") or "").strip()
+            if label is None or not text:
+                continue
+            texts.append(text)
+            labels.append(label)
+    return texts, labels
+
+
+def train(texts: List[str], labels: List[int], holdout: float = 0.2, seed: int = 0) -> Tuple[RedFlagModel, dict]:
+    """Обучить на части разметки, порог и качество — по отложенной части"""
+    import numpy as np
+
+    y = np.asarray(labels)
+    order = np.random.default_rng(seed).permutation(len(texts))
+    split = int(len(texts) * (1 - holdout))
+    train_idx, test_idx = order[:split], order[split:]
+    if not 0 < y[test_idx].sum() < len(test_idx):
+        raise ValueError("в отложенной части нет одного из классов — нужно больше разметки")
+
+    model = RedFlagModel.fit([texts[i] for i in train_idx], y[train_idx])
+    test_texts = [texts[i] for i in test_idx]
+    threshold, precision, recall, f1 = best_threshold(model.score_batch(test_texts), y[test_idx])
+    model.threshold = threshold
+
+    # Для сравнения — правила parser на той же части
+    rules = np.fromiter((parser.is_red_flag(text) for text in test_texts), dtype=bool, count=len(test_texts))
+    rule_hits = (rules & (y[test_idx] == 1)).sum()
+    stats = {
+        "train": len(train_idx),
+        "test": len(test_idx),
+        "positives": int(y.sum()),
+        "threshold": round(threshold, 4),
+        "precision": round(precision, 3),
+        "recall": round(recall, 3),
+        "f1": round(f1, 3),
+        "rules_precision": round(rule_hits / max(rules.sum(), 1), 3),
+        "rules_recall": round(rule_hits / max(y[test_idx].sum(), 1), 3),
+    }
+    return model, stats
+
+
+# ==================== CLI ====================
+
+def bench(model: RedFlagModel, samples: int = 2000) -> dict:
+    """Время оценки: по одному сообщению (как в боте) и пачкой"""
+    texts = [
+        f"Здравствуйте, у меня Toyota Camry {2010 + i % 14}, хочу оклеить капот и фары плёнкой, "
+        f"можно в субботу после {10 + i % 8}? Сообщение {i}"
+        for i in range(samples)
+    ]
+    started = time.perf_counter()
+    for text in texts:
+        model.score(text)
+    single = (time.perf_counter() - started) / samples
+
+    _word_hashes.cache_clear()
+    started = time.perf_counter()
+    model.score_batch(texts)
+    batch = (time.perf_counter() - started) / samples
+    return {"single_ms": round(single * 1000, 3), "batch_ms": round(batch * 1000, 3)}
+
+
+def main():
+    from database import init_db
+
+    arg_parser = argparse.ArgumentParser(description="Классификатор красных флагов заявок")
+    arg_parser.add_argument("--database-url", default=config.DATABASE_URL)
+    arg_parser.add_argument("--model", default=config.LEAD_SCORE_MODEL)
+    commands = arg_parser.add_subparsers(dest="command", required=True)
+
+    export_parser = commands.add_parser("export", help="Тексты заявок в CSV для разметки")
+    export_parser.add_argument("output")
+    train_parser = commands.add_parser("train", help="Обучить по размеченным CSV (text,label)")
+    train_parser.add_argument("files", nargs="+")
+    train_parser.add_argument("--holdout", type=float, default=0.2)
+    rescore_parser = commands.add_parser("rescore", help="Пересчитать оценки заявок в БД")
+    rescore_parser.add_argument("--all", action="store_true", help="Все заявки, а не только новые и в работе")
+    rescore_parser.add_argument("--batch-size", type=int, default=1000)
+    commands.add_parser("bench", help="Время оценки одного сообщения")
+    args = arg_parser.parse_args()
+
+    if args.command == "train":
+        texts, labels = [], []
+        for path in args.files:
+            file_texts, file_labels = read_labelled(path)
+            texts += file_texts
+            labels += file_labels
+        try:
+            model, stats = train(texts, labels, args.holdout)
+        except ValueError as e:
+            print(e, file=sys.stderr)
+            sys.exit(1)
+        model.save(args.model)
+        print(
+            f"Примеров: {stats['train']} + {stats['test']} на проверку, красных флагов: {stats['positives']}\n"
+            f"Порог {stats['threshold']}: точность {stats['precision']}, полнота {stats['recall']}, F1 {stats['f1']}\n"
+            f"Правила parser: точность {stats['rules_precision']}, полнота {stats['rules_recall']}\n"
+            f"Модель: {args.model}"
+        )
+        return
+
+    if args.command in ("rescore", "bench"):
+        if not os.path.exists(args.model):
+            arg_parser.error(f"нет модели {args.model} — сначала train")
+        model = RedFlagModel.load(args.model)
+        if args.command == "bench":
+            stats = bench(model)
+            print(f"Одно сообщение: {stats['single_ms']} мс, в пачке: {stats['batch_ms']} мс на текст")
+            return
+
+    if not args.database_url:
+        arg_parser.error("DATABASE_URL не установлен")
+    engine, SessionLocal = init_db(args.database_url)
+    db = SessionLocal()
+    try:
+        if args.command == "export":
+            print(f"Заявок выгружено: {export(db, args.output)} → {args.output}")
+        else:
+            print(f"Заявок оценено: {rescore(db, model, not args.all, args.batch_size)}")
+    finally:
+        db.close()
+        engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,351 @@
+"""
+Импорт старых заявок (до бота) из CSV-выгрузок таблиц.
+
+    python legacy_import.py leads_2022.csv leads_2023.csv [--workers 4] [--batch-size 5000]
+    python legacy_import.py export.csv --encoding cp1251 --dry-run
+
+Файл читается потоком, пачками по batch-size строк; в памяти не больше
+2 × workers пачек, так что размер файла не важен.
+
+- Колонки ищутся по заголовку (COLUMN_ALIASES: "Телефон", "phone", "Марка", ...);
+  авто — одной колонкой ("Toyota Camry 2020") или марка/модель/год отдельно.
+- Нормализация — те же функции parser, что и в воронке; пачки разбираются
+  в пуле процессов (регулярки parser — чистый Python, векторизовать нечего),
+  даты — с кэшем: в выгрузках они повторяются.
+- Строки без распознанного телефона пропускаются. Телефон → клиент
+  (clients.py); у старого клиента нет Telegram, поэтому пользователь
+  заводится с user_id = -client_id (рассылки таких пропускают).
+- Повторный запуск не дублирует: у заявки — import_key, хеш её содержимого
+  (телефон, дата из файла, авто, услуга, комментарий); такая уже в базе — пропуск.
+  Строки без даты получают дату импорта, но в ключ она не входит: разные
+  заявки без даты не склеиваются, а повторный запуск их не задваивает.
+  События для CRM (outbox.py) импорт не создаёт.
+- Загрузка: в Postgres — COPY, иначе — INSERT пачкой (executemany);
+  одна транзакция на пачку.
+"""
+import argparse
+import csv
+import hashlib
+import io
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from functools import lru_cache
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from sqlalchemy import insert, select
+from sqlalchemy.orm import Session
+
+import clients
+import parser
+from database import Lead, LeadStatus, User, insert_ignore
+
+# Поле заявки → возможные заголовки колонок (без регистра и пробелов по краям)
+COLUMN_ALIASES = {
+    "phone": ("phone", "телефон", "тел", "номер телефона", "номер"),
+    "name": ("name", "имя", "клиент", "фио"),
+    "car": ("car", "авто", "автомобиль", "машина"),
+    "car_brand": ("brand", "car_brand", "марка"),
+    "car_model": ("model", "car_model", "модель"),
+    "car_year": ("year", "car_year", "год"),
+    "service": ("service", "услуга"),
+    "comment": ("comment", "комментарий", "примечание"),
+    "status": ("status", "статус"),
+    "created_at": ("date", "created_at", "дата", "дата обращения"),
+}
+
+STATUS_ALIASES = {
+    "new": LeadStatus.NEW, "новая": LeadStatus.NEW,
+    "in_work": LeadStatus.IN_WORK, "в работе": LeadStatus.IN_WORK,
+    "completed": LeadStatus.COMPLETED, "выполнена": LeadStatus.COMPLETED, "приехал": LeadStatus.COMPLETED,
+    "rejected": LeadStatus.REJECTED, "отказ": LeadStatus.REJECTED, "не приехал": LeadStatus.REJECTED,
+}
+
+DATE_FORMATS = ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d", "%d.%m.%Y %H:%M", "%d.%m.%Y", "%d.%m.%y", "%d/%m/%Y")
+
+# Колонки leads, которые заполняет импорт (порядок — как в COPY)
+LEAD_COLUMNS = (
+    "user_id", "client_id", "service", "car_brand", "car_model", "car_year", "phone", "comment",
+    "is_urgent", "is_red_flag", "status", "created_at", "updated_at", "completed_at", "import_key",
+)
+
+# Нормализованная строка: (phone, name, service, brand, model, year, comment, is_red_flag, status, created_at, import_key)
+Record = tuple
+
+
+# ==================== НОРМАЛИЗАЦИЯ (в процессах пула) ====================
+
+@lru_cache(maxsize=65536)
+def parse_date(text: str) -> Optional[datetime]:
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(text, date_format)
+        except ValueError:
+            continue
+    return None
+
+
+def row_key(phone, created_at, brand, model, year, service, comment) -> str:
+    """import_key заявки. Статус и имя в ключ не входят: в следующей выгрузке они могут быть уже другими"""
+    return hashlib.sha256("\x1f".join(
+        "" if value is None else str(value)
+        for value in (phone, created_at and created_at.isoformat(), brand, model, year, service, comment)
+    ).encode("utf-8")).hexdigest()
+
+
+def _car(row: List[str], columns: Dict[str, int]) -> Tuple[Optional[str], Optional[str], Optional[int]]:
+    if "car_brand" in columns:
+        year = _cell(row, columns, "car_year")
+        year = int(year) if year and year.isdigit() and parser.validate_car_year(int(year)) else None
+        return _cell(row, columns, "car_brand"), _cell(row, columns, "car_model"), year
+
+    text = _cell(row, columns, "car")
+    if not text:
+        return None, None, None
+    car = parser.parse_car(text)
+    if car:
+        return car["brand"], car["model"] or None, car["year"]
+    # Без года parser авто не признаёт — в таблице это всё равно марка и модель
+    words = text.split()
+    return words[0], " ".join(words[1:]) or None, None
+
+
+def _cell(row: List[str], columns: Dict[str, int], field: str) -> Optional[str]:
+    index = columns.get(field)
+    if index is None or index >= len(row):
+        return None
+    return row[index].strip() or None
+
+
+def normalize_batch(rows: List[List[str]], columns: Dict[str, int], default_status: str) -> Tuple[List[Record], Dict[str, int]]:
+    """Сырые строки CSV → записи для загрузки и счётчики отбраковки"""
+    records = []
+    stats = {"no_phone": 0, "no_date": 0}
+    fallback_status = LeadStatus[default_status.upper()]
+
+    for row in rows:
+        phone = parser.parse_phone(_cell(row, columns, "phone") or "")
+        if not phone or not parser.validate_phone(phone):
+            stats["no_phone"] += 1
+            continue
+
+        created_at = parse_date(_cell(row, columns, "created_at") or "")
+        if created_at is None:
+            stats["no_date"] += 1
+
+        brand, model, year = _car(row, columns)
+        comment = _cell(row, columns, "comment")
+        status = STATUS_ALIASES.get((_cell(row, columns, "status") or "").lower(), fallback_status)
+        service = _cell(row, columns, "service")
+
+        records.append((
+            phone,
+            _cell(row, columns, "name"),
+            service,
+            brand,
+            model,
+            year,
+            comment,
+            parser.is_red_flag(comment) if comment else False,
+            status.name,
+            created_at,
+            row_key(phone, created_at, brand, model, year, service, comment),
+        ))
+    return records, stats
+
+
+# ==================== ЗАГРУЗКА В БД ====================
+
+def _copy_leads(db: Session, rows: List[tuple]):
+    """COPY ... FROM STDIN в транзакции сессии (psycopg2)"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow(["" if value is None else value for value in row])
+    buffer.seek(0)
+    cursor = db.connection().connection.cursor()
+    try:
+        # Пустое без кавычек в FORMAT csv — NULL
+        cursor.copy_expert(f"COPY leads ({', '.join(LEAD_COLUMNS)}) FROM STDIN WITH (FORMAT csv)", buffer)
+    finally:
+        cursor.close()
+
+
+def load_batch(db: Session, records: List[Record], default_date: datetime) -> Dict[str, int]:
+    """Клиенты, пользователи и заявки одной пачки — одной транзакцией"""
+    client_ids = clients.client_ids(db, (record[0] for record in records))
+
+    # Уже загруженные (повторный запуск, та же строка в нескольких файлах)
+    keys = {record[10] for record in records}
+    existing = set(db.scalars(select(Lead.import_key).where(Lead.import_key.in_(keys)))) if keys else set()
+
+    users = {}
+    leads = []
+    for phone, name, service, brand, model, year, comment, red_flag, status, created_at, import_key in records:
+        if import_key in existing:
+            continue
+        existing.add(import_key)
+        client_id = client_ids[phone]
+        created_at = created_at or default_date
+
+        users.setdefault(-client_id, {"user_id": -client_id, "first_name": name, "created_at": created_at})
+        closed = status in (LeadStatus.COMPLETED.name, LeadStatus.REJECTED.name)
+        leads.append((
+            -client_id, client_id, service, brand, model, year, phone, comment,
+            False, red_flag, status, created_at, created_at, created_at if closed else None, import_key,
+        ))
+
+    insert_ignore(db, User, list(users.values()))
+    if leads:
+        if db.get_bind().dialect.name == "postgresql":
+            _copy_leads(db, leads)
+        else:
+            db.execute(insert(Lead.__table__), [
+                dict(zip(LEAD_COLUMNS, row), status=LeadStatus[row[10]]) for row in leads
+            ])
+    db.commit()
+    return {"imported": len(leads), "duplicates": len(records) - len(leads)}
+
+
+# ==================== ЧТЕНИЕ ====================
+
+def resolve_columns(header: List[str]) -> Dict[str, int]:
+    names = [name.strip().lower() for name in header]
+    columns = {}
+    for field, aliases in COLUMN_ALIASES.items():
+        for alias in aliases:
+            if alias in names:
+                columns[field] = names.index(alias)
+                break
+    return columns
+
+
+def read_batches(path: str, encoding: str, delimiter: Optional[str], batch_size: int) -> Iterator:
+    """(колонки, пачка строк) — файл читается потоком"""
+    with open(path, newline="", encoding=encoding) as file:
+        if delimiter is None:
+            sample = file.read(65536)
+            file.seek(0)
+            try:
+                delimiter = csv.Sniffer().sniff(sample, delimiters=",;\t").delimiter
+            except csv.Error:
+                delimiter = ","
+        reader = csv.reader(file, delimiter=delimiter)
+        columns = resolve_columns(next(reader, []))
+        if "phone" not in columns:
+            raise ValueError(f"{path}: нет колонки с телефоном (ожидается одна из: {', '.join(COLUMN_ALIASES['phone'])})")
+
+        batch = []
+        for row in reader:
+            batch.append(row)
+            if len(batch) >= batch_size:
+                yield columns, batch
+                batch = []
+        if batch:
+            yield columns, batch
+
+
+def import_files(
+    db: Optional[Session],
+    paths: List[str],
+    workers: int = 0,
+    batch_size: int = 5000,
+    encoding: str = "utf-8-sig",
+    delimiter: Optional[str] = None,
+    default_status: str = "completed",
+    progress=print,
+) -> dict:
+    """
+    Импортировать файлы; db=None — только разбор (проверка файла).
+
+    Пачки разбираются в пуле по порядку чтения; загрузка — в этом процессе,
+    пока пул разбирает следующие.
+    """
+    stats = {"rows": 0, "imported": 0, "duplicates": 0, "no_phone": 0, "no_date": 0}
+    default_date = datetime.utcnow().replace(microsecond=0)
+    started = time.monotonic()
+    pool = ProcessPoolExecutor(max_workers=workers) if workers > 0 else None
+
+    def consume(records: List[Record], batch_stats: Dict[str, int]):
+        for key, value in batch_stats.items():
+            stats[key] += value
+        if db is not None:
+            for key, value in load_batch(db, records, default_date).items():
+                stats[key] += value
+        elapsed = max(time.monotonic() - started, 1e-6)
+        progress(
+            f"  строк {stats['rows']}, загружено {stats['imported']}, "
+            f"дублей {stats['duplicates']}, без телефона {stats['no_phone']} ({stats['rows'] / elapsed:.0f}/с)"
+        )
+
+    try:
+        for path in paths:
+            progress(f"{path}:")
+            in_flight = deque()
+            for columns, rows in read_batches(path, encoding, delimiter, batch_size):
+                stats["rows"] += len(rows)
+                if pool is None:
+                    consume(*normalize_batch(rows, columns, default_status))
+                    continue
+                in_flight.append(pool.submit(normalize_batch, rows, columns, default_status))
+                if len(in_flight) >= 2 * workers:
+                    consume(*in_flight.popleft().result())
+            while in_flight:
+                consume(*in_flight.popleft().result())
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+
+    stats["elapsed_s"] = round(time.monotonic() - started, 1)
+    return stats
+
+
+# ==================== CLI ====================
+
+def main():
+    import config
+    from database import init_db
+
+    arg_parser = argparse.ArgumentParser(description="Импорт старых заявок из CSV")
+    arg_parser.add_argument("files", nargs="+")
+    arg_parser.add_argument("--batch-size", type=int, default=5000)
+    arg_parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Процессы для разбора; 0 — в этом процессе")
+    arg_parser.add_argument("--encoding", default="utf-8-sig", help="Выгрузки из Excel часто в cp1251")
+    arg_parser.add_argument("--delimiter", default=None, help="По умолчанию определяется по началу файла")
+    arg_parser.add_argument("--status", default="completed", choices=[status.value for status in LeadStatus],
+                            help="Статус, если в файле его нет или он не распознан")
+    arg_parser.add_argument("--dry-run", action="store_true", help="Только разобрать и посчитать, в БД не писать")
+    arg_parser.add_argument("--database-url", default=config.DATABASE_URL)
+    args = arg_parser.parse_args()
+
+    if not args.dry_run and not args.database_url:
+        arg_parser.error("DATABASE_URL не установлен")
+
+    engine = db = None
+    if not args.dry_run:
+        engine, SessionLocal = init_db(args.database_url)
+        db = SessionLocal()
+    try:
+        stats = import_files(
+            db, args.files, args.workers, args.batch_size, args.encoding, args.delimiter, args.status,
+        )
+    except (OSError, ValueError) as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+    finally:
+        if db is not None:
+            db.close()
+            engine.dispose()
+
+    print(
+        f"Строк: {stats['rows']}, загружено заявок: {stats['imported']}, уже были: {stats['duplicates']}\n"
+        f"Без телефона (пропущены): {stats['no_phone']}, без даты (дата импорта): {stats['no_date']}\n"
+        f"За {stats['elapsed_s']} с"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,371 @@
+"""
+Нагрузочный тест: N симулированных клиентов проходят воронку PPF
+(/start → "🛡 Оклейка плёнкой" → вариант → авто → время → телефон)
+через настоящие client.router/admin.router против локального фейкового
+Bot API и локальной БД (SQLite по умолчанию или Postgres по --database-url).
+
+Отчёт: апдейтов в секунду, перцентили латентности по шагам,
+SQL-запросов на одну завершённую заявку. После прогона отчёт по заявкам
+строится через сессии для чтения — с --replica-url / --sqlite-replica
+это проверка маршрутизации на реплику. С --db-outage первые секунды прогона
+БД «лежит»: заявки должны завершиться через локальный журнал (spool.py)
+и попасть в БД после восстановления.
+
+    python loadtest.py --users 2000 --concurrency 200
+    python loadtest.py --users 5000 --database-url postgresql://localhost/bot_load --api-latency-ms 30
+    python loadtest.py --users 500 --sqlite-replica
+    python loadtest.py --users 200 --db-outage 5 --think-time 0.5
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import sqlite3
+import tempfile
+import time
+from datetime import datetime
+from typing import Dict, Optional
+
+from aiogram import Bot, Dispatcher
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.types import Chat, Message, Update, User as TgUser
+from aiohttp import web
+from sqlalchemy import event, func, select
+
+import dedup
+import metrics
+import outbox
+import reminders
+import replicas
+import reports
+import spool
+import telemetry
+from database import Lead, OutboxEvent, init_db
+
+BOT_TOKEN = "123456:LOADTEST"
+
+# Сценарий клиента: (название шага, текст сообщения)
+SCENARIO = [
+    ("start", "/start"),
+    ("service", "🛡 Оклейка плёнкой"),
+    ("variant", "База (только морда)"),
+    ("car", "Toyota Camry 2020"),
+    ("time", "завтра после 18"),
+    ("phone", "+7 999 {:03d} {:02d} {:02d}"),
+]
+
+
+# ==================== ФЕЙКОВЫЙ BOT API ====================
+
+class FakeBotAPI:
+    """Минимальный Bot API: отвечает на методы, которые вызывают хендлеры"""
+
+    def __init__(self, latency: float = 0.0, file_content: bytes = b"\xff\xd8fake-jpeg"):
+        self.latency = latency
+        self.file_content = file_content
+        self.calls: Dict[str, int] = {}
+        self._message_ids = itertools.count(1)
+        self._runner: Optional[web.AppRunner] = None
+        self.url = ""
+
+    def _message(self, chat_id: int, text: Optional[str]) -> dict:
+        return {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "text": text or "",
+        }
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        self.calls[method] = self.calls.get(method, 0) + 1
+
+        params = dict(await request.post())
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if method in ("sendMessage", "editMessageText", "sendPhoto", "sendDocument"):
+            result = self._message(int(params.get("chat_id", 0)), params.get("text"))
+        elif method == "sendMediaGroup":
+            result = [self._message(int(params.get("chat_id", 0)), None)]
+        elif method == "getFile":
+            result = {
+                "file_id": params.get("file_id"),
+                "file_unique_id": params.get("file_id"),
+                "file_path": f"photos/{params.get('file_id')}.jpg",
+            }
+        elif method == "getMe":
+            result = {"id": 123456, "is_bot": True, "first_name": "LoadTest", "username": "loadtest_bot"}
+        else:
+            result = True
+
+        return web.json_response({"ok": True, "result": result})
+
+    async def _handle_file(self, request: web.Request) -> web.Response:
+        self.calls["file"] = self.calls.get("file", 0) + 1
+        # Содержимое зависит от пути — разные файлы не совпадают по хешу
+        return web.Response(body=self.file_content + request.match_info["path"].encode())
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0):
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self._handle)
+        app.router.add_get("/file/bot{token}/{path:.+}", self._handle_file)
+
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://{host}:{port}"
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+
+
+# ==================== ГЕНЕРАТОР НАГРУЗКИ ====================
+
+class LoadTest:
+    def __init__(self, dp: Dispatcher, bot: Bot):
+        self.dp = dp
+        self.bot = bot
+        self.step_latency = {name: reports.StreamingHistogram(min_value=0.0001, max_value=60) for name, _ in SCENARIO}
+        self.updates = 0
+        self.errors = 0
+        self.completed_users = 0
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+
+    def _update(self, user_id: int, text: str) -> Update:
+        user = TgUser(id=user_id, is_bot=False, first_name=f"Client{user_id}")
+        message = Message(
+            message_id=next(self._message_ids),
+            date=datetime.now(),
+            chat=Chat(id=user_id, type="private"),
+            from_user=user,
+            text=text,
+        )
+        return Update(update_id=next(self._update_ids), message=message)
+
+    async def run_user(self, user_id: int, think_time: float):
+        for step, text in SCENARIO:
+            if step == "phone":
+                text = text.format(user_id % 1000, user_id // 1000 % 100, user_id % 100)
+
+            if think_time:
+                await asyncio.sleep(random.uniform(0, think_time))
+
+            start = time.perf_counter()
+            try:
+                await self.dp.feed_update(self.bot, self._update(user_id, text))
+            except Exception:
+                self.errors += 1
+                return
+            finally:
+                self.updates += 1
+
+            self.step_latency[step].add(time.perf_counter() - start)
+
+        self.completed_users += 1
+
+    async def run(self, users: int, concurrency: int, think_time: float, first_user_id: int = 10_000_000):
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def limited(user_id: int):
+            async with semaphore:
+                await self.run_user(user_id, think_time)
+
+        await asyncio.gather(*(limited(first_user_id + index) for index in range(users)))
+
+
+# ==================== ЗАПУСК ====================
+
+async def run_loadtest(args) -> dict:
+    # Импорт здесь: роутеры читают config при импорте
+    from main import build_dispatcher
+
+    database_url = args.database_url
+    replica_urls = [args.replica_url] if args.replica_url else []
+    if not database_url:
+        path = os.path.join(tempfile.mkdtemp(prefix="loadtest-"), "bot.db")
+        database_url = f"sqlite:///{path}"
+        if args.sqlite_replica:
+            # Вторая "база": тот же файл, подключение только для чтения
+            replica_urls = [f"sqlite:///file:{path}?mode=ro&uri=true"]
+
+    engine_kwargs = {}
+    if args.pool_size:
+        engine_kwargs = {"pool_size": args.pool_size, "max_overflow": 0}
+
+    engine, SessionLocal = init_db(database_url, **engine_kwargs)
+    metrics.instrument_engine(engine)
+    spool.guard_engine(engine, spool.breaker)
+    spool.journal.path = os.path.join(tempfile.mkdtemp(prefix="loadtest-spool-"), "spool.db")
+    spool.breaker.reset_timeout = 1.0
+
+    # Имитация аварии БД: первые --db-outage секунд любой запрос падает как при обрыве соединения
+    outage_until = [0.0]
+
+    def _outage(*_):
+        if time.perf_counter() < outage_until[0]:
+            raise sqlite3.OperationalError("simulated outage")
+
+    for name in ("do_execute", "do_executemany", "do_execute_no_params"):
+        event.listen(engine, name, _outage)
+    ReadSessionLocal = replicas.init_read_sessions(SessionLocal, replica_urls, args.replica_max_lag)
+
+    queries = [0]
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _count_query(*_):
+        queries[0] += 1
+
+    api = FakeBotAPI(latency=args.api_latency_ms / 1000)
+    await api.start()
+
+    session = AiohttpSession(api=TelegramAPIServer.from_base(api.url), limit=args.http_connections)
+    bot = Bot(token=BOT_TOKEN, session=session)
+
+    dp = build_dispatcher(bot, SessionLocal, ReadSessionLocal)
+
+    # Как в боте: события воронки, обработанные update_id и напоминания пишутся в фоне
+    telemetry.funnel.start(SessionLocal)
+    dedup.updates.start(SessionLocal)
+    reminders.scheduler.start(bot, SessionLocal, dp.storage)
+    ReadSessionLocal.start()
+
+    # Выгрузка в CRM — в локальную заглушку, которая ловит дубли и нарушения порядка
+    crm = None
+    if args.crm:
+        crm = outbox.StubCRM(fail_rate=args.crm_fail_rate)
+        outbox.install()
+        outbox.relay.url = await crm.start()
+        outbox.relay.max_backoff = 1.0
+        outbox.relay.start(SessionLocal)
+
+    test = LoadTest(dp, bot)
+    queries_before = queries[0]
+    started = time.perf_counter()
+    outage_until[0] = started + args.db_outage
+
+    try:
+        await test.run(args.users, args.concurrency, args.think_time)
+        elapsed = time.perf_counter() - started
+
+        # Заявки, принятые во время аварии, — из журнала в БД
+        spooled = spool.journal.pending()
+        await asyncio.sleep(max(0.0, outage_until[0] - time.perf_counter()))
+        while spool.journal.pending():
+            await asyncio.sleep(spool.breaker.reset_timeout)
+            await spool.replayer.replay(bot, SessionLocal)
+
+        if crm:
+            while await asyncio.to_thread(_outbox_pending, SessionLocal):
+                outbox.relay.wake()
+                await asyncio.sleep(0.2)
+    finally:
+        if crm:
+            await outbox.relay.stop()
+            await crm.stop()
+        await reminders.scheduler.stop(SessionLocal)
+        await telemetry.funnel.stop(SessionLocal)
+        await dedup.updates.stop(SessionLocal)
+        await ReadSessionLocal.stop()
+        await bot.session.close()
+        await api.stop()
+        spool.journal.close()
+
+    db = SessionLocal()
+    try:
+        completed_leads = db.execute(select(func.count(Lead.id)).where(Lead.phone.isnot(None))).scalar()
+    finally:
+        db.close()
+    
+    # Отчёт владельца — как /report, через сессию для чтения (по свежей проверке реплики)
+    ReadSessionLocal.check_all()
+    read_db = ReadSessionLocal()
+    try:
+        report = reports.build_report(read_db)
+        read_target = read_db.get_bind().url.render_as_string(hide_password=True)
+    finally:
+        read_db.close()
+        engine.dispose()
+
+    return {
+        "users": args.users,
+        "concurrency": args.concurrency,
+        "elapsed_s": round(elapsed, 2),
+        "updates": test.updates,
+        "updates_per_s": round(test.updates / elapsed, 1) if elapsed else None,
+        "errors": test.errors,
+        "spooled_during_outage": spooled,
+        "completed_users": test.completed_users,
+        "completed_leads": completed_leads,
+        "report_leads": report.leads_total,
+        "report_read_from": read_target,
+        "db_queries": queries[0] - queries_before,
+        "db_queries_per_lead": round((queries[0] - queries_before) / completed_leads, 1) if completed_leads else None,
+        "bot_api_calls": api.calls,
+        "crm": crm.stats if crm else None,
+        "step_latency_ms": {
+            step: {
+                "p50": _ms(histogram.percentile(50)),
+                "p90": _ms(histogram.percentile(90)),
+                "p99": _ms(histogram.percentile(99)),
+                "max": _ms(histogram.max),
+            }
+            for step, histogram in test.step_latency.items()
+        },
+    }
+
+
+def _outbox_pending(SessionLocal) -> int:
+    db = SessionLocal()
+    try:
+        return db.scalar(select(func.count()).select_from(OutboxEvent).where(OutboxEvent.status == "pending"))
+    finally:
+        db.close()
+
+
+def _ms(seconds: Optional[float]) -> Optional[float]:
+    return None if seconds is None else round(seconds * 1000, 2)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Нагрузочный тест воронки PPF")
+    arg_parser.add_argument("--users", type=int, default=1000, help="Сколько клиентов симулировать")
+    arg_parser.add_argument("--concurrency", type=int, default=100, help="Сколько клиентов одновременно")
+    arg_parser.add_argument("--think-time", type=float, default=0.0, help="Пауза клиента между сообщениями, до N секунд")
+    arg_parser.add_argument("--api-latency-ms", type=float, default=0.0, help="Задержка ответа фейкового Bot API")
+    arg_parser.add_argument("--http-connections", type=int, default=100, help="Лимит соединений сессии бота")
+    arg_parser.add_argument("--database-url", default=None, help="По умолчанию — временный SQLite")
+    arg_parser.add_argument("--replica-url", default=None, help="Реплика для чтения (отчёт после прогона)")
+    arg_parser.add_argument(
+        "--sqlite-replica", action="store_true",
+        help="Для временного SQLite: реплика — тот же файл, подключение только для чтения",
+    )
+    arg_parser.add_argument("--replica-max-lag", type=float, default=10.0, help="Допустимое отставание реплики, с")
+    arg_parser.add_argument(
+        "--pool-size", type=int, default=None,
+        help="Пул соединений БД (по умолчанию как в боте: 5 + 10 overflow). Хендлеры держат "
+             "соединение через await, поэтому при concurrency больше пула event loop "
+             "встаёт на ожидании соединения",
+    )
+    arg_parser.add_argument(
+        "--db-outage", type=float, default=0.0,
+        help="Первые N секунд прогона БД недоступна: заявки идут в локальный журнал и переносятся после",
+    )
+    arg_parser.add_argument("--crm", action="store_true", help="Выгружать заявки в локальную заглушку CRM (outbox.py)")
+    arg_parser.add_argument("--crm-fail-rate", type=float, default=0.0, help="Доля запросов, на которые заглушка CRM отвечает 503")
+    args = arg_parser.parse_args()
+
+    result = asyncio.run(run_loadtest(args))
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+"""
+Неблокирующее структурированное логирование.
+
+На event loop запись лога — это только сбор полей и put_nowait в очередь;
+форматирование в JSON и вывод в поток делает фоновый QueueListener.
+Контекст апдейта (update_id, user_id, lead_id, handler) берётся из contextvars,
+которые выставляют middleware и хендлеры.
+"""
+import contextvars
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import time
+import traceback
+from datetime import datetime, timezone
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from aiogram import BaseMiddleware
+
+# Поля контекста, которые попадают в каждую запись
+CONTEXT_FIELDS = ("update_id", "user_id", "lead_id", "handler")
+
+_context: Dict[str, contextvars.ContextVar] = {
+    name: contextvars.ContextVar(name, default=None) for name in CONTEXT_FIELDS
+}
+
+# Стандартные атрибуты LogRecord — всё остальное считаем extra-полями
+_RECORD_ATTRS = set(logging.makeLogRecord({}).__dict__) | {"message", "asctime"} | set(CONTEXT_FIELDS)
+
+
+def bind(**fields):
+    """Добавить поля в контекст логов текущего апдейта (например, lead_id)"""
+    for name, value in fields.items():
+        _context[name].set(value)
+
+
+# ==================== ФОРМАТИРОВАНИЕ ====================
+
+class JsonFormatter(logging.Formatter):
+    """Одна запись — одна строка JSON"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+
+        for name in CONTEXT_FIELDS:
+            value = getattr(record, name, None)
+            if value is not None:
+                entry[name] = value
+
+        for name, value in record.__dict__.items():
+            if name not in _RECORD_ATTRS and not name.startswith("_"):
+                entry[name] = value
+
+        if record.exc_info:
+            entry["exc"] = "".join(traceback.format_exception(*record.exc_info))
+
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+# ==================== ОЧЕРЕДЬ ====================
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler, который никогда не ждёт: при переполнении очереди запись
+    отбрасывается и учитывается в dropped.
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Контекст снимаем здесь — в потоке слушателя contextvars уже другие
+        for name in CONTEXT_FIELDS:
+            if not hasattr(record, name):
+                setattr(record, name, _context[name].get())
+
+        # Подставляем аргументы сейчас (объекты могут измениться), но сам JSON
+        # собирает слушатель. exc_info оставляем — очередь внутрипроцессная.
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class DebugSamplingFilter(logging.Filter):
+    """Пропускает каждую N-ю DEBUG-запись для каждого шаблона сообщения"""
+
+    def __init__(self, every: int):
+        super().__init__()
+        self.every = max(1, every)
+        self._counters: Dict[tuple, int] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > logging.DEBUG or self.every == 1:
+            return True
+
+        key = (record.name, record.msg)
+        count = self._counters.get(key, 0)
+        self._counters[key] = count + 1
+        return count % self.every == 0
+
+
+_listener: Optional[logging.handlers.QueueListener] = None
+queue_handler: Optional[NonBlockingQueueHandler] = None
+
+
+def setup_logging(level: str = "INFO", json_format: bool = True, queue_size: int = 10000, debug_sample_every: int = 100):
+    """Настроить корневой логгер: очередь + фоновый слушатель"""
+    global _listener, queue_handler
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    if json_format:
+        stream_handler.setFormatter(JsonFormatter())
+    else:
+        stream_handler.setFormatter(logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s"))
+
+    queue_handler = NonBlockingQueueHandler(queue.Queue(maxsize=queue_size))
+    queue_handler.addFilter(DebugSamplingFilter(debug_sample_every))
+
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    root.setLevel(level)
+
+    _listener = logging.handlers.QueueListener(queue_handler.queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+
+
+def stop_logging():
+    """Дописать очередь и остановить слушателя"""
+    global _listener
+    if _listener:
+        _listener.stop()
+        _listener = None
+
+
+# ==================== MIDDLEWARE ====================
+
+class LoggingContextMiddleware(BaseMiddleware):
+    """Outer middleware на dp.update: update_id/user_id в контексте логов"""
+
+    async def __call__(
+        self,
+        handler: Callable[[Any, Dict[str, Any]], Awaitable[Any]],
+        event: Any,
+        data: Dict[str, Any],
+    ) -> Any:
+        user = data.get("event_from_user")
+        bind(update_id=event.update_id, user_id=user.id if user else None, lead_id=None, handler=None)
+        return await handler(event, data)
+
+
+class HandlerTimingMiddleware(BaseMiddleware):
+    """Inner middleware: имя и время хендлера в логах"""
+
+    def __init__(self, slow_threshold_ms: int = 500):
+        self.slow_threshold_ms = slow_threshold_ms
+        self.logger = logging.getLogger("handlers.timing")
+
+    async def __call__(
+        self,
+        handler: Callable[[Any, Dict[str, Any]], Awaitable[Any]],
+        event: Any,
+        data: Dict[str, Any],
+    ) -> Any:
+        handler_object = data.get("handler")
+        name = handler_object.callback.__name__ if handler_object else None
+        bind(handler=name)
+        start = time.perf_counter()
+
+        try:
+            return await handler(event, data)
+        finally:
+            duration_ms = round((time.perf_counter() - start) * 1000, 2)
+            if duration_ms >= self.slow_threshold_ms:
+                self.logger.warning("Медленный хендлер", extra={"duration_ms": duration_ms})
+            elif self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug("Хендлер отработал", extra={"duration_ms": duration_ms})
+
+
+def setup_dispatcher(dp, slow_threshold_ms: int = 500):
+    dp.update.outer_middleware(LoggingContextMiddleware())
+    dp.message.middleware(HandlerTimingMiddleware(slow_threshold_ms))
+    dp.callback_query.middleware(HandlerTimingMiddleware(slow_threshold_ms))
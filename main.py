@@ -1,22 +1,114 @@
+import time
+
+# Отсчёт времени старта — до тяжёлых импортов (aiogram, SQLAlchemy)
+_STARTED = time.perf_counter()
+
 import asyncio
 import logging
 from aiogram import Bot, Dispatcher
 from aiogram.fsm.storage.memory import MemoryStorage
 
+import ai
+import broadcast
+import cache
+import chat_scheduler
 import config
+import dedup
+import diagnostics
+import faq
+import lead_score
+import logging_setup
+import media
+import metrics
+import outbox
+import reminders
+import replicas
+import spool
+import telemetry
 from database import init_db
 from handlers import client, admin
 
+_IMPORTS_DONE = time.perf_counter()
+
+
+def build_dispatcher(bot: Bot, SessionLocal, ReadSessionLocal=None) -> Dispatcher:
+    """Диспетчер со всеми middleware и роутерами (общий для бота и нагрузочного теста)"""
+    storage = MemoryStorage()
+    
+    # Апдейты одного чата — по очереди, разных чатов — параллельно (до UPDATE_WORKERS)
+    scheduler = chat_scheduler.ChatScheduler(workers=config.UPDATE_WORKERS)
+    chat_scheduler.register_metrics(scheduler)
+    
+    dp = Dispatcher(storage=storage, events_isolation=scheduler)
+    
+    # Передаём SessionLocal в диспетчер (чтобы handlers могли использовать)
+    dp["db_session"] = SessionLocal
+    # Только чтение (админские списки, отчёты): реплика, если не отстаёт, иначе primary
+    dp["db_read_session"] = ReadSessionLocal or SessionLocal
+    
+    # Повторные update_id отсекаются до всех хендлеров
+    dp.update.outer_middleware(dedup.DeduplicationMiddleware(dedup.updates))
+    
+    # Контекст логов (update_id, user_id, handler) и метрики хендлеров, БД и Bot API
+    logging_setup.setup_dispatcher(dp, config.SLOW_HANDLER_MS)
+    metrics.setup_dispatcher(dp, bot)
+    
+    # Регистрация handlers
+    dp.include_router(client.router)
+    dp.include_router(admin.router)
+    
+    return dp
+
+
+class StartupTimer:
+    """Разбивка времени старта по этапам (в мс) для лога «Бот готов»"""
+    
+    def __init__(self):
+        self.phases = {"imports": round((_IMPORTS_DONE - _STARTED) * 1000)}
+        self._last = time.perf_counter()
+    
+    def mark(self, phase: str):
+        now = time.perf_counter()
+        self.phases[phase] = round((now - self._last) * 1000)
+        self._last = now
+    
+    @property
+    def total_ms(self) -> int:
+        return round((time.perf_counter() - _STARTED) * 1000)
+
+
+async def warm_faq(SessionLocal):
+    """Загрузить индекс FAQ в фоне: до готовности вопросы ищутся по встроенной базе"""
+    logger = logging.getLogger(__name__)
+    started = time.perf_counter()
+    try:
+        # Чтение и векторы — в потоке, подмена индекса — здесь, атомарно для хендлеров
+        faq.index.apply(await asyncio.to_thread(faq.index.fetch, SessionLocal))
+    except Exception as e:
+        logger.warning("FAQ из БД не загружен, ищем по встроенной базе: %s", e)
+        faq.index.build_in_memory()
+    logger.info("Индекс FAQ прогрет", extra={"duration_ms": round((time.perf_counter() - started) * 1000)})
+
+
+async def warm_caches(SessionLocal, storage, bot: Bot):
+    """Активные заявки и шаги воронки до рестарта — в кэши и FSM; polling не ждёт"""
+    try:
+        await cache.hot.warm(SessionLocal, storage, bot.id)
+    except Exception as e:
+        logging.getLogger(__name__).warning("Прогрев кэшей не удался, работаем через БД: %s", e)
+
 
 async def main():
     """Главная функция запуска бота"""
     
-    # Настройка логирования
-    logging.basicConfig(
-        level=logging.INFO,
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    # Настройка логирования (очередь + фоновый поток, JSON)
+    logging_setup.setup_logging(
+        level=config.LOG_LEVEL,
+        json_format=config.LOG_JSON,
+        debug_sample_every=config.LOG_DEBUG_SAMPLE_EVERY,
     )
     logger = logging.getLogger(__name__)
+    timer = StartupTimer()
     
     # Проверка обязательных переменных
     if not config.BOT_TOKEN:
@@ -30,34 +122,120 @@ async def main():
     # Инициализация базы данных
     logger.info("Инициализация базы данных...")
     try:
-        engine, SessionLocal = init_db(config.DATABASE_URL)
+        engine, SessionLocal = init_db(config.DATABASE_URL, **spool.engine_options(config.DATABASE_URL))
+        metrics.instrument_engine(engine)
+        # БД упала или тормозит — запросы сразу отказывают, заявки пишутся в локальный журнал
+        spool.guard_engine(engine, spool.breaker)
+        ReadSessionLocal = replicas.init_read_sessions(
+            SessionLocal, config.DATABASE_REPLICA_URLS, config.REPLICA_MAX_LAG_S
+        )
+        for replica in ReadSessionLocal.replicas:
+            metrics.instrument_engine(replica.engine)
+        timer.mark("db_schema")
+        # До polling: Telegram сразу передоставит апдейты, не подтверждённые до рестарта
+        dedup.updates.load(SessionLocal)
+        timer.mark("dedup_load")
         logger.info("База данных готова!")
     except Exception as e:
-        logger.error(f"Ошибка инициализации БД: {e}")
+        logger.error("Ошибка инициализации БД: %s", e)
         return
     
+    # Выгрузка в CRM: события по заявкам пишутся в outbox той же транзакцией
+    if config.CRM_WEBHOOK_URL:
+        outbox.install()
+        logger.info("Выгрузка заявок в CRM включена")
+    
+    # ИИ-ответы на вопросы вне базы знаний
+    if config.OPENAI_API_KEY:
+        ai.setup(ai.OpenAIClient(config.OPENAI_API_KEY, config.OPENAI_MODEL))
+        logger.info("ИИ-ответы включены (%s)", config.OPENAI_MODEL)
+    
     # Создание бота и диспетчера
     bot = Bot(token=config.BOT_TOKEN)
-    storage = MemoryStorage()
-    dp = Dispatcher(storage=storage)
-    
-    # Передаём SessionLocal в диспетчер (чтобы handlers могли использовать)
-    dp["db_session"] = SessionLocal
+    dp = build_dispatcher(bot, SessionLocal, ReadSessionLocal)
+    timer.mark("dispatcher")
     
-    # Регистрация handlers
-    dp.include_router(client.router)
-    dp.include_router(admin.router)
+    # Диагностика блокировок и профилирование (опционально)
+    diag = None
+    if config.DIAGNOSTICS:
+        diag = diagnostics.Diagnostics(
+            config.LOOP_BLOCK_THRESHOLD_MS,
+            config.PROFILE_HANDLERS,
+            config.PROFILE_OUTPUT_DIR,
+        )
+        diag.setup_dispatcher(dp)
     
     logger.info("Бот запущен!")
-    logger.info(f"Admin chat ID: {config.ADMIN_CHAT_ID}")
-    logger.info(f"Owner chat ID: {config.OWNER_CHAT_ID}")
+    logger.info("Admin chat ID: %s", config.ADMIN_CHAT_ID)
+    logger.info("Owner chat ID: %s", config.OWNER_CHAT_ID)
+    
+    # Фоновая запись телеметрии воронки и обработанных update_id
+    telemetry.funnel.start(SessionLocal)
+    dedup.updates.start(SessionLocal)
+    
+    # Напоминания и дожимы (задачи в scheduled_jobs)
+    reminders.scheduler.start(bot, SessionLocal, dp.storage)
+    
+    # Журнал заявок, принятых без БД: перенос в БД по восстановлении
+    spool.replayer.start(bot, SessionLocal)
+    # Отставание реплик — фоновой проверкой; хендлеры читают готовый результат
+    ReadSessionLocal.start()
+    
+    # Рассылки: продолжить прерванные рестартом
+    broadcast.runner.start(bot, SessionLocal)
+    
+    if config.CRM_WEBHOOK_URL:
+        outbox.relay.start(SessionLocal)
+    
+    # HTTP-эндпоинт /metrics
+    metrics_server = None
+    if config.METRICS_PORT:
+        metrics_server = metrics.MetricsServer(config.METRICS_HOST, config.METRICS_PORT)
+        await metrics_server.start()
+    
+    if diag:
+        diag.start()
+    
+    # Индекс базы знаний для "❓ Задать вопрос" — в фоне, polling не ждёт
+    warm_task = asyncio.create_task(warm_faq(SessionLocal))
+    # Модель красных флагов (и NumPy) — в потоке; до загрузки флаги по правилам parser
+    score_task = asyncio.create_task(asyncio.to_thread(lead_score.scorer.load))
+    # Активные заявки, известные пользователи и шаги воронки — тоже в фоне (готовность: cache.hot.ready)
+    cache_task = asyncio.create_task(warm_caches(SessionLocal, dp.storage, bot))
+    timer.mark("background_tasks")
+    
+    @dp.startup()
+    async def on_startup():
+        timer.mark("polling_start")
+        logger.info(
+            "Бот готов за %d мс", timer.total_ms,
+            extra={"startup_ms": timer.total_ms, "startup_phases": timer.phases},
+        )
     
     # Запуск polling
     try:
         await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
     finally:
+        warm_task.cancel()
+        score_task.cancel()
+        cache_task.cancel()
+        if diag:
+            diag.stop()
+        if metrics_server:
+            await metrics_server.stop()
+        media.photos.shutdown()
+        await broadcast.runner.stop(SessionLocal)
+        await outbox.relay.stop()
+        await spool.replayer.stop()
+        await ReadSessionLocal.stop()
+        await reminders.scheduler.stop(SessionLocal)
+        await telemetry.funnel.stop(SessionLocal)
+        await dedup.updates.stop(SessionLocal)
         await bot.session.close()
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    try:
+        asyncio.run(main())
+    finally:
+        logging_setup.stop_logging()
@@ -0,0 +1,216 @@
+"""
+Фото авто и повреждений от клиента во время воронки.
+
+- файл качается потоком из Bot API в MEDIA_DIR, sha256 считается по ходу;
+- повтор того же файла Telegram (file_unique_id) не качается второй раз,
+  одинаковое содержимое (sha256) хранится на диске один раз
+  и не прикрепляется к заявке дважды;
+- превью делаются в пуле процессов (Pillow), event loop не ждёт;
+- к карточке заявки у админа фото уходят альбомом (по file_id, без перезаливки).
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional
+
+from aiogram.types import Message
+from aiogram.utils.media_group import MediaGroupBuilder
+from sqlalchemy.orm import Session
+
+import config
+import metrics
+from database import LeadCard, LeadMedia
+
+logger = logging.getLogger(__name__)
+
+MEDIA_FILES = metrics.Counter("bot_media_files_total", "Фото от клиентов по результату", ["result"])
+MEDIA_DOWNLOAD = metrics.Histogram("bot_media_download_seconds", "Скачивание фото из Bot API")
+
+# Bot API не отдаёт ботам файлы больше 20 МБ
+MAX_DOWNLOAD_BYTES = 20 * 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+ALBUM_SIZE = 10  # максимум в одном sendMediaGroup
+
+
+# ==================== ПРЕВЬЮ (В ОТДЕЛЬНОМ ПРОЦЕССЕ) ====================
+
+def make_thumbnail(source: str, destination: str, size: int) -> Optional[str]:
+    """Уменьшенная копия JPEG; выполняется в процессе пула"""
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        return None
+
+    with Image.open(source) as image:
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((size, size))
+        image.convert("RGB").save(destination, "JPEG", quality=80, optimize=True)
+    return destination
+
+
+# ==================== ПРИЁМ ФАЙЛОВ ====================
+
+class MediaIntake:
+    def __init__(self, media_dir: str, thumb_size: int = 320, workers: int = 2):
+        self.media_dir = media_dir
+        self.thumb_size = thumb_size
+        self.workers = workers
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._acknowledged_groups: "OrderedDict[str, None]" = OrderedDict()
+
+    @property
+    def pool(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers)
+        return self._pool
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    def _path(self, sha256: str, suffix: str) -> str:
+        # Раскладываем по подпапкам, чтобы не держать тысячи файлов в одной
+        return os.path.join(self.media_dir, sha256[:2], sha256 + suffix)
+
+    def first_in_album(self, message: Message) -> bool:
+        """Отвечать клиенту один раз на альбом, а не на каждое фото"""
+        group_id = message.media_group_id
+        if group_id is None:
+            return True
+        if group_id in self._acknowledged_groups:
+            return False
+        self._acknowledged_groups[group_id] = None
+        if len(self._acknowledged_groups) > 1000:
+            self._acknowledged_groups.popitem(last=False)
+        return True
+
+    async def _download(self, bot, file_path: str) -> tuple:
+        """Скачать файл потоком во временный файл: (путь, sha256, размер)"""
+        os.makedirs(self.media_dir, exist_ok=True)
+        tmp_path = os.path.join(self.media_dir, f".{uuid.uuid4().hex}.part")
+        digest = hashlib.sha256()
+        size = 0
+
+        url = bot.session.api.file_url(bot.token, file_path)
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        try:
+            with open(tmp_path, "wb") as f:
+                async for chunk in bot.session.stream_content(url=url, chunk_size=CHUNK_SIZE):
+                    digest.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        MEDIA_DOWNLOAD.observe(loop.time() - started)
+
+        return tmp_path, digest.hexdigest(), size
+
+    async def intake(self, message: Message, db: Session, lead_id: int) -> Optional[LeadMedia]:
+        """
+        Принять фото/картинку-документ к заявке.
+
+        Возвращает новую запись или None, если это повтор.
+        """
+        if message.photo:
+            kind, attachment = "photo", message.photo[-1]  # самый крупный размер
+        else:
+            kind, attachment = "document", message.document
+
+        if attachment.file_size and attachment.file_size > MAX_DOWNLOAD_BYTES:
+            raise ValueError("file too big")
+
+        # Этот файл Telegram уже есть — не качаем
+        known = db.query(LeadMedia).filter(LeadMedia.file_unique_id == attachment.file_unique_id).first()
+        if known:
+            sha256, path, thumb_path, size = known.sha256, known.path, known.thumb_path, known.size
+        else:
+            file = await message.bot.get_file(attachment.file_id)
+            tmp_path, sha256, size = await self._download(message.bot, file.file_path)
+
+            suffix = os.path.splitext(file.file_path or "")[1].lower() or ".jpg"
+            path = self._path(sha256, suffix)
+            thumb_path = self._path(sha256, ".thumb.jpg")
+
+            if os.path.exists(path):
+                os.remove(tmp_path)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(tmp_path, path)
+
+            if not os.path.exists(thumb_path):
+                loop = asyncio.get_running_loop()
+                try:
+                    thumb_path = await loop.run_in_executor(
+                        self.pool, make_thumbnail, path, thumb_path, self.thumb_size
+                    )
+                except Exception as e:
+                    logger.warning("Превью не сделано: %s", e)
+                    thumb_path = None
+
+        # То же содержимое уже прикреплено к этой заявке
+        if db.query(LeadMedia.id).filter(LeadMedia.lead_id == lead_id, LeadMedia.sha256 == sha256).first():
+            MEDIA_FILES.inc("duplicate")
+            return None
+
+        item = LeadMedia(
+            lead_id=lead_id,
+            user_id=message.from_user.id,
+            kind=kind,
+            file_id=attachment.file_id,
+            file_unique_id=attachment.file_unique_id,
+            sha256=sha256,
+            size=size,
+            path=path,
+            thumb_path=thumb_path,
+        )
+        db.add(item)
+        db.commit()
+        MEDIA_FILES.inc("reused" if known else "stored")
+        return item
+
+    async def send_to_admins(self, bot, db: Session, lead_id: int):
+        """Неотправленные фото заявки — альбомами ответом на её карточку"""
+        items: List[LeadMedia] = db.query(LeadMedia).filter(
+            LeadMedia.lead_id == lead_id,
+            LeadMedia.sent_to_admin.is_(False),
+        ).order_by(LeadMedia.id).all()
+        if not items:
+            return
+
+        cards = db.query(LeadCard).filter(LeadCard.lead_id == lead_id).order_by(LeadCard.id).all()
+        targets = {card.chat_id: card.message_id for card in cards} or {config.ADMIN_CHAT_ID: None}
+
+        # Фото и документы в одном альбоме Telegram не смешивает
+        for kind in ("photo", "document"):
+            batch = [item for item in items if item.kind == kind]
+            for start in range(0, len(batch), ALBUM_SIZE):
+                album = batch[start:start + ALBUM_SIZE]
+                for chat_id, card_message_id in targets.items():
+                    await self._send_album(bot, chat_id, card_message_id, kind, album)
+
+        for item in items:
+            item.sent_to_admin = True
+        db.commit()
+
+    @staticmethod
+    async def _send_album(bot, chat_id: int, reply_to: Optional[int], kind: str, album: List[LeadMedia]):
+        if len(album) == 1:
+            send = bot.send_photo if kind == "photo" else bot.send_document
+            await send(chat_id, album[0].file_id, reply_to_message_id=reply_to)
+            return
+
+        builder = MediaGroupBuilder()
+        for item in album:
+            builder.add(type=kind, media=item.file_id)
+        await bot.send_media_group(chat_id, media=builder.build(), reply_to_message_id=reply_to)
+
+
+photos = MediaIntake(config.MEDIA_DIR, config.MEDIA_THUMB_SIZE, config.MEDIA_WORKERS)
@@ -0,0 +1,315 @@
+"""
+Метрики в формате Prometheus: латентность хендлеров, запросов к БД,
+методов Bot API и лаг event loop. Отдаются по HTTP на /metrics.
+"""
+import asyncio
+import bisect
+import contextvars
+import logging
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiohttp import web
+from sqlalchemy import event
+
+import logging_setup
+import telemetry
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55)
+
+
+# ==================== ПРИМИТИВЫ ====================
+
+class Metric:
+    """Базовая метрика с метками"""
+
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _format_labels(self, labels: Tuple[str, ...], extra: Dict[str, str] = None) -> str:
+        pairs = list(zip(self.labelnames, labels))
+        if extra:
+            pairs.extend(extra.items())
+        if not pairs:
+            return ""
+        inner = ",".join(f'{key}="{_escape(str(value))}"' for key, value in pairs)
+        return "{" + inner + "}"
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *labels: str, amount: float = 1.0):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{self._format_labels(labels)} {value}" for labels, value in items]
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._function: Optional[Callable[[], float]] = None
+
+    def set(self, value: float, *labels: str):
+        with self._lock:
+            self._values[labels] = value
+
+    def set_function(self, function: Callable[[], float]):
+        """Значение считается в момент выгрузки (для метрик без меток)"""
+        self._function = function
+
+    def samples(self) -> List[str]:
+        if self._function is not None:
+            return [f"{self.name} {float(self._function())}"]
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{self._format_labels(labels)} {value}" for labels, value in items]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+        # labels -> [счётчики по корзинам..., +Inf], сумма
+        self._counts: Dict[Tuple[str, ...], List[int]] = {}
+        self._sums: Dict[Tuple[str, ...], float] = {}
+
+    def observe(self, value: float, *labels: str):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._counts.get(labels)
+            if counts is None:
+                counts = self._counts[labels] = [0] * (len(self.buckets) + 1)
+                self._sums[labels] = 0.0
+            counts[index] += 1
+            self._sums[labels] += value
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            items = [(labels, list(counts), self._sums[labels]) for labels, counts in self._counts.items()]
+
+        lines = []
+        for labels, counts, total in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{self._format_labels(labels, {'le': _format_bound(bound)})} {cumulative}")
+            cumulative += counts[-1]
+            lines.append(f"{self.name}_bucket{self._format_labels(labels, {'le': '+Inf'})} {cumulative}")
+            lines.append(f"{self.name}_sum{self._format_labels(labels)} {total}")
+            lines.append(f"{self.name}_count{self._format_labels(labels)} {cumulative}")
+        return lines
+
+
+REGISTRY: List[Metric] = []
+
+
+def render_all() -> str:
+    return "\n".join(metric.render() for metric in REGISTRY) + "\n"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_bound(bound: float) -> str:
+    return repr(float(bound))
+
+
+# ==================== МЕТРИКИ БОТА ====================
+
+UPDATES = Counter("bot_updates_total", "Обработано апдейтов", ["type"])
+UPDATE_LATENCY = Histogram("bot_update_duration_seconds", "Полное время обработки апдейта", ["type"])
+HANDLER_LATENCY = Histogram("bot_handler_duration_seconds", "Время работы хендлера", ["handler"])
+HANDLER_ERRORS = Counter("bot_handler_errors_total", "Исключения в хендлерах", ["handler"])
+
+DB_QUERY_LATENCY = Histogram("bot_db_query_duration_seconds", "Время SQL-запроса", ["statement"])
+DB_QUERIES_PER_UPDATE = Histogram("bot_db_queries_per_update", "SQL-запросов на один апдейт", buckets=COUNT_BUCKETS)
+
+BOT_API_LATENCY = Histogram("bot_telegram_api_duration_seconds", "Время запроса к Bot API", ["method"])
+BOT_API_ERRORS = Counter("bot_telegram_api_errors_total", "Ошибки запросов к Bot API", ["method"])
+
+LOOP_LAG = Histogram("bot_event_loop_lag_seconds", "Задержка пробуждения event loop")
+
+FUNNEL_EVENTS_PENDING = Gauge("bot_funnel_events_pending", "События воронки в буфере, ещё не записанные")
+FUNNEL_EVENTS_PENDING.set_function(lambda: telemetry.funnel.pending)
+FUNNEL_EVENTS_DROPPED = Gauge("bot_funnel_events_dropped", "Потерянные события воронки (переполнение/ошибка БД)")
+FUNNEL_EVENTS_DROPPED.set_function(lambda: telemetry.funnel.dropped)
+
+LOG_RECORDS_DROPPED = Gauge("bot_log_records_dropped", "Записи лога, отброшенные из-за переполнения очереди")
+LOG_RECORDS_DROPPED.set_function(lambda: logging_setup.queue_handler.dropped if logging_setup.queue_handler else 0)
+
+# Счётчик SQL-запросов текущего апдейта
+_update_queries: contextvars.ContextVar[Optional[List[int]]] = contextvars.ContextVar("update_queries", default=None)
+
+
+# ==================== MIDDLEWARE ====================
+
+class UpdateMetricsMiddleware(BaseMiddleware):
+    """Outer middleware на dp.update: полное время апдейта и число SQL-запросов"""
+
+    async def __call__(
+        self,
+        handler: Callable[[Any, Dict[str, Any]], Awaitable[Any]],
+        event: Any,
+        data: Dict[str, Any],
+    ) -> Any:
+        update_type = event.event_type
+        queries = [0]
+        token = _update_queries.set(queries)
+        start = time.perf_counter()
+
+        try:
+            return await handler(event, data)
+        finally:
+            UPDATE_LATENCY.observe(time.perf_counter() - start, update_type)
+            UPDATES.inc(update_type)
+            DB_QUERIES_PER_UPDATE.observe(queries[0])
+            _update_queries.reset(token)
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Inner middleware: время каждого хендлера по его имени"""
+
+    async def __call__(
+        self,
+        handler: Callable[[Any, Dict[str, Any]], Awaitable[Any]],
+        event: Any,
+        data: Dict[str, Any],
+    ) -> Any:
+        handler_object = data.get("handler")
+        name = handler_object.callback.__name__ if handler_object else "unknown"
+        start = time.perf_counter()
+
+        try:
+            return await handler(event, data)
+        except Exception:
+            HANDLER_ERRORS.inc(name)
+            raise
+        finally:
+            HANDLER_LATENCY.observe(time.perf_counter() - start, name)
+
+
+class BotApiMetricsMiddleware(BaseRequestMiddleware):
+    """Middleware сессии бота: время каждого метода Bot API"""
+
+    async def __call__(self, make_request, bot, method):
+        name = method.__api_method__
+        start = time.perf_counter()
+
+        try:
+            return await make_request(bot, method)
+        except Exception:
+            BOT_API_ERRORS.inc(name)
+            raise
+        finally:
+            BOT_API_LATENCY.observe(time.perf_counter() - start, name)
+
+
+def setup_dispatcher(dp, bot):
+    """Подключить middleware метрик к диспетчеру и сессии бота"""
+    dp.update.outer_middleware(UpdateMetricsMiddleware())
+    dp.message.middleware(HandlerMetricsMiddleware())
+    dp.callback_query.middleware(HandlerMetricsMiddleware())
+    bot.session.middleware(BotApiMetricsMiddleware())
+
+
+# ==================== SQLALCHEMY ====================
+
+def instrument_engine(engine):
+    """Слушатели SQLAlchemy: время запроса по типу (SELECT/INSERT/...) и счётчик на апдейт"""
+
+    # Начало запроса — на его ExecutionContext, а не на соединении: при ошибке
+    # (в т.ч. отказе предохранителя spool.guard_engine) after_cursor_execute не
+    # вызывается, и на соединении из пула оставался бы мусор
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        if context is not None:
+            context._metrics_query_start = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        started = getattr(context, "_metrics_query_start", None)
+        if started is not None:
+            statement_type = statement.lstrip().split(None, 1)[0].upper() if statement else "UNKNOWN"
+            DB_QUERY_LATENCY.observe(time.perf_counter() - started, statement_type)
+
+        queries = _update_queries.get()
+        if queries is not None:
+            queries[0] += 1
+
+
+# ==================== ЛАГ EVENT LOOP ====================
+
+async def monitor_loop_lag(interval: float = 0.5):
+    """Периодически засыпать и мерить, насколько позже проснулись"""
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        LOOP_LAG.observe(max(0.0, time.perf_counter() - start - interval))
+
+
+# ==================== HTTP /metrics ====================
+
+async def _handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(text=render_all(), content_type="text/plain", charset="utf-8")
+
+
+class MetricsServer:
+    """Локальный HTTP-сервер с /metrics и фоновым замером лага"""
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self._runner: Optional[web.AppRunner] = None
+        self._lag_task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/metrics", _handle_metrics)
+
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+
+        self._lag_task = asyncio.create_task(monitor_loop_lag())
+        logger.info("Метрики доступны на http://%s:%s/metrics", self.host, self.port)
+
+    async def stop(self):
+        if self._lag_task:
+            self._lag_task.cancel()
+        if self._runner:
+            await self._runner.cleanup()
@@ -0,0 +1,473 @@
+"""
+Выгрузка заявок в CRM через outbox.
+
+Каждое изменение заявки (создание, поля чек-листа, статус) при flush
+сессии пишется строкой в outbox_events — той же транзакцией, что и сама
+заявка: откатилась заявка — откатилось и событие, закоммитилась — событие
+не потеряется, даже если бот упадёт сразу после commit.
+
+Фоновый relay отправляет события пачками (до CRM_BATCH) POST-запросом
+на CRM_WEBHOOK_URL:
+
+    {"events": [{"id": 17, "type": "lead.updated", "lead_id": 5,
+                 "occurred_at": "...", "lead": {...снимок заявки...}}]}
+
+- порядок — по id события, пачки идут строго по очереди, так что события
+  одной заявки приходят в CRM в том порядке, в каком менялась заявка
+  (порядок важен только внутри заявки, между заявками — нет):
+  пачка занимается (claimed_until) короткой транзакцией — в Postgres под
+  advisory lock, — пока занятая пачка есть, другие инстансы ждут;
+  POST — вне транзакции, отметка результата — отдельной короткой;
+  инстанс упал посреди отправки — пачку после claim_ttl займёт другой;
+- 2xx — пачка доставлена; любая ошибка — дальше по одному событию, у
+  событий пачки — своя экспоненциальная пауза (next_attempt_at), и пока
+  она идёт, события этих заявок пропускаются: одна застрявшая заявка не
+  держит остальные; сеть, 5xx, 408, 429 — ещё и общая пауза relay (или
+  Retry-After);
+- событие помечается dead: 4xx — после max_attempts попыток; сеть, 5xx,
+  408, 429 — после max_retry_attempts, и только если другие события CRM
+  в это время принимает (лежит CRM целиком — ждём сколько угодно);
+  следующие события заявки — полные снимки, CRM всё равно придёт к
+  актуальному состоянию; застрявшие видны по bot_outbox_lag_seconds и
+  bot_outbox_retrying_leads;
+- доставка «хотя бы раз»: упали между ответом CRM и отметкой в БД —
+  пачка уйдёт ещё раз. id события уникален и не меняется при повторах —
+  CRM отбрасывает уже принятые id, и в итоге каждое событие применяется
+  ровно один раз.
+
+Локальная заглушка CRM для проверки (печатает события, ловит дубли и
+нарушения порядка, может отвечать ошибками):
+
+    python outbox.py --stub --port 8099 --fail-rate 0.2
+    CRM_WEBHOOK_URL=http://127.0.0.1:8099/events python main.py
+"""
+import argparse
+import asyncio
+import json
+import logging
+import random
+import time
+from datetime import datetime, timedelta
+from typing import Dict, Optional
+
+import aiohttp
+from aiohttp import web
+from sqlalchemy import delete, event, func, insert, inspect, select, text, update
+from sqlalchemy.orm import Session
+
+import config
+import metrics
+from database import Lead, LeadStatus, OutboxEvent
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_EVENTS = metrics.Counter("bot_outbox_events_total", "События выгрузки в CRM по результату", ["result"])
+OUTBOX_LAG = metrics.Gauge("bot_outbox_lag_seconds", "Возраст самого старого неотправленного события")
+OUTBOX_RETRYING = metrics.Gauge("bot_outbox_retrying_leads", "Заявки, чьи события ждут повтора после ошибки CRM")
+
+# Поля заявки, которые уходят в CRM; изменение других (updated_at, client_id) события не создаёт
+EXPORTED_FIELDS = (
+    "service", "service_variant", "car_brand", "car_model", "car_year", "preferred_time", "phone",
+    "goal", "comment", "is_urgent", "is_red_flag", "red_flag_score", "status", "completed_at",
+)
+
+# Ответы, после которых есть смысл повторить ту же пачку
+RETRYABLE_STATUSES = {408, 429}
+
+
+def _value(value):
+    if isinstance(value, LeadStatus):
+        return value.value
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+def snapshot(lead: Lead) -> dict:
+    data = {field: _value(getattr(lead, field)) for field in EXPORTED_FIELDS}
+    data.update(id=lead.id, user_id=lead.user_id, created_at=_value(lead.created_at))
+    return data
+
+
+# ==================== ЗАПИСЬ СОБЫТИЙ ====================
+
+def _capture(session: Session, flush_context):
+    """after_flush: id новых заявок уже есть, история изменений атрибутов ещё не сброшена"""
+    rows = []
+    for obj in session.new:
+        if isinstance(obj, Lead):
+            rows.append((obj, "lead.created"))
+    for obj in session.dirty:
+        if isinstance(obj, Lead):
+            attrs = inspect(obj).attrs
+            if any(attrs[field].history.has_changes() for field in EXPORTED_FIELDS):
+                rows.append((obj, "lead.updated"))
+    if not rows:
+        return
+
+    now = datetime.utcnow()
+    session.connection().execute(insert(OutboxEvent), [
+        {
+            "lead_id": lead.id,
+            "event_type": event_type,
+            "payload": json.dumps(snapshot(lead), ensure_ascii=False),
+            "status": "pending",
+            "attempts": 0,
+            "created_at": now,
+        }
+        for lead, event_type in rows
+    ])
+
+
+def install():
+    """Писать события по заявкам из всех ORM-сессий (UPDATE в обход ORM события не создаёт)"""
+    if not event.contains(Session, "after_flush", _capture):
+        event.listen(Session, "after_flush", _capture)
+
+
+# ==================== ОТПРАВКА ====================
+
+class DeliveryError(Exception):
+    def __init__(self, message: str, retryable: bool = True, retry_after: float = None):
+        super().__init__(message)
+        self.retryable = retryable
+        self.retry_after = retry_after
+
+
+class OutboxRelay:
+    def __init__(
+        self,
+        url: str,
+        token: str = "",
+        batch_size: int = 100,
+        poll_interval: float = 2.0,
+        timeout: float = 10.0,
+        max_backoff: float = 300.0,
+        max_attempts: int = 5,
+        max_retry_attempts: int = 20,
+        retention: timedelta = timedelta(days=7),
+    ):
+        self.url = url
+        self.token = token
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.max_backoff = max_backoff
+        self.max_attempts = max_attempts
+        self.max_retry_attempts = max_retry_attempts
+        self.retention = retention
+        # Занятая пачка держится не дольше: POST ограничен timeout, с запасом на отметку
+        self.claim_ttl = timedelta(seconds=2 * timeout + 30)
+
+        self._failures = 0
+        self._delivered_at = 0.0   # monotonic последней доставленной пачки
+        self._isolate_until = 0   # отвергнутая пачка: до этого id шлём по одному событию
+        self._pruned_at = 0.0
+        self._http: Optional[aiohttp.ClientSession] = None
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    # ---------- БД (в потоке; короткие транзакции, HTTP — вне их) ----------
+
+    def _claim(self, db) -> Optional[list]:
+        """Занять следующую пачку (commit сразу); None — пачку сейчас шлёт другой инстанс"""
+        now = datetime.utcnow()
+        if db.get_bind().dialect.name == "postgresql":
+            # Проверка и захват — по очереди между инстансами; блокировка — до commit ниже
+            if not db.execute(text("SELECT pg_try_advisory_xact_lock(7033)")).scalar():
+                db.rollback()
+                return None
+        busy = db.execute(
+            select(OutboxEvent.id)
+            .where(OutboxEvent.status == "pending", OutboxEvent.claimed_until > now)
+            .limit(1)
+        ).first()
+        if busy:
+            db.rollback()
+            return None
+
+        # Заявки, чьё событие ждёт повтора: их события не обгоняют его, остальные идут
+        waiting = (
+            select(OutboxEvent.lead_id)
+            .where(OutboxEvent.status == "pending", OutboxEvent.next_attempt_at > now)
+            .distinct()
+        )
+        OUTBOX_RETRYING.set(db.scalar(select(func.count()).select_from(waiting.subquery())))
+        oldest = db.scalar(
+            select(OutboxEvent.created_at).where(OutboxEvent.status == "pending").order_by(OutboxEvent.id).limit(1)
+        )
+        OUTBOX_LAG.set((now - oldest).total_seconds() if oldest else 0)
+
+        rows = db.execute(
+            select(OutboxEvent.id, OutboxEvent.lead_id, OutboxEvent.event_type, OutboxEvent.payload,
+                   OutboxEvent.attempts, OutboxEvent.created_at)
+            .where(OutboxEvent.status == "pending", OutboxEvent.lead_id.not_in(waiting))
+            .order_by(OutboxEvent.id)
+            .limit(self.batch_size)
+        ).all()
+        if rows and rows[0].id <= self._isolate_until:
+            rows = rows[:1]
+        elif rows:
+            # Пусто — все ещё ждут повтора: поиск виноватого продолжится после паузы
+            self._isolate_until = 0
+        if rows:
+            db.execute(
+                update(OutboxEvent)
+                .where(OutboxEvent.id.in_([row.id for row in rows]))
+                .values(claimed_until=now + self.claim_ttl)
+            )
+        db.commit()
+        return rows
+
+    def _mark_sent(self, db, rows: list):
+        db.execute(
+            update(OutboxEvent)
+            .where(OutboxEvent.id.in_([row.id for row in rows]))
+            .values(status="sent", sent_at=datetime.utcnow(), attempts=OutboxEvent.attempts + 1,
+                    last_error=None, claimed_until=None, next_attempt_at=None)
+        )
+        db.commit()
+
+    def _mark_failed(self, db, rows: list, error: str, dead: bool):
+        values = {"attempts": OutboxEvent.attempts + 1, "last_error": error[:1000], "claimed_until": None}
+        if dead:
+            values["status"] = "dead"
+        else:
+            pause = min(self.max_backoff, 2 ** (rows[0].attempts + 1))
+            values["next_attempt_at"] = datetime.utcnow() + timedelta(seconds=pause)
+        db.execute(update(OutboxEvent).where(OutboxEvent.id.in_([row.id for row in rows])).values(**values))
+        db.commit()
+
+    def _prune(self, session_factory):
+        db = session_factory()
+        try:
+            db.execute(delete(OutboxEvent).where(
+                OutboxEvent.status == "sent",
+                OutboxEvent.sent_at < datetime.utcnow() - self.retention,
+            ))
+            db.commit()
+        finally:
+            db.close()
+
+    # ---------- HTTP ----------
+
+    @staticmethod
+    def _body(rows: list) -> str:
+        events = [
+            {
+                "id": row.id,
+                "type": row.event_type,
+                "lead_id": row.lead_id,
+                "occurred_at": row.created_at.isoformat(),
+                "lead": json.loads(row.payload),
+            }
+            for row in rows
+        ]
+        return json.dumps({"events": events}, ensure_ascii=False)
+
+    async def _post(self, rows: list):
+        if self._http is None:
+            self._http = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.timeout))
+        headers = {"Content-Type": "application/json"}
+        if self.token:
+            headers["Authorization"] = f"Bearer {self.token}"
+        try:
+            async with self._http.post(self.url, data=self._body(rows).encode("utf-8"), headers=headers) as response:
+                if response.status < 300:
+                    return
+                detail = (await response.text())[:200]
+                retry_after = response.headers.get("Retry-After")
+                raise DeliveryError(
+                    f"HTTP {response.status}: {detail}",
+                    retryable=response.status >= 500 or response.status in RETRYABLE_STATUSES,
+                    retry_after=float(retry_after) if retry_after and retry_after.isdigit() else None,
+                )
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise DeliveryError(f"{type(e).__name__}: {e}") from e
+
+    # ---------- Цикл ----------
+
+    async def relay_once(self, session_factory) -> Optional[float]:
+        """
+        Отправить одну пачку. Возвращает паузу до следующей попытки:
+        0 — можно сразу дальше, None — событий нет (ждать poll_interval).
+        """
+        db = session_factory()
+        try:
+            rows = await asyncio.to_thread(self._claim, db)
+            if not rows:
+                return None
+
+            try:
+                await self._post(rows)
+            except DeliveryError as e:
+                if len(rows) > 1:
+                    # Кто-то из пачки не нравится CRM (или CRM лежит) — найти его, отправляя по одному
+                    self._isolate_until = rows[-1].id
+                if not e.retryable and len(rows) > 1:
+                    await asyncio.to_thread(self._mark_failed, db, rows, str(e), False)
+                    OUTBOX_EVENTS.inc("rejected", amount=len(rows))
+                    return 0
+
+                attempts = rows[0].attempts + 1
+                if e.retryable:
+                    # Падает только это событие, а другие CRM принимает — ждать его дальше незачем
+                    dead = len(rows) == 1 and attempts >= self.max_retry_attempts and self._crm_alive()
+                else:
+                    dead = attempts >= self.max_attempts
+                await asyncio.to_thread(self._mark_failed, db, rows, str(e), dead)
+                if dead:
+                    logger.error("CRM не принимает событие %s (заявка %s): %s", rows[0].id, rows[0].lead_id, e)
+                    OUTBOX_EVENTS.inc("dead")
+                    self._isolate_until = 0
+                    return 0
+                if attempts == self.max_retry_attempts:
+                    logger.error("Событие %s (заявка %s) не доставлено за %d попыток: %s",
+                                 rows[0].id, rows[0].lead_id, attempts, e)
+                OUTBOX_EVENTS.inc("retry", amount=len(rows))
+                self._failures += 1
+                delay = e.retry_after or min(self.max_backoff, 2 ** self._failures)
+                logger.warning("Выгрузка в CRM не удалась, повтор через %.0f с: %s", delay, e)
+                return delay
+
+            await asyncio.to_thread(self._mark_sent, db, rows)
+            OUTBOX_EVENTS.inc("sent", amount=len(rows))
+            self._failures = 0
+            self._delivered_at = time.monotonic()
+            return 0
+        finally:
+            db.close()
+
+    def _crm_alive(self) -> bool:
+        """CRM недавно приняла пачку — значит, ошибка в самом событии, а не в CRM"""
+        return self._delivered_at > 0 and time.monotonic() - self._delivered_at < 2 * self.max_backoff
+
+    def wake(self):
+        self._wake.set()
+
+    async def run(self, session_factory):
+        while True:
+            try:
+                delay = await self.relay_once(session_factory)
+                if time.monotonic() - self._pruned_at > 3600:
+                    self._pruned_at = time.monotonic()
+                    await asyncio.to_thread(self._prune, session_factory)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Ошибка выгрузки в CRM: %s", e)
+                self._failures += 1
+                delay = min(self.max_backoff, 2 ** self._failures)
+
+            if delay == 0:
+                continue
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), delay or self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self, session_factory):
+        if self._task is None:
+            self._task = asyncio.create_task(self.run(session_factory))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._http is not None:
+            await self._http.close()
+            self._http = None
+
+
+relay = OutboxRelay(config.CRM_WEBHOOK_URL, config.CRM_WEBHOOK_TOKEN, config.CRM_BATCH)
+
+
+# ==================== ЗАГЛУШКА CRM ====================
+
+class StubCRM:
+    """
+    Локальный приёмник событий: отбрасывает повторные id (как должна
+    настоящая CRM) и считает события, пришедшие по заявке не по порядку.
+    """
+
+    def __init__(self, fail_rate: float = 0.0, verbose: bool = False):
+        self.fail_rate = fail_rate
+        self.verbose = verbose
+        self.seen: set = set()
+        self.last_event: Dict[int, int] = {}   # lead_id → id последнего применённого события
+        self.leads: Dict[int, dict] = {}
+        self.stats = {"requests": 0, "failed": 0, "events": 0, "duplicates": 0, "out_of_order": 0}
+        self._runner: Optional[web.AppRunner] = None
+
+    async def handle(self, request: web.Request) -> web.Response:
+        self.stats["requests"] += 1
+        body = await request.json()
+        if random.random() < self.fail_rate:
+            self.stats["failed"] += 1
+            return web.Response(status=503, text="stub: simulated failure")
+
+        for item in body["events"]:
+            if item["id"] in self.seen:
+                self.stats["duplicates"] += 1
+                continue
+            self.seen.add(item["id"])
+            if item["id"] < self.last_event.get(item["lead_id"], 0):
+                self.stats["out_of_order"] += 1
+            self.last_event[item["lead_id"]] = item["id"]
+            self.leads[item["lead_id"]] = item["lead"]
+            self.stats["events"] += 1
+            if self.verbose:
+                lead = item["lead"]
+                print(f"#{item['id']} {item['type']} заявка {item['lead_id']}: {lead['status']} {lead['phone'] or ''}")
+        return web.json_response({"accepted": len(body["events"])})
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        app = web.Application()
+        app.router.add_post("/events", self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return f"http://{host}:{port}/events"
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+
+
+async def _serve_stub(args):
+    stub = StubCRM(args.fail_rate, verbose=True)
+    url = await stub.start(args.host, args.port)
+    print(f"Заглушка CRM: {url} (ошибок: {args.fail_rate:.0%}), Ctrl+C — выход")
+    try:
+        while True:
+            await asyncio.sleep(3600)
+    finally:
+        await stub.stop()
+        print(stub.stats)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Выгрузка заявок в CRM")
+    arg_parser.add_argument("--stub", action="store_true", help="Запустить локальную заглушку CRM")
+    arg_parser.add_argument("--host", default="127.0.0.1")
+    arg_parser.add_argument("--port", type=int, default=8099)
+    arg_parser.add_argument("--fail-rate", type=float, default=0.0, help="Доля запросов, на которые заглушка отвечает 503")
+    args = arg_parser.parse_args()
+
+    if not args.stub:
+        arg_parser.error("укажите --stub")
+    try:
+        asyncio.run(_serve_stub(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
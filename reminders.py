@@ -0,0 +1,475 @@
+"""
+Отложенные сообщения: "вы не закончили заявку", напоминание админу
+о заявке без ответа, напоминания клиенту о визите.
+
+Задачи живут в scheduled_jobs и переживают рестарт. В памяти — куча
+ближайших (run_at, key) на горизонт HORIZON: планирование O(log n),
+цикл спит до ближайшей задачи. Задачи дальше горизонта (хоть сотни тысяч)
+лежат только в БД и подтягиваются по индексу (status, run_at).
+
+Хендлеры только планируют: schedule()/cancel() кладут запись в буфер,
+в БД она уходит пачкой из фоновой задачи (как телеметрия воронки).
+
+Несколько инстансов бота: задачу выполняет тот, кто её арендовал условным
+UPDATE (на Postgres — через SELECT ... FOR UPDATE SKIP LOCKED); аренда
+упавшего воркера истекает, и задачу берёт другой. Доставка at-least-once:
+если процесс упал между отправкой и отметкой done, сообщение уйдёт ещё раз.
+"""
+import asyncio
+import heapq
+import json
+import logging
+import os
+import socket
+import time
+import uuid
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from aiogram.fsm.storage.base import BaseStorage, StorageKey
+from sqlalchemy import and_, delete, or_, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+
+import config
+import metrics
+from database import Lead, LeadCard, LeadStatus, ScheduledJob
+
+logger = logging.getLogger(__name__)
+
+JOBS = metrics.Counter("bot_scheduled_jobs_total", "Выполненные отложенные задачи", ["kind", "result"])
+JOB_DELAY = metrics.Histogram("bot_scheduled_job_delay_seconds", "Опоздание выполнения относительно run_at")
+
+_EPOCH = datetime(1970, 1, 1)
+
+
+def _ts(moment: datetime) -> float:
+    """naive UTC datetime → unix time"""
+    return (moment - _EPOCH).total_seconds()
+
+
+@dataclass
+class JobContext:
+    bot: object
+    storage: BaseStorage
+    session_factory: object
+    scheduler: "Scheduler"
+
+
+Handler = Callable[[JobContext, dict], Awaitable[None]]
+
+
+class Scheduler:
+    def __init__(
+        self,
+        horizon: float = 300.0,
+        refresh_interval: float = 30.0,
+        tick: float = 1.0,
+        lease: float = 120.0,
+        batch_size: int = 100,
+        max_attempts: int = 3,
+        retention: timedelta = timedelta(days=7),
+    ):
+        self.horizon = horizon
+        self.refresh_interval = refresh_interval
+        self.tick = tick
+        self.lease = lease
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.retention = retention
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+        self._handlers: Dict[str, Handler] = {}
+        self._heap: list = []                        # (run_at, key)
+        self._queued: Dict[str, float] = {}          # key → актуальный run_at в куче (остальное — устаревшие записи)
+        self._writes: Dict[str, Optional[dict]] = {}  # key → строка для upsert или None (отменить)
+        self._task: Optional[asyncio.Task] = None
+        self.context: Optional[JobContext] = None
+
+    def handler(self, kind: str):
+        """Декоратор: обработчик задач вида kind"""
+        def register(function: Handler) -> Handler:
+            self._handlers[kind] = function
+            return function
+        return register
+
+    # ---------- Планирование (без запросов к БД) ----------
+
+    def schedule(self, kind: str, key: str, run_at: datetime, payload: dict = None):
+        """Запланировать задачу на run_at (naive UTC); задача с тем же key заменяется"""
+        self._writes[key] = {
+            "key": key,
+            "kind": kind,
+            "payload": json.dumps(payload or {}, ensure_ascii=False),
+            "run_at": run_at,
+        }
+        self._push(key, _ts(run_at))
+
+    def cancel(self, key: str):
+        self._writes[key] = None
+        self._queued.pop(key, None)
+
+    def _push(self, key: str, run_at: float):
+        if run_at > time.time() + self.horizon or self._queued.get(key) == run_at:
+            return
+        self._queued[key] = run_at
+        heapq.heappush(self._heap, (run_at, key))
+
+    @property
+    def queued(self) -> int:
+        return len(self._queued)
+
+    # ---------- БД (в потоке) ----------
+
+    def _write(self, session_factory, writes: Dict[str, Optional[dict]]):
+        now = datetime.utcnow()
+        upserts = [dict(row, updated_at=now) for row in writes.values() if row]
+        cancels = [key for key, row in writes.items() if row is None]
+
+        db = session_factory()
+        try:
+            if upserts:
+                _upsert_jobs(db, upserts)
+            if cancels:
+                db.execute(
+                    update(ScheduledJob)
+                    .where(ScheduledJob.key.in_(cancels), ScheduledJob.status == "pending")
+                    .values(status="cancelled", updated_at=now)
+                )
+            db.commit()
+        finally:
+            db.close()
+
+    def _load_due(self, session_factory) -> list:
+        """Ключи задач на ближайший горизонт + задачи с истёкшей арендой"""
+        now = datetime.utcnow()
+        db = session_factory()
+        try:
+            return db.execute(
+                select(ScheduledJob.key, ScheduledJob.run_at).where(or_(
+                    and_(ScheduledJob.status == "pending", ScheduledJob.run_at <= now + timedelta(seconds=self.horizon)),
+                    and_(ScheduledJob.status == "running", ScheduledJob.locked_until < now),
+                )).order_by(ScheduledJob.run_at).limit(50000)
+            ).all()
+        finally:
+            db.close()
+
+    def _claim(self, session_factory, keys: List[str]) -> list:
+        """Арендовать наступившие задачи; возвращает только взятые этим воркером"""
+        now = datetime.utcnow()
+        claimable = and_(
+            ScheduledJob.key.in_(keys),
+            or_(
+                and_(ScheduledJob.status == "pending", ScheduledJob.run_at <= now),
+                and_(ScheduledJob.status == "running", ScheduledJob.locked_until < now),
+            ),
+        )
+        values = dict(
+            status="running",
+            locked_by=self.worker_id,
+            locked_until=now + timedelta(seconds=self.lease),
+            attempts=ScheduledJob.attempts + 1,
+            updated_at=now,
+        )
+        columns = (ScheduledJob.key, ScheduledJob.kind, ScheduledJob.payload, ScheduledJob.run_at, ScheduledJob.attempts)
+
+        db = session_factory()
+        try:
+            dialect = db.get_bind().dialect
+            if dialect.name == "postgresql":
+                # Строки, которые прямо сейчас берёт другой воркер, пропускаем, а не ждём
+                locked = select(ScheduledJob.id).where(claimable).with_for_update(skip_locked=True)
+                rows = db.execute(
+                    update(ScheduledJob).where(ScheduledJob.id.in_(locked)).values(**values).returning(*columns)
+                ).all()
+            elif dialect.update_returning:
+                rows = db.execute(update(ScheduledJob).where(claimable).values(**values).returning(*columns)).all()
+            else:
+                rows = []
+                for key in keys:
+                    claimed = db.execute(
+                        update(ScheduledJob).where(claimable, ScheduledJob.key == key).values(**values)
+                    ).rowcount
+                    if claimed:
+                        rows.append(db.execute(select(*columns).where(ScheduledJob.key == key)).one())
+            db.commit()
+            return rows
+        finally:
+            db.close()
+
+    def _complete(self, session_factory, results: list):
+        """results: (key, status, run_at для повтора или None)"""
+        now = datetime.utcnow()
+        db = session_factory()
+        try:
+            for key, status, retry_at in results:
+                values = {"status": status, "locked_by": None, "locked_until": None, "updated_at": now}
+                if retry_at:
+                    values["run_at"] = retry_at
+                db.execute(
+                    update(ScheduledJob)
+                    .where(ScheduledJob.key == key, ScheduledJob.locked_by == self.worker_id, ScheduledJob.status == "running")
+                    .values(**values)
+                )
+            db.commit()
+        finally:
+            db.close()
+
+    def _prune(self, session_factory):
+        db = session_factory()
+        try:
+            db.execute(delete(ScheduledJob).where(
+                ScheduledJob.status.in_(["done", "cancelled", "failed"]),
+                ScheduledJob.updated_at < datetime.utcnow() - self.retention,
+            ))
+            db.commit()
+        finally:
+            db.close()
+
+    # ---------- Цикл ----------
+
+    async def flush(self, session_factory):
+        if not self._writes:
+            return
+        writes, self._writes = self._writes, {}
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(None, self._write, session_factory, writes)
+        except Exception as e:
+            # Вернём в буфер (не затирая то, что успели запланировать заново)
+            self._writes = {**writes, **self._writes}
+            logger.warning("Не удалось записать %d отложенных задач: %s", len(writes), e)
+
+    async def _refresh(self, session_factory):
+        loop = asyncio.get_running_loop()
+        for key, run_at in await loop.run_in_executor(None, self._load_due, session_factory):
+            # Запись в буфере новее того, что в БД
+            if key not in self._writes:
+                self._push(key, _ts(run_at))
+
+    async def _run_job(self, row) -> tuple:
+        handler = self._handlers.get(row.kind)
+        if handler is None:
+            logger.error("Нет обработчика для задач %s (%s)", row.kind, row.key)
+            JOBS.inc(row.kind, "failed")
+            return row.key, "failed", None
+
+        JOB_DELAY.observe(max(0.0, time.time() - _ts(row.run_at)))
+        try:
+            await asyncio.wait_for(handler(self.context, json.loads(row.payload or "{}")), timeout=self.lease / 2)
+        except Exception as e:
+            if row.attempts < self.max_attempts:
+                logger.warning("Задача %s упала (попытка %d), повторим: %s", row.key, row.attempts, e)
+                JOBS.inc(row.kind, "retry")
+                return row.key, "pending", datetime.utcnow() + timedelta(minutes=row.attempts)
+            logger.error("Задача %s не выполнена за %d попыток: %s", row.key, row.attempts, e)
+            JOBS.inc(row.kind, "failed")
+            return row.key, "failed", None
+
+        JOBS.inc(row.kind, "done")
+        return row.key, "done", None
+
+    async def _execute(self, session_factory, keys: List[str]):
+        loop = asyncio.get_running_loop()
+        rows = await loop.run_in_executor(None, self._claim, session_factory, keys)
+        if not rows:
+            return
+        results = await asyncio.gather(*(self._run_job(row) for row in rows))
+        await loop.run_in_executor(None, self._complete, session_factory, results)
+
+    def _pop_due(self) -> List[str]:
+        now = time.time()
+        due = []
+        while self._heap and self._heap[0][0] <= now and len(due) < self.batch_size:
+            run_at, key = heapq.heappop(self._heap)
+            if self._queued.get(key) == run_at:
+                del self._queued[key]
+                due.append(key)
+        return due
+
+    async def run(self, session_factory):
+        last_refresh = 0.0
+        last_prune = time.monotonic()
+
+        while True:
+            try:
+                await self.flush(session_factory)
+
+                if time.monotonic() - last_refresh >= self.refresh_interval:
+                    await self._refresh(session_factory)
+                    last_refresh = time.monotonic()
+
+                if time.monotonic() - last_prune >= 3600:
+                    await asyncio.get_running_loop().run_in_executor(None, self._prune, session_factory)
+                    last_prune = time.monotonic()
+
+                due = self._pop_due()
+                if due:
+                    await self._execute(session_factory, due)
+                    continue
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("Планировщик напоминаний: %s", e)
+
+            next_at = self._heap[0][0] - time.time() if self._heap else self.tick
+            await asyncio.sleep(max(0.0, min(self.tick, next_at)))
+
+    def start(self, bot, session_factory, storage: BaseStorage):
+        self.context = JobContext(bot=bot, storage=storage, session_factory=session_factory, scheduler=self)
+        self._task = asyncio.create_task(self.run(session_factory))
+
+    async def stop(self, session_factory):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        await self.flush(session_factory)
+
+
+def _upsert_jobs(db, rows: list):
+    """Вставить задачи; существующая с тем же key перепланируется"""
+    reset = {"status": "pending", "attempts": 0, "locked_by": None, "locked_until": None}
+    dialect = db.get_bind().dialect.name
+
+    if dialect in ("postgresql", "sqlite"):
+        insert = postgresql.insert if dialect == "postgresql" else sqlite.insert
+        stmt = insert(ScheduledJob)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[ScheduledJob.key],
+            set_={
+                "kind": stmt.excluded.kind,
+                "payload": stmt.excluded.payload,
+                "run_at": stmt.excluded.run_at,
+                "updated_at": stmt.excluded.updated_at,
+                **reset,
+            },
+        )
+        db.execute(stmt, [dict(row, **reset) for row in rows])
+        return
+
+    for row in rows:
+        updated = db.execute(
+            update(ScheduledJob).where(ScheduledJob.key == row["key"]).values(**row, **reset)
+        ).rowcount
+        if not updated:
+            db.execute(ScheduledJob.__table__.insert().values(**row, **reset))
+
+
+scheduler = Scheduler()
+
+
+# ==================== ВРЕМЯ СТУДИИ ====================
+
+def to_utc(local: datetime) -> datetime:
+    """Местное время студии → naive UTC"""
+    return local - timedelta(hours=config.STUDIO_UTC_OFFSET)
+
+
+def to_local(utc: datetime) -> datetime:
+    return utc + timedelta(hours=config.STUDIO_UTC_OFFSET)
+
+
+def daytime(run_at: datetime) -> datetime:
+    """Не пишем клиентам ночью: перенос на ближайшие 10:00–21:00 по времени студии"""
+    local = to_local(run_at)
+    if local.hour < 10:
+        local = local.replace(hour=10, minute=0, second=0, microsecond=0)
+    elif local.hour >= 21:
+        local = (local + timedelta(days=1)).replace(hour=10, minute=0, second=0, microsecond=0)
+    return to_utc(local)
+
+
+# ==================== ЗАДАЧИ ====================
+
+def schedule_funnel_nudge(user_id: int, step: str):
+    """Клиент на шаге воронки: если застрянет на нём — напомнить"""
+    run_at = daytime(datetime.utcnow() + timedelta(minutes=config.NUDGE_AFTER_MIN))
+    scheduler.schedule("funnel_nudge", f"nudge:{user_id}", run_at, {"user_id": user_id, "step": step})
+
+
+def cancel_funnel_nudge(user_id: int):
+    scheduler.cancel(f"nudge:{user_id}")
+
+
+def schedule_admin_followup(lead_id: int, repeat: int = 1):
+    """Заявка ушла админу: если останется новой — напомнить админу"""
+    run_at = datetime.utcnow() + timedelta(minutes=config.FOLLOWUP_AFTER_MIN)
+    scheduler.schedule("admin_followup", f"followup:{lead_id}", run_at, {"lead_id": lead_id, "repeat": repeat})
+
+
+def schedule_visit_reminder(lead_id: int, user_id: int, visit_at: datetime):
+    """
+    Напоминания клиенту о визите: за сутки и за 2 часа.
+
+    visit_at — местное время студии.
+    """
+    visit_utc = to_utc(visit_at)
+    for label, before in (("24h", timedelta(hours=24)), ("2h", timedelta(hours=2))):
+        run_at = visit_utc - before
+        if run_at > datetime.utcnow():
+            scheduler.schedule(
+                "visit_reminder", f"visit:{lead_id}:{label}", run_at,
+                {"lead_id": lead_id, "user_id": user_id, "visit_at": visit_at.isoformat()},
+            )
+
+
+@scheduler.handler("funnel_nudge")
+async def funnel_nudge(ctx: JobContext, payload: dict):
+    user_id = payload["user_id"]
+    key = StorageKey(bot_id=ctx.bot.id, chat_id=user_id, user_id=user_id)
+
+    # Клиент уже ушёл с этого шага (или бот перезапускался и состояние потеряно)
+    if await ctx.storage.get_state(key) != payload["step"]:
+        return
+
+    await ctx.bot.send_message(
+        user_id,
+        "Вы не закончили заявку 🙂\n\n"
+        "Ответьте на последний вопрос выше — и администратор свяжется с вами. "
+        "Если планы поменялись, просто вернитесь в главное меню."
+    )
+
+
+@scheduler.handler("admin_followup")
+async def admin_followup(ctx: JobContext, payload: dict):
+    lead_id = payload["lead_id"]
+    db = ctx.session_factory()
+    try:
+        lead = db.get(Lead, lead_id)
+        if not lead or lead.status != LeadStatus.NEW:
+            return
+        card = db.query(LeadCard).filter(
+            LeadCard.lead_id == lead_id, LeadCard.chat_id == config.ADMIN_CHAT_ID
+        ).order_by(LeadCard.id.desc()).first()
+        waiting_min = int((datetime.utcnow() - lead.created_at).total_seconds() // 60)
+    finally:
+        db.close()
+
+    await ctx.bot.send_message(
+        config.ADMIN_CHAT_ID,
+        f"⏰ Заявка #{lead_id} без ответа уже {waiting_min} мин",
+        reply_to_message_id=card.message_id if card else None,
+    )
+
+    repeat = payload.get("repeat", 1)
+    if repeat < config.FOLLOWUP_REPEATS:
+        schedule_admin_followup(lead_id, repeat + 1)
+
+
+@scheduler.handler("visit_reminder")
+async def visit_reminder(ctx: JobContext, payload: dict):
+    db = ctx.session_factory()
+    try:
+        lead = db.get(Lead, payload["lead_id"])
+        if not lead or lead.status in (LeadStatus.REJECTED, LeadStatus.COMPLETED):
+            return
+    finally:
+        db.close()
+
+    visit_at = datetime.fromisoformat(payload["visit_at"])
+    await ctx.bot.send_message(
+        payload["user_id"],
+        f"Напоминаем: ждём вас {visit_at.strftime('%d.%m в %H:%M')} 🚗\n\n"
+        f"{config.STUDIO_ADDRESS}\n\n"
+        f"Карта: {config.STUDIO_MAP_URL}"
+    )
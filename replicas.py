@@ -0,0 +1,141 @@
+"""
+Чтение с реплик: сессии для админских списков и отчётов идут на реплику,
+если её отставание от primary не больше REPLICA_MAX_LAG_S, иначе — на primary.
+
+Запись (воронка клиентов, статусы, реестр карточек) всегда через db_session
+на primary; реплики здесь только читаются.
+
+Отставание проверяет фоновая задача (start/stop) в потоке: выбор реплики в
+хендлере читает только сохранённый результат и в сеть не ходит, а мёртвая
+реплика не держит event loop — у её движка те же таймауты, что у primary
+(spool.engine_options). Нет свежей проверки — реплика считается недоступной.
+
+Локально для проверки маршрутизации хватит второго подключения к тому же
+SQLite-файлу в режиме только чтения:
+
+    DATABASE_URL=sqlite:///bot.db
+    DATABASE_REPLICA_URLS=sqlite:///file:bot.db?mode=ro&uri=true
+"""
+import asyncio
+import itertools
+import logging
+import time
+from typing import List, Optional
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import Session, sessionmaker
+
+import metrics
+import spool
+
+logger = logging.getLogger(__name__)
+
+READ_SESSIONS = metrics.Counter("bot_db_read_sessions_total", "Сессии только для чтения по цели", ["target"])
+REPLICA_LAG = metrics.Gauge("bot_db_replica_lag_seconds", "Отставание реплики при последней проверке", ["replica"])
+
+# Отставание hot standby: 0, если всё полученное WAL уже применено
+# (иначе на простаивающем primary "отставание" растёт само по себе)
+PG_LAG_SQL = text(
+    "SELECT CASE "
+    "WHEN NOT pg_is_in_recovery() THEN 0 "
+    "WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+    "ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END"
+)
+
+
+class _Replica:
+    def __init__(self, name: str, engine):
+        self.name = name
+        self.engine = engine
+        self.factory = sessionmaker(bind=engine)
+        self.lag: Optional[float] = None  # None — недоступна
+        self.checked_at = 0.0
+
+
+class ReadSessionRouter:
+    """Фабрика сессий для чтения: вызывается как sessionmaker"""
+
+    def __init__(self, primary_factory, replica_engines: list = (), max_lag: float = 10.0, check_interval: float = 5.0):
+        self.primary_factory = primary_factory
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.replicas: List[_Replica] = [
+            _Replica(f"replica{index}", engine) for index, engine in enumerate(replica_engines)
+        ]
+        self._round_robin = itertools.cycle(self.replicas) if self.replicas else None
+        self._task: Optional[asyncio.Task] = None
+
+    def _check(self, replica: _Replica):
+        """Обновить отставание реплики (блокирующий запрос — вызывается в потоке)"""
+        try:
+            with replica.engine.connect() as conn:
+                if replica.engine.dialect.name == "postgresql":
+                    replica.lag = float(conn.execute(PG_LAG_SQL).scalar())
+                else:
+                    # Не Postgres (локальная проверка) — отставания нет
+                    conn.execute(text("SELECT 1"))
+                    replica.lag = 0.0
+        except Exception as e:
+            if replica.lag is not None:
+                logger.warning("Реплика %s недоступна: %s", replica.name, e)
+            replica.lag = None
+        replica.checked_at = time.monotonic()
+
+        REPLICA_LAG.set(-1 if replica.lag is None else replica.lag, replica.name)
+
+    def check_all(self):
+        for replica in self.replicas:
+            self._check(replica)
+
+    async def run(self):
+        while True:
+            await asyncio.to_thread(self.check_all)
+            await asyncio.sleep(self.check_interval)
+
+    def start(self):
+        if self.replicas and self._task is None:
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    def _healthy(self, replica: _Replica, now: float) -> bool:
+        # Проверка зависла или задача не запущена — данным о реплике не верим
+        fresh = now - replica.checked_at <= 3 * self.check_interval
+        return fresh and replica.lag is not None and replica.lag <= self.max_lag
+
+    def _pick(self) -> Optional[_Replica]:
+        now = time.monotonic()
+        for _ in range(len(self.replicas)):
+            replica = next(self._round_robin)
+            if self._healthy(replica, now):
+                return replica
+        return None
+
+    def __call__(self) -> Session:
+        replica = self._pick() if self.replicas else None
+        if replica is None:
+            READ_SESSIONS.inc("primary")
+            return self.primary_factory()
+
+        READ_SESSIONS.inc(replica.name)
+        return replica.factory()
+
+
+def init_read_sessions(primary_factory, replica_urls: List[str], max_lag: float, **engine_kwargs) -> ReadSessionRouter:
+    """
+    Роутер сессий для чтения; без реплик всегда отдаёт сессии primary.
+
+    Проверку отставания запускает start(), до первой проверки чтение идёт с primary.
+    """
+    engines = [create_engine(url, **{**spool.engine_options(url), **engine_kwargs}) for url in replica_urls if url]
+    if engines:
+        logger.info("Реплик для чтения: %d (допустимое отставание %s с)", len(engines), max_lag)
+    return ReadSessionRouter(primary_factory, engines, max_lag=max_lag)
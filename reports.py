@@ -0,0 +1,497 @@
+"""
+Отчёты для владельца: конверсия воронки по услугам, время первого ответа,
+доля срочных заявок и объёмы по услугам.
+
+Строки Lead и агрегаты по Message читаются потоком (server-side cursor),
+всё считается за один проход с ограниченной памятью.
+
+Запуск офлайн:
+    python reports.py --out report_output/ --format csv
+    python reports.py funnel --since 2024-01-01
+"""
+import argparse
+import bisect
+import csv
+import io
+import math
+import os
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from sqlalchemy import case, func, select
+from sqlalchemy.orm import Session
+
+from database import FunnelEvent, Lead, LeadStatus, Message
+from states import MainMenu, PPFFlow
+
+# Сколько строк тянуть из курсора за раз
+STREAM_BATCH_SIZE = 2000
+
+# Этапы воронки в порядке прохождения
+FUNNEL_STAGES = ["created", "car", "time", "phone", "taken", "completed"]
+
+FUNNEL_STAGE_NAMES = {
+    "created": "Начали заявку",
+    "car": "Указали авто",
+    "time": "Указали время",
+    "phone": "Оставили телефон",
+    "taken": "Взяты в работу",
+    "completed": "Выполнены",
+}
+
+# Шаги FSM в порядке воронки (для отчёта по отвалам)
+FUNNEL_STEPS = [MainMenu.choosing_service.state] + [step.state for step in PPFFlow.__all_states__]
+
+# Выходы из шага, которые означают, что клиент бросил заявку
+ABANDON_OUTCOMES = ("menu", "restart")
+
+
+# ==================== ПОТОКОВАЯ ГИСТОГРАММА ====================
+
+class StreamingHistogram:
+    """
+    Гистограмма с логарифмическими корзинами для перцентилей за один проход.
+
+    Память фиксирована (число корзин), относительная ошибка перцентиля —
+    не больше шага корзины (по умолчанию 10%).
+    """
+
+    def __init__(self, min_value: float = 1.0, max_value: float = 60 * 60 * 24 * 60, growth: float = 1.1):
+        self.bounds: List[float] = []
+        bound = min_value
+        while bound < max_value:
+            self.bounds.append(bound)
+            bound *= growth
+        self.bounds.append(max_value)
+
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min: Optional[float] = None
+        self.max: Optional[float] = None
+
+    def add(self, value: float):
+        """Добавить значение"""
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def percentile(self, p: float) -> Optional[float]:
+        """Перцентиль (0..100) — верхняя граница корзины, в которую он попал"""
+        if not self.count:
+            return None
+
+        rank = max(1, math.ceil(self.count * p / 100))
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= rank:
+                if index >= len(self.bounds):
+                    return self.max
+                return min(self.bounds[index], self.max)
+
+        return self.max
+
+    def mean(self) -> Optional[float]:
+        if not self.count:
+            return None
+        return self.total / self.count
+
+
+# ==================== АГРЕГАЦИЯ ====================
+
+class LeadReport:
+    """Агрегаты отчёта, заполняемые за один проход по заявкам"""
+
+    def __init__(self, since: Optional[datetime] = None):
+        self.since = since
+        self.funnel: Dict[str, Dict[str, int]] = {}
+        self.messages_by_service: Dict[str, int] = {}
+        self.urgent_by_service: Dict[str, int] = {}
+        self.red_flags = 0
+        self.response_time = StreamingHistogram()
+        self.response_time_by_service: Dict[str, StreamingHistogram] = {}
+        self.leads_total = 0
+        self.urgent_total = 0
+
+    def add_lead(self, row, first_admin_reply_at: Optional[datetime], messages_count: int):
+        """Учесть одну заявку"""
+        service = row.service or "unknown"
+
+        stages = self.funnel.get(service)
+        if stages is None:
+            stages = self.funnel[service] = dict.fromkeys(FUNNEL_STAGES, 0)
+
+        stages["created"] += 1
+        if row.car_brand:
+            stages["car"] += 1
+        if row.preferred_time:
+            stages["time"] += 1
+        if row.phone:
+            stages["phone"] += 1
+        if row.status in (LeadStatus.IN_WORK, LeadStatus.COMPLETED):
+            stages["taken"] += 1
+        if row.status == LeadStatus.COMPLETED:
+            stages["completed"] += 1
+
+        self.leads_total += 1
+        self.messages_by_service[service] = self.messages_by_service.get(service, 0) + messages_count
+
+        if row.is_urgent:
+            self.urgent_total += 1
+            self.urgent_by_service[service] = self.urgent_by_service.get(service, 0) + 1
+
+        if row.is_red_flag:
+            self.red_flags += 1
+
+        if first_admin_reply_at and row.created_at:
+            seconds = (first_admin_reply_at - row.created_at).total_seconds()
+            if seconds >= 0:
+                self.response_time.add(seconds)
+                histogram = self.response_time_by_service.get(service)
+                if histogram is None:
+                    histogram = self.response_time_by_service[service] = StreamingHistogram()
+                histogram.add(seconds)
+
+    # ---------- Табличное представление ----------
+
+    def funnel_table(self) -> Dict[str, list]:
+        """Конверсия воронки по услугам (колонки)"""
+        columns: Dict[str, list] = {"service": [], "stage": [], "leads": [], "conversion": []}
+
+        for service in sorted(self.funnel):
+            stages = self.funnel[service]
+            created = stages["created"] or 1
+            for stage in FUNNEL_STAGES:
+                columns["service"].append(service)
+                columns["stage"].append(stage)
+                columns["leads"].append(stages[stage])
+                columns["conversion"].append(round(stages[stage] / created, 4))
+
+        return columns
+
+    def services_table(self) -> Dict[str, list]:
+        """Объёмы и срочные заявки по услугам (колонки)"""
+        columns: Dict[str, list] = {
+            "service": [], "leads": [], "messages": [], "urgent": [], "urgent_share": []
+        }
+
+        for service in sorted(self.funnel):
+            leads = self.funnel[service]["created"]
+            urgent = self.urgent_by_service.get(service, 0)
+            columns["service"].append(service)
+            columns["leads"].append(leads)
+            columns["messages"].append(self.messages_by_service.get(service, 0))
+            columns["urgent"].append(urgent)
+            columns["urgent_share"].append(round(urgent / leads, 4) if leads else 0.0)
+
+        return columns
+
+    def response_time_table(self) -> Dict[str, list]:
+        """Перцентили времени первого ответа, в секундах (колонки)"""
+        columns: Dict[str, list] = {
+            "service": [], "answered": [], "mean": [], "p50": [], "p90": [], "p99": []
+        }
+
+        rows = [("all", self.response_time)] + sorted(self.response_time_by_service.items())
+        for service, histogram in rows:
+            columns["service"].append(service)
+            columns["answered"].append(histogram.count)
+            columns["mean"].append(_round(histogram.mean()))
+            columns["p50"].append(_round(histogram.percentile(50)))
+            columns["p90"].append(_round(histogram.percentile(90)))
+            columns["p99"].append(_round(histogram.percentile(99)))
+
+        return columns
+
+    def tables(self) -> Dict[str, Dict[str, list]]:
+        return {
+            "funnel_by_service": self.funnel_table(),
+            "services": self.services_table(),
+            "response_time": self.response_time_table(),
+        }
+
+    def as_text(self) -> str:
+        """Краткая сводка для Telegram"""
+        text = "📈 Отчёт по заявкам"
+        if self.since:
+            text += f" с {self.since:%d.%m.%Y}"
+        text += f"\n\nВсего заявок: {self.leads_total}"
+
+        if not self.leads_total:
+            return text
+
+        urgent_share = self.urgent_total / self.leads_total
+        text += f"\n🚨 Срочные: {self.urgent_total} ({urgent_share:.0%})"
+        text += f"\n⚠️ Красные флаги: {self.red_flags}"
+
+        text += "\n\n📋 По услугам:"
+        for service in sorted(self.funnel, key=lambda s: -self.funnel[s]["created"]):
+            stages = self.funnel[service]
+            created = stages["created"]
+            text += (
+                f"\n• {service}: {created} → телефон {stages['phone']} "
+                f"({stages['phone'] / created:.0%}) → в работе {stages['taken']} "
+                f"→ выполнено {stages['completed']} ({stages['completed'] / created:.0%})"
+            )
+
+        text += "\n\n⏱ Первый ответ админа:"
+        if self.response_time.count:
+            text += (
+                f"\nmedian {_format_duration(self.response_time.percentile(50))}, "
+                f"p90 {_format_duration(self.response_time.percentile(90))}, "
+                f"p99 {_format_duration(self.response_time.percentile(99))} "
+                f"(ответов: {self.response_time.count})"
+            )
+        else:
+            text += "\nнет данных"
+
+        return text
+
+
+def build_report(db: Session, since: Optional[datetime] = None) -> LeadReport:
+    """
+    Построить отчёт за один проход.
+
+    Заявки и агрегаты сообщений (по lead_id) читаются двумя потоками,
+    отсортированными по lead_id, и сливаются merge-join'ом — в памяти
+    одновременно держится только текущая пачка строк.
+    """
+    report = LeadReport(since=since)
+
+    leads_query = select(
+        Lead.id,
+        Lead.service,
+        Lead.car_brand,
+        Lead.preferred_time,
+        Lead.phone,
+        Lead.status,
+        Lead.is_urgent,
+        Lead.is_red_flag,
+        Lead.created_at,
+    ).order_by(Lead.id)
+
+    messages_query = select(
+        Message.lead_id,
+        func.min(case((Message.is_from_admin.is_(True), Message.created_at))).label("first_admin_reply_at"),
+        func.count(Message.id).label("messages_count"),
+    ).where(Message.lead_id.isnot(None)).group_by(Message.lead_id).order_by(Message.lead_id)
+
+    if since:
+        leads_query = leads_query.where(Lead.created_at >= since)
+        messages_query = messages_query.where(Message.created_at >= since)
+
+    leads = db.execute(leads_query.execution_options(yield_per=STREAM_BATCH_SIZE))
+
+    # Второму курсору нужно отдельное соединение — первое занято потоком заявок
+    messages_db = Session(bind=db.get_bind())
+    try:
+        messages = iter(messages_db.execute(messages_query.execution_options(yield_per=STREAM_BATCH_SIZE)))
+        current = next(messages, None)
+
+        for row in leads:
+            while current is not None and current.lead_id < row.id:
+                current = next(messages, None)
+
+            if current is not None and current.lead_id == row.id:
+                report.add_lead(row, current.first_admin_reply_at, current.messages_count)
+            else:
+                report.add_lead(row, None, 0)
+    finally:
+        messages_db.close()
+
+    return report
+
+
+# ==================== ОТВАЛЫ ПО ШАГАМ ВОРОНКИ ====================
+
+class FunnelReport:
+    """Входы, выходы и время на каждом шаге FSM по событиям funnel_events"""
+
+    def __init__(self, since: Optional[datetime] = None):
+        self.since = since
+        self.entered: Dict[str, int] = {}
+        self.advanced: Dict[str, int] = {}
+        self.abandoned: Dict[str, int] = {}
+        self.completed: Dict[str, int] = {}
+        self.latency: Dict[str, StreamingHistogram] = {}
+
+    def add_event(self, row):
+        step = row.step
+
+        if row.event == "enter":
+            self.entered[step] = self.entered.get(step, 0) + 1
+            return
+
+        if row.next_step in ABANDON_OUTCOMES:
+            self.abandoned[step] = self.abandoned.get(step, 0) + 1
+        elif row.next_step == "completed":
+            self.completed[step] = self.completed.get(step, 0) + 1
+        else:
+            self.advanced[step] = self.advanced.get(step, 0) + 1
+
+        if row.duration_ms is not None:
+            histogram = self.latency.get(step)
+            if histogram is None:
+                histogram = self.latency[step] = StreamingHistogram(min_value=0.05)
+            histogram.add(row.duration_ms / 1000)
+
+    def steps(self) -> List[str]:
+        known = [step for step in FUNNEL_STEPS if step in self.entered]
+        return known + sorted(set(self.entered) - set(FUNNEL_STEPS))
+
+    def tables(self) -> Dict[str, Dict[str, list]]:
+        columns: Dict[str, list] = {
+            "step": [], "entered": [], "advanced": [], "completed": [],
+            "abandoned": [], "silent": [], "drop_off": [], "p50_s": [], "p90_s": [],
+        }
+
+        for step in self.steps():
+            entered = self.entered[step]
+            advanced = self.advanced.get(step, 0)
+            completed = self.completed.get(step, 0)
+            abandoned = self.abandoned.get(step, 0)
+            # Вошли и больше ничего не сделали
+            silent = max(0, entered - advanced - completed - abandoned)
+            histogram = self.latency.get(step) or StreamingHistogram()
+
+            columns["step"].append(step)
+            columns["entered"].append(entered)
+            columns["advanced"].append(advanced)
+            columns["completed"].append(completed)
+            columns["abandoned"].append(abandoned)
+            columns["silent"].append(silent)
+            columns["drop_off"].append(round((abandoned + silent) / entered, 4))
+            columns["p50_s"].append(_round(histogram.percentile(50)))
+            columns["p90_s"].append(_round(histogram.percentile(90)))
+
+        return {"funnel_steps": columns}
+
+    def as_text(self) -> str:
+        text = "🪜 Отвалы по шагам воронки"
+        if self.since:
+            text += f" с {self.since:%d.%m.%Y}"
+
+        columns = self.tables()["funnel_steps"]
+        if not columns["step"]:
+            return text + "\n\nнет данных"
+
+        for index, step in enumerate(columns["step"]):
+            text += (
+                f"\n\n{step}\n"
+                f"вошли {columns['entered'][index]}, дальше {columns['advanced'][index]}, "
+                f"бросили {columns['abandoned'][index] + columns['silent'][index]} "
+                f"({columns['drop_off'][index]:.0%}), "
+                f"медиана {_format_duration(columns['p50_s'][index])}"
+            )
+
+        return text
+
+
+def build_funnel_report(db: Session, since: Optional[datetime] = None) -> FunnelReport:
+    """Построить отчёт по шагам за один потоковый проход по funnel_events"""
+    report = FunnelReport(since=since)
+
+    query = select(
+        FunnelEvent.step,
+        FunnelEvent.event,
+        FunnelEvent.next_step,
+        FunnelEvent.duration_ms,
+    )
+    if since:
+        query = query.where(FunnelEvent.created_at >= since)
+
+    for row in db.execute(query.execution_options(yield_per=STREAM_BATCH_SIZE)):
+        report.add_event(row)
+
+    return report
+
+
+# ==================== ЭКСПОРТ ====================
+
+def table_to_csv(columns: Dict[str, list]) -> bytes:
+    """Колоночная таблица → CSV (UTF-8 с BOM, чтобы Excel открыл кириллицу)"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    names = list(columns)
+    writer.writerow(names)
+    writer.writerows(zip(*(columns[name] for name in names)))
+    return buffer.getvalue().encode("utf-8-sig")
+
+
+def export_report(report, out_dir: str, fmt: str = "csv") -> List[str]:
+    """Сохранить таблицы отчёта в out_dir (csv или parquet)"""
+    os.makedirs(out_dir, exist_ok=True)
+    paths = []
+
+    for name, columns in report.tables().items():
+        if fmt == "parquet":
+            # pyarrow нужен только для этого формата
+            import pyarrow
+            import pyarrow.parquet
+
+            path = os.path.join(out_dir, f"{name}.parquet")
+            pyarrow.parquet.write_table(pyarrow.table(columns), path)
+        else:
+            path = os.path.join(out_dir, f"{name}.csv")
+            with open(path, "wb") as f:
+                f.write(table_to_csv(columns))
+
+        paths.append(path)
+
+    return paths
+
+
+def _round(value: Optional[float]) -> Optional[float]:
+    return None if value is None else round(value, 1)
+
+
+def _format_duration(seconds: Optional[float]) -> str:
+    if seconds is None:
+        return "—"
+    if seconds < 60:
+        return f"{seconds:.0f} с"
+    if seconds < 3600:
+        return f"{seconds / 60:.0f} мин"
+    return f"{seconds / 3600:.1f} ч"
+
+
+# ==================== CLI ====================
+
+def main():
+    import config
+    from database import init_db
+
+    arg_parser = argparse.ArgumentParser(description="Отчёт по заявкам")
+    arg_parser.add_argument("kind", nargs="?", choices=["leads", "funnel"], default="leads")
+    arg_parser.add_argument("--out", default="report_output", help="Каталог для файлов отчёта")
+    arg_parser.add_argument("--format", choices=["csv", "parquet"], default="csv")
+    arg_parser.add_argument("--since", help="Начальная дата, YYYY-MM-DD")
+    arg_parser.add_argument("--database-url", default=config.DATABASE_URL)
+    args = arg_parser.parse_args()
+
+    if not args.database_url:
+        arg_parser.error("DATABASE_URL не установлен")
+
+    since = datetime.strptime(args.since, "%Y-%m-%d") if args.since else None
+
+    engine, SessionLocal = init_db(args.database_url)
+    db = SessionLocal()
+    try:
+        if args.kind == "funnel":
+            report = build_funnel_report(db, since=since)
+        else:
+            report = build_report(db, since=since)
+    finally:
+        db.close()
+        engine.dispose()
+
+    print(report.as_text())
+    for path in export_report(report, args.out, args.format):
+        print(path)
+
+
+if __name__ == "__main__":
+    main()
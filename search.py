@@ -0,0 +1,209 @@
+"""
+Поиск по заявкам и переписке для админа (/find).
+
+В Postgres — индексы миграции 4 (database.create_search_indexes):
+- полнотекстовый (tsvector, словарь russian) по полям заявки и по messages.text —
+  "белая камри", "скол на капоте", "перезвонить вечером";
+- триграммный (pg_trgm) по телефону и марке/модели — фрагмент номера "4567",
+  опечатка в модели.
+
+В SQLite (локально, loadtest) — триграммный индекс в памяти: строится при
+первом поиске и дальше догружает только изменённые заявки и новые сообщения.
+"""
+import logging
+import re
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, List, Optional, Set, Tuple
+
+from sqlalchemy import text
+
+import metrics
+from database import LEAD_CAR_SQL, LEAD_DOCUMENT_SQL, MESSAGE_DOCUMENT_SQL, Lead, Message
+from faq import normalize
+
+logger = logging.getLogger(__name__)
+
+SEARCH_LATENCY = metrics.Histogram("bot_search_seconds", "Поиск /find по заявкам", ["backend"])
+
+# Совпадение в переписке весит меньше, чем в самой заявке
+MESSAGE_WEIGHT = 0.5
+MIN_PHONE_DIGITS = 4
+
+# Запрос-номер: только цифры и то, чем их разделяют в записи телефона
+_PHONE_QUERY_RE = re.compile(r"[\d\s+()\-.]+")
+
+PG_SEARCH_SQL = text(f"""
+WITH query AS (SELECT websearch_to_tsquery('russian', :query) AS tsq),
+hits AS (
+    SELECT leads.id AS lead_id, ts_rank({LEAD_DOCUMENT_SQL}, query.tsq) AS rank
+    FROM leads, query
+    WHERE {LEAD_DOCUMENT_SQL} @@ query.tsq
+    UNION ALL
+    SELECT lead_id, {MESSAGE_WEIGHT} * ts_rank({MESSAGE_DOCUMENT_SQL}, query.tsq)
+    FROM messages, query
+    WHERE lead_id IS NOT NULL AND {MESSAGE_DOCUMENT_SQL} @@ query.tsq
+    UNION ALL
+    SELECT id, word_similarity(:query, {LEAD_CAR_SQL})
+    FROM leads
+    WHERE :query <% {LEAD_CAR_SQL}
+    UNION ALL
+    SELECT id, CAST(1.0 AS real)
+    FROM leads
+    WHERE :phone_pattern IS NOT NULL AND phone LIKE :phone_pattern
+)
+SELECT lead_id, sum(rank) AS score
+FROM hits
+GROUP BY lead_id
+ORDER BY score DESC, lead_id DESC
+LIMIT :limit
+""")
+
+
+def phone_digits(query: str) -> Optional[str]:
+    """
+    Цифры номера из запроса в формате хранения (+7XXXXXXXXXX) или None.
+
+    Номером считается только запрос без букв: "camry 2020" — это год, а не кусок телефона.
+    """
+    if not _PHONE_QUERY_RE.fullmatch(query.strip()):
+        return None
+    digits = re.sub(r"\D", "", query)
+    if len(digits) < MIN_PHONE_DIGITS:
+        return None
+    if len(digits) == 11 and digits[0] == "8":
+        digits = "7" + digits[1:]
+    return digits
+
+
+# ==================== ИНДЕКС В ПАМЯТИ (SQLite) ====================
+
+def _trigrams(word: str, padded: bool) -> Set[str]:
+    if padded:
+        word = f" {word} "
+    return {word[i:i + 3] for i in range(len(word) - 2)}
+
+
+def _document_trigrams(document: str) -> Set[str]:
+    result = set()
+    for word in normalize(document).split():
+        result |= _trigrams(word, padded=True)
+    return result
+
+
+def _query_trigrams(query: str) -> Set[str]:
+    """Без краевых триграмм: слово запроса может быть куском слова в заявке"""
+    result = set()
+    for word in normalize(query).split():
+        result |= _trigrams(word, padded=len(word) < 3)
+    return result
+
+
+def _lead_document(lead) -> str:
+    return " ".join(filter(None, (
+        lead.car_brand, lead.car_model, lead.car_year and str(lead.car_year),
+        lead.service_variant, lead.goal, lead.comment, lead.preferred_time,
+    )))
+
+
+class TrigramIndex:
+    """Триграмма → id заявок; поля заявки переиндексируются при изменении, сообщения только добавляются"""
+
+    def __init__(self):
+        self.postings: Dict[str, Set[int]] = defaultdict(set)
+        self.lead_trigrams: Dict[int, Set[str]] = {}
+        self.phones: Dict[int, str] = {}
+        self.leads_seen_at: Optional[datetime] = None
+        self.last_message_id = 0
+        self._lock = threading.Lock()
+
+    def _index_lead(self, lead):
+        for trigram in self.lead_trigrams.pop(lead.id, ()):
+            self.postings[trigram].discard(lead.id)
+        trigrams = _document_trigrams(_lead_document(lead))
+        for trigram in trigrams:
+            self.postings[trigram].add(lead.id)
+        self.lead_trigrams[lead.id] = trigrams
+        if lead.phone:
+            self.phones[lead.id] = re.sub(r"\D", "", lead.phone)
+
+    def _index_message(self, lead_id: int, message_text: str):
+        # Триграммы сообщений не удаляются — переписка не редактируется
+        for trigram in _document_trigrams(message_text):
+            self.postings[trigram].add(lead_id)
+
+    def refresh(self, db):
+        """Догрузить заявки, изменённые с прошлого раза, и новые сообщения"""
+        query = db.query(Lead)
+        if self.leads_seen_at is not None:
+            # >= : заявки с той же updated_at могли записаться после прошлого прохода
+            query = query.filter(Lead.updated_at >= self.leads_seen_at)
+        for lead in query.yield_per(1000):
+            self._index_lead(lead)
+            if lead.updated_at and (self.leads_seen_at is None or lead.updated_at > self.leads_seen_at):
+                self.leads_seen_at = lead.updated_at
+
+        rows = db.query(Message.id, Message.lead_id, Message.text).filter(
+            Message.id > self.last_message_id,
+            Message.lead_id.isnot(None),
+            Message.text.isnot(None),
+        ).order_by(Message.id).yield_per(1000)
+        for message_id, lead_id, message_text in rows:
+            self._index_message(lead_id, message_text)
+            self.last_message_id = message_id
+
+    def search(self, db, query: str, limit: int) -> List[Tuple[int, float]]:
+        with self._lock:
+            self.refresh(db)
+
+            scores: Dict[int, float] = defaultdict(float)
+            trigrams = _query_trigrams(query)
+            if trigrams:
+                matched: Dict[int, int] = defaultdict(int)
+                for trigram in trigrams:
+                    for lead_id in self.postings.get(trigram, ()):
+                        matched[lead_id] += 1
+                for lead_id, count in matched.items():
+                    share = count / len(trigrams)
+                    if share >= 0.5:
+                        scores[lead_id] += share
+
+            digits = phone_digits(query)
+            if digits:
+                for lead_id, phone in self.phones.items():
+                    if digits in phone:
+                        scores[lead_id] += 1.0
+
+        return sorted(scores.items(), key=lambda item: (-item[1], -item[0]))[:limit]
+
+
+# ==================== ПОИСК ====================
+
+class LeadSearch:
+    def __init__(self):
+        self.memory_index = TrigramIndex()
+
+    def find(self, db, query: str, limit: int = 10) -> List[Tuple[int, float]]:
+        """(id заявки, релевантность), лучшие первыми; синхронно — вызывать из потока"""
+        backend = db.get_bind().dialect.name
+        started = time.perf_counter()
+
+        if backend == "postgresql":
+            digits = phone_digits(query)
+            rows = db.execute(PG_SEARCH_SQL, {
+                "query": query,
+                "phone_pattern": f"%{digits}%" if digits else None,
+                "limit": limit,
+            }).all()
+            results = [(row.lead_id, float(row.score)) for row in rows]
+        else:
+            backend = "memory"
+            results = self.memory_index.search(db, query, limit)
+
+        SEARCH_LATENCY.observe(time.perf_counter() - started, backend)
+        return results
+
+
+leads = LeadSearch()
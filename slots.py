@@ -0,0 +1,263 @@
+"""
+Запись на время: боксы студии, длительность работ по услуге, свободные слоты.
+
+Занятость каждого бокса — отсортированный список непересекающихся
+интервалов [начало, конец); проверка слота — bisect, O(log n) на бокс.
+Поиск ближайших свободных слотов идёт по сетке SLOT_STEP_MIN внутри
+рабочих часов и при конфликте перепрыгивает сразу на конец мешающей записи.
+
+Длительность — в рабочих минутах: долгая работа (оклейка кузова)
+переходит на следующие рабочие дни, бокс занят и ночью между ними.
+
+Все времена — местное время студии (naive), как в config.*_HOURS.
+Записи хранятся в bookings; другие инстансы видят их при перезагрузке
+индекса (раз в refresh_interval), а двойную запись одного бокса
+отсекает проверка в БД при бронировании.
+"""
+import bisect
+import logging
+import re
+import time
+from datetime import date, datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+import config
+import metrics
+from database import Booking
+
+logger = logging.getLogger(__name__)
+
+BOOKINGS = metrics.Counter("bot_bookings_total", "Бронирования слотов по результату", ["result"])
+
+# Сколько рабочих минут бокс занят под услугу
+SERVICE_DURATIONS = {
+    "ppf": 2 * 540,
+    "color_ppf": 4 * 540,
+    "vinyl": 4 * 540,
+    "polish": 540,
+    "ceramic": 540,
+    "wash": 90,
+    "tint": 180,
+    "cleaning": 480,
+}
+DEFAULT_DURATION = 120
+
+WEEKDAY_NAMES = ["Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс"]
+
+_HOURS_RE = re.compile(r"(\d{1,2}):(\d{2})\D+(\d{1,2}):(\d{2})")
+
+
+def parse_hours(hours: str) -> Optional[Tuple[int, int]]:
+    """"10:00–19:00" → (600, 1140) в минутах от полуночи; выходной — None"""
+    match = _HOURS_RE.search(hours or "")
+    if not match:
+        return None
+    open_h, open_m, close_h, close_m = map(int, match.groups())
+    return open_h * 60 + open_m, close_h * 60 + close_m
+
+
+# Пн–Пт, Сб, Вс
+WORKING_HOURS = [parse_hours(config.WEEKDAY_HOURS)] * 5 + [parse_hours(config.SATURDAY_HOURS), parse_hours(config.SUNDAY_HOURS)]
+
+
+def now_local() -> datetime:
+    return datetime.utcnow() + timedelta(hours=config.STUDIO_UTC_OFFSET)
+
+
+def day_hours(day: date) -> Optional[Tuple[datetime, datetime]]:
+    hours = WORKING_HOURS[day.weekday()]
+    if not hours:
+        return None
+    midnight = datetime.combine(day, datetime.min.time())
+    return midnight + timedelta(minutes=hours[0]), midnight + timedelta(minutes=hours[1])
+
+
+def work_end(start: datetime, minutes: int) -> datetime:
+    """Конец работы длиной minutes рабочих минут, начатой в start"""
+    day = start.date()
+    current = start
+    for _ in range(366):
+        hours = day_hours(day)
+        if hours:
+            opens, closes = hours
+            current = max(current, opens)
+            available = (closes - current).total_seconds() / 60
+            if minutes <= available:
+                return current + timedelta(minutes=minutes)
+            minutes -= max(available, 0)
+        day += timedelta(days=1)
+        current = datetime.combine(day, datetime.min.time())
+    raise ValueError("no working hours")
+
+
+def format_slot(start: datetime) -> str:
+    return f"{WEEKDAY_NAMES[start.weekday()]} {start:%d.%m} в {start:%H:%M}"
+
+
+# ==================== ИНДЕКС ЗАНЯТОСТИ ====================
+
+class BayIndex:
+    """Занятость одного бокса: параллельные отсортированные списки начал и концов"""
+
+    def __init__(self):
+        self.starts: List[datetime] = []
+        self.ends: List[datetime] = []
+
+    def is_free(self, start: datetime, end: datetime) -> Optional[datetime]:
+        """None — свободно; иначе конец записи, которая мешает"""
+        i = bisect.bisect_right(self.starts, start)
+        if i > 0 and self.ends[i - 1] > start:
+            return self.ends[i - 1]
+        if i < len(self.starts) and self.starts[i] < end:
+            return self.ends[i]
+        return None
+
+    def add(self, start: datetime, end: datetime):
+        i = bisect.bisect_right(self.starts, start)
+        self.starts.insert(i, start)
+        self.ends.insert(i, end)
+
+    def remove(self, start: datetime, end: datetime):
+        i = bisect.bisect_left(self.starts, start)
+        while i < len(self.starts) and self.starts[i] == start:
+            if self.ends[i] == end:
+                del self.starts[i]
+                del self.ends[i]
+                return
+            i += 1
+
+
+class SlotEngine:
+    def __init__(
+        self,
+        bays: int = 2,
+        step_minutes: int = 60,
+        min_notice_minutes: int = 60,
+        horizon_days: int = 14,
+        refresh_interval: float = 60.0,
+    ):
+        self.bays = bays
+        self.step = timedelta(minutes=step_minutes)
+        self.min_notice = timedelta(minutes=min_notice_minutes)
+        self.horizon = timedelta(days=horizon_days)
+        self.refresh_interval = refresh_interval
+        self.index: Dict[int, BayIndex] = {bay: BayIndex() for bay in range(1, bays + 1)}
+        self.loaded_at: Optional[float] = None
+
+    def load(self, db: Session):
+        """Перечитать будущие записи из bookings"""
+        index = {bay: BayIndex() for bay in range(1, self.bays + 1)}
+        rows = db.query(Booking.bay, Booking.starts_at, Booking.ends_at).filter(
+            Booking.status == "active",
+            Booking.ends_at > now_local(),
+        ).order_by(Booking.starts_at)
+        for bay, starts_at, ends_at in rows:
+            if bay in index:
+                index[bay].starts.append(starts_at)
+                index[bay].ends.append(ends_at)
+        self.index = index
+        self.loaded_at = time.monotonic()
+
+    def ensure_loaded(self, db: Session):
+        if self.loaded_at is None or time.monotonic() - self.loaded_at > self.refresh_interval:
+            self.load(db)
+
+    def _align(self, moment: datetime) -> datetime:
+        """Вверх до ближайшей точки сетки от начала часа"""
+        midnight = datetime.combine(moment.date(), datetime.min.time())
+        steps = -(-(moment - midnight) // self.step)
+        return midnight + steps * self.step
+
+    def is_bookable(self, start: datetime) -> bool:
+        """Начало из кнопки (callback data — от клиента): в рабочих часах, на сетке, не в прошлом и не за горизонтом"""
+        hours = day_hours(start.date())
+        if not hours or not hours[0] <= start < hours[1] or start != self._align(start):
+            return False
+        now = now_local()
+        return now <= start <= now + self.min_notice + self.horizon + timedelta(days=1)
+
+    def free_slots(self, service: Optional[str], count: int = 6, per_day: int = 2, after: datetime = None) -> List[Tuple[int, datetime]]:
+        """
+        Ближайшие свободные слоты под услугу: [(бокс, начало)], не больше
+        per_day в один день — чтобы было из чего выбрать.
+        """
+        duration = SERVICE_DURATIONS.get(service, DEFAULT_DURATION)
+        earliest = after or now_local() + self.min_notice
+        last_day = earliest.date() + self.horizon
+
+        result = []
+        day = earliest.date()
+        while day <= last_day and len(result) < count:
+            hours = day_hours(day)
+            if hours:
+                opens, closes = hours
+                candidate = self._align(max(opens, earliest))
+                found_today = 0
+                while candidate < closes and found_today < per_day and len(result) < count:
+                    end = work_end(candidate, duration)
+                    next_candidate = None
+                    for bay, bay_index in self.index.items():
+                        blocker_end = bay_index.is_free(candidate, end)
+                        if blocker_end is None:
+                            result.append((bay, candidate))
+                            found_today += 1
+                            break
+                        next_candidate = blocker_end if next_candidate is None else min(next_candidate, blocker_end)
+                    else:
+                        # Все боксы заняты — сразу к ближайшему освобождению
+                        candidate = self._align(max(next_candidate, candidate + self.step))
+                        continue
+                    candidate += self.step
+            day += timedelta(days=1)
+        return result
+
+    def book(self, db: Session, lead_id: int, service: Optional[str], bay: int, start: datetime) -> Optional[Booking]:
+        """
+        Занять слот за заявкой (прежняя запись заявки отменяется).
+        None — слот уже занят (другим клиентом или другим инстансом).
+        """
+        bay_index = self.index.get(bay)
+        if bay_index is None or not self.is_bookable(start):
+            BOOKINGS.inc("rejected")
+            return None
+        end = work_end(start, SERVICE_DURATIONS.get(service, DEFAULT_DURATION))
+
+        if db.get_bind().dialect.name == "postgresql":
+            # Проверка и вставка по одному боксу — по очереди между инстансами
+            db.execute(text("SELECT pg_advisory_xact_lock(7032, :bay)"), {"bay": bay})
+
+        taken = db.query(Booking.id).filter(
+            Booking.bay == bay,
+            Booking.status == "active",
+            Booking.lead_id != lead_id,
+            Booking.starts_at < end,
+            Booking.ends_at > start,
+        ).first()
+        if taken:
+            db.rollback()
+            BOOKINGS.inc("conflict")
+            self.loaded_at = None  # индекс устарел — перечитаем при следующем запросе
+            return None
+
+        self.release(db, lead_id, commit=False)
+        booking = Booking(lead_id=lead_id, bay=bay, starts_at=start, ends_at=end)
+        db.add(booking)
+        db.commit()
+        bay_index.add(start, end)
+        BOOKINGS.inc("booked")
+        return booking
+
+    def release(self, db: Session, lead_id: int, commit: bool = True):
+        """Отменить активную запись заявки (отказ, перезапись на другое время)"""
+        for booking in db.query(Booking).filter(Booking.lead_id == lead_id, Booking.status == "active"):
+            booking.status = "cancelled"
+            if booking.bay in self.index:
+                self.index[booking.bay].remove(booking.starts_at, booking.ends_at)
+        if commit:
+            db.commit()
+
+
+engine = SlotEngine(bays=config.STUDIO_BAYS, step_minutes=config.SLOT_STEP_MIN)
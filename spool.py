@@ -0,0 +1,343 @@
+"""
+Работа воронки при недоступной или медленной БД.
+
+Предохранитель (circuit breaker) на engine: после DB_BREAKER_FAILURES
+подряд ошибок соединения/таймаутов запросы к БД не выполняются вовсе —
+сразу DatabaseUnavailable, без ожидания таймаутов. Раз в
+DB_BREAKER_RESET_S пропускается один пробный запрос; удался — БД снова в строю.
+
+Хендлеры воронки при ошибке БД не падают: данные клиента и так лежат в FSM,
+а то, что нельзя потерять (сообщения клиента, готовая заявка), пишется
+в локальный журнал SPOOL_PATH (SQLite в режиме WAL, только добавление).
+Фоновая задача переносит журнал в БД строго по порядку записи, как только
+предохранитель снова пропускает запросы; по заявке после переноса уходит
+обычная карточка админу.
+
+Заявки воронки, прошедшей без БД, ещё нет: сообщения и заявка в журнале
+несут общий spool_key (funnel_state), заявка создаётся по нему ровно
+одна (уникальный leads.spool_key) — и при повторе прерванного переноса.
+"""
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.exc import InterfaceError, OperationalError, SQLAlchemyError
+
+import config
+import metrics
+
+logger = logging.getLogger(__name__)
+
+BREAKER_STATE = metrics.Gauge("bot_db_breaker_state", "Предохранитель БД: 0 — закрыт, 1 — пробный запрос, 2 — открыт")
+SPOOL_WRITES = metrics.Counter("bot_spool_writes_total", "Записи в локальный журнал при недоступной БД", ["kind"])
+SPOOL_REPLAYED = metrics.Counter("bot_spool_replayed_total", "Записи журнала, перенесённые в БД", ["kind"])
+SPOOL_PENDING = metrics.Gauge("bot_spool_pending", "Записей в журнале, ждущих переноса в БД")
+
+
+class DatabaseUnavailable(SQLAlchemyError):
+    """Предохранитель открыт — запрос к БД не выполнялся"""
+
+
+# ==================== ПРЕДОХРАНИТЕЛЬ ====================
+
+class CircuitBreaker:
+    CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+
+    def __init__(self, failure_threshold: int = 3, reset_timeout: float = 15.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._lock = threading.Lock()  # события engine приходят и из потоков (отчёты, фон)
+
+    def _set(self, state: str):
+        if state != self.state:
+            logger.warning("Предохранитель БД: %s → %s", self.state, state)
+        self.state = state
+        BREAKER_STATE.set({self.CLOSED: 0, self.HALF_OPEN: 1, self.OPEN: 2}[state])
+
+    def allow(self) -> bool:
+        """Можно ли сейчас идти в БД (в открытом состоянии — один пробный запрос раз в reset_timeout)"""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self._set(self.HALF_OPEN)
+                return True
+            return False
+
+    @property
+    def available(self) -> bool:
+        """Без побочных эффектов: закрыт или пора пробовать"""
+        return self.state == self.CLOSED or (
+            self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout
+        )
+
+    def success(self):
+        if self.state == self.CLOSED and not self.failures:
+            return
+        with self._lock:
+            self.failures = 0
+            self._set(self.CLOSED)
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+                self._set(self.OPEN)
+
+
+def guard_engine(engine, breaker: "CircuitBreaker"):
+    """Повесить предохранитель на engine: ошибки соединения и таймауты его размыкают"""
+
+    @event.listens_for(engine, "do_connect")
+    def _connect(dialect, conn_rec, cargs, cparams):
+        if not breaker.allow():
+            raise DatabaseUnavailable("database circuit is open")
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        if not breaker.allow():
+            raise DatabaseUnavailable("database circuit is open")
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        breaker.success()
+
+    @event.listens_for(engine, "handle_error")
+    def _error(context):
+        if isinstance(context.original_exception, DatabaseUnavailable):
+            return
+        if context.is_disconnect or isinstance(context.sqlalchemy_exception, (OperationalError, InterfaceError)):
+            breaker.failure()
+
+
+def engine_options(database_url: str) -> dict:
+    """Таймауты, чтобы зависшая БД не держала хендлеры дольше нескольких секунд"""
+    options = {"pool_timeout": config.DB_POOL_TIMEOUT, "pool_pre_ping": True}
+    if database_url.startswith("postgres"):
+        options["connect_args"] = {
+            "connect_timeout": config.DB_CONNECT_TIMEOUT,
+            "options": f"-c statement_timeout={config.DB_STATEMENT_TIMEOUT_MS}",
+        }
+    return options
+
+
+# ==================== ЖУРНАЛ ====================
+
+class Spool:
+    """Локальный журнал: (seq, kind, payload), читается в порядке seq"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS spool ("
+                "seq INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT NOT NULL, "
+                "payload TEXT NOT NULL, created_at REAL NOT NULL)"
+            )
+            self._conn = conn
+            SPOOL_PENDING.set(self.pending())
+        return self._conn
+
+    def append(self, kind: str, payload: dict) -> int:
+        with self._lock:
+            seq = self.conn.execute(
+                "INSERT INTO spool (kind, payload, created_at) VALUES (?, ?, ?)",
+                (kind, json.dumps(payload, ensure_ascii=False, default=str), time.time()),
+            ).lastrowid
+        SPOOL_WRITES.inc(kind)
+        SPOOL_PENDING.set(self.pending())
+        return seq
+
+    def peek(self, limit: int = 100) -> List[Tuple[int, str, dict]]:
+        with self._lock:
+            rows = self.conn.execute("SELECT seq, kind, payload FROM spool ORDER BY seq LIMIT ?", (limit,)).fetchall()
+        return [(seq, kind, json.loads(payload)) for seq, kind, payload in rows]
+
+    def delete(self, seq: int):
+        with self._lock:
+            self.conn.execute("DELETE FROM spool WHERE seq = ?", (seq,))
+        SPOOL_PENDING.set(self.pending())
+
+    def pending(self) -> int:
+        if self._conn is None and not os.path.exists(self.path):
+            return 0
+        return self.conn.execute("SELECT count(*) FROM spool").fetchone()[0]
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+# ==================== ПЕРЕНОС В БД ====================
+
+ReplayHandler = Callable[[object, object, dict], Awaitable[None]]
+
+
+class Replayer:
+    """Фоновый перенос журнала в БД по порядку; на первой ошибке — стоп до следующего раза"""
+
+    def __init__(self, journal: Spool, breaker: CircuitBreaker, interval: float = 5.0):
+        self.journal = journal
+        self.breaker = breaker
+        self.interval = interval
+        self._handlers: Dict[str, ReplayHandler] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def handler(self, kind: str):
+        def register(function: ReplayHandler) -> ReplayHandler:
+            self._handlers[kind] = function
+            return function
+        return register
+
+    async def replay(self, bot, session_factory) -> int:
+        """Перенести всё, что получится; возвращает число перенесённых записей"""
+        replayed = 0
+        while self.breaker.available:
+            entries = self.journal.peek()
+            if not entries:
+                break
+            for seq, kind, payload in entries:
+                try:
+                    await self._handlers[kind](bot, session_factory, payload)
+                except SQLAlchemyError as e:
+                    logger.info("Перенос журнала отложен (запись %s): %s", seq, e)
+                    return replayed
+                self.journal.delete(seq)
+                SPOOL_REPLAYED.inc(kind)
+                replayed += 1
+        if replayed:
+            logger.info("Из журнала перенесено в БД: %d", replayed)
+        return replayed
+
+    async def run(self, bot, session_factory):
+        while True:
+            try:
+                if self.journal.pending():
+                    await self.replay(bot, session_factory)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Ошибка переноса журнала: %s", e)
+            await asyncio.sleep(self.interval)
+
+    def start(self, bot, session_factory):
+        if self._task is None:
+            self._task = asyncio.create_task(self.run(bot, session_factory))
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        self.journal.close()
+
+
+breaker = CircuitBreaker(config.DB_BREAKER_FAILURES, config.DB_BREAKER_RESET_S)
+journal = Spool(config.SPOOL_PATH)
+replayer = Replayer(journal, breaker)
+
+
+# ==================== ЗАПИСИ ВОРОНКИ ====================
+
+def _spooled_lead(db, payload: dict, created_at: datetime):
+    """Заявка воронки по spool_key записи журнала; нет — создаётся (без commit)"""
+    from database import Lead, LeadStatus
+
+    lead = db.query(Lead).filter(Lead.spool_key == payload["spool_key"]).first()
+    if lead is None:
+        lead = Lead(user_id=payload["user_id"], status=LeadStatus.NEW, spool_key=payload["spool_key"], created_at=created_at)
+        db.add(lead)
+        db.flush()
+    return lead
+
+
+@replayer.handler("message")
+async def replay_message(bot, session_factory, payload: dict):
+    from database import Message
+
+    created_at = datetime.fromisoformat(payload["created_at"])
+    db = session_factory()
+    try:
+        lead_id = payload["lead_id"]
+        if lead_id is None and payload.get("spool_key"):
+            lead_id = _spooled_lead(db, payload, created_at).id
+        db.add(Message(
+            user_id=payload["user_id"],
+            text=payload["text"],
+            lead_id=lead_id,
+            is_from_admin=payload["is_from_admin"],
+            message_type=payload["message_type"],
+            created_at=created_at,
+        ))
+        db.commit()
+    finally:
+        db.close()
+
+
+@replayer.handler("lead")
+async def replay_lead(bot, session_factory, payload: dict):
+    """Заявка, завершённая без БД: создать/дополнить лид, затем карточка админу"""
+    import cards
+    import clients
+    import reminders
+    from database import Lead, LeadStatus, User
+
+    created_at = datetime.fromisoformat(payload["created_at"])
+    db = session_factory()
+    try:
+        user = db.query(User).filter(User.user_id == payload["user_id"]).first()
+        if user is None:
+            user = User(user_id=payload["user_id"], **payload["user"])
+            db.add(user)
+
+        lead = db.get(Lead, payload["lead_id"]) if payload["lead_id"] else None
+        if lead is None and payload.get("spool_key"):
+            # Сообщения воронки уже в этой заявке (replay_message)
+            lead = _spooled_lead(db, payload, created_at)
+        if lead is None:
+            lead = Lead(user_id=payload["user_id"], status=LeadStatus.NEW, created_at=created_at)
+            db.add(lead)
+        for key, value in payload["fields"].items():
+            if value not in (None, ""):
+                setattr(lead, key, value)
+        lead.updated_at = datetime.utcnow()
+        db.flush()
+        clients.link_lead(db, lead)
+        db.commit()
+
+        # Заявка уже в БД: ошибка отправки не должна повторить перенос (и создать дубль)
+        reminders.schedule_admin_followup(lead.id)
+        try:
+            await cards.send_to_admins(bot, db, lead, user)
+        except Exception as e:
+            db.rollback()
+            logger.warning("Карточка заявки %s из журнала не отправлена: %s", lead.id, e)
+    finally:
+        db.close()
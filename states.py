@@ -79,6 +79,11 @@ class GenericCollection(StatesGroup):
     collecting_phone = State()
 
 
+class FAQFlow(StatesGroup):
+    """Сценарий: Вопрос о студии / услугах"""
+    asking = State()                # Клиент пишет вопрос
+
+
 class AdminDialog(StatesGroup):
     """Режим диалога: админ общается с клиентом"""
     active = State()  # Диалог открыт
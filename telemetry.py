@@ -0,0 +1,150 @@
+"""
+Телеметрия воронки: вход/выход клиента из шагов FSM.
+
+Хендлер только кладёт кортеж в кольцевой буфер (O(1), без I/O),
+фоновая задача пачками сбрасывает события в таблицу funnel_events.
+"""
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+from datetime import datetime, timezone
+from typing import Optional
+
+from sqlalchemy import insert
+
+from database import FunnelEvent
+
+logger = logging.getLogger(__name__)
+
+# Через сколько секунд неактивности забываем текущий шаг клиента
+STEP_TTL_SECONDS = 60 * 60 * 24
+
+
+class FunnelTelemetry:
+    """Кольцевой буфер событий воронки с пакетной записью в БД"""
+
+    def __init__(self, capacity: int = 50000, batch_size: int = 1000, flush_interval: float = 5.0):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        # (user_id, lead_id, step, event, next_step, duration_ms, timestamp)
+        self._buffer = deque(maxlen=capacity)
+
+        # user_id -> (step, lead_id, entered_at); порядок — по последней активности
+        self._current = OrderedDict()
+
+        self._task: Optional[asyncio.Task] = None
+        self.dropped = 0
+        self.written = 0
+
+    @property
+    def pending(self) -> int:
+        """Сколько событий ждёт записи"""
+        return len(self._buffer)
+
+    # ---------- Запись событий (вызывается из хендлеров) ----------
+
+    def step(self, user_id: int, step: str, lead_id: int = None):
+        """Клиент перешёл на шаг step"""
+        now = time.time()
+        previous = self._current.pop(user_id, None)
+
+        if previous is not None:
+            prev_step, prev_lead_id, entered_at = previous
+            lead_id = lead_id or prev_lead_id
+            self._push(user_id, lead_id, prev_step, "exit", step, int((now - entered_at) * 1000), now)
+
+        self._push(user_id, lead_id, step, "enter", None, None, now)
+        self._current[user_id] = (step, lead_id, now)
+        self._evict(now)
+
+    def leave(self, user_id: int, outcome: str):
+        """Клиент вышел из воронки (completed / menu / restart)"""
+        previous = self._current.pop(user_id, None)
+        if previous is None:
+            return
+
+        now = time.time()
+        prev_step, lead_id, entered_at = previous
+        self._push(user_id, lead_id, prev_step, "exit", outcome, int((now - entered_at) * 1000), now)
+
+    def restore(self, user_id: int, step: str, lead_id: Optional[int], entered_at: datetime):
+        """Шаг клиента из БД после рестарта (cache.py): следующий переход запишет exit с длительностью"""
+        if user_id not in self._current:
+            self._current[user_id] = (step, lead_id, entered_at.replace(tzinfo=timezone.utc).timestamp())
+
+    def _push(self, *event):
+        if len(self._buffer) == self._buffer.maxlen:
+            self.dropped += 1
+        self._buffer.append(event)
+
+    def _evict(self, now: float):
+        """Забыть клиентов, которые давно не двигались по воронке"""
+        while self._current:
+            user_id, (_, _, entered_at) = next(iter(self._current.items()))
+            if now - entered_at < STEP_TTL_SECONDS:
+                break
+            self._current.popitem(last=False)
+
+    # ---------- Сброс в БД ----------
+
+    def _drain(self) -> list:
+        batch = []
+        while self._buffer and len(batch) < self.batch_size:
+            batch.append(self._buffer.popleft())
+        return batch
+
+    def _write(self, session_factory, batch: list):
+        rows = [
+            {
+                "user_id": user_id,
+                "lead_id": lead_id,
+                "step": step,
+                "event": event,
+                "next_step": next_step,
+                "duration_ms": duration_ms,
+                "created_at": datetime.utcfromtimestamp(timestamp),
+            }
+            for user_id, lead_id, step, event, next_step, duration_ms, timestamp in batch
+        ]
+
+        db = session_factory()
+        try:
+            db.execute(insert(FunnelEvent), rows)
+            db.commit()
+        finally:
+            db.close()
+
+    async def flush(self, session_factory):
+        """Сбросить всё накопленное (запись — в потоке, не на event loop)"""
+        loop = asyncio.get_running_loop()
+
+        while self._buffer:
+            batch = self._drain()
+            try:
+                await loop.run_in_executor(None, self._write, session_factory, batch)
+                self.written += len(batch)
+            except Exception as e:
+                # Телеметрия не должна ронять бота — теряем пачку
+                self.dropped += len(batch)
+                logger.warning("Не удалось записать %d событий воронки: %s", len(batch), e)
+                return
+
+    async def run(self, session_factory):
+        """Фоновая задача периодического сброса"""
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush(session_factory)
+
+    def start(self, session_factory):
+        self._task = asyncio.create_task(self.run(session_factory))
+
+    async def stop(self, session_factory):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        await self.flush(session_factory)
+
+
+funnel = FunnelTelemetry()